@@ -93,6 +93,31 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Write transactions take the lock at BEGIN; see shop.db.write_transaction for retries
+            'transaction_mode': 'IMMEDIATE',
+            # Seconds a connection waits on a busy database before raising "database is locked"
+            'timeout': 5,
+            # WAL lets readers carry on while a till writes, so commits do not wait on them
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+        },
+    }
+}
+
+
+# Cache
+# Shared by all worker processes through the filesystem, no cache server needed.
+# Dashboard and report contexts are keyed by per-model versions, which live in the
+# shop_cacheversion table and are written once per committed transaction (see shop.cache)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
     }
 }
 
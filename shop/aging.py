@@ -0,0 +1,136 @@
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal
+from django.db.models import F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import Client, Sale, Invoice, DebtPayment, BALANCE_FIELD
+from .reports import day_bounds
+
+CENT = Decimal('0.01')
+
+# Days past due covered by each bucket (None = open ended), oldest last
+AgingBucket = namedtuple('AgingBucket', 'key label first last')
+BUCKETS = (
+    AgingBucket('current', 'Current', None, 0),
+    AgingBucket('days_30', '1-30', 1, 30),
+    AgingBucket('days_60', '31-60', 31, 60),
+    AgingBucket('days_90', '61-90', 61, 90),
+    AgingBucket('over_90', '90+', 91, None),
+)
+
+def due_filter(bucket, today, due_date=None, due_datetime=None):
+    """
+    Q matching rows whose due day falls in bucket. due_date names a DateField; rows without
+    one fall back to due_datetime, a DateTimeField compared on local day boundaries
+    """
+    # Due on day d is (today - d) days past due, so older buckets reach further back
+    earliest = today - timedelta(days=bucket.last) if bucket.last is not None else None
+    latest = today - timedelta(days=bucket.first) if bucket.first is not None else None
+
+    by_datetime = Q()
+    if earliest is not None:
+        by_datetime &= Q(**{f'{due_datetime}__gte': day_bounds(earliest, earliest)[0]})
+    if latest is not None:
+        by_datetime &= Q(**{f'{due_datetime}__lt': day_bounds(latest, latest)[1]})
+    if due_date is None:
+        return by_datetime
+
+    by_date = Q(**{f'{due_date}__isnull': False})
+    if earliest is not None:
+        by_date &= Q(**{f'{due_date}__gte': earliest})
+    if latest is not None:
+        by_date &= Q(**{f'{due_date}__lte': latest})
+    return by_date | (Q(**{f'{due_date}__isnull': True}) & by_datetime)
+
+def bucket_totals(queryset, client_field, amount, today, **due_fields):
+    """
+    {client_id: [total per bucket]} for a queryset, in one grouped query
+    """
+    amount_sum = {
+        bucket.key: Coalesce(Sum(amount, filter=due_filter(bucket, today, **due_fields)), Value(Decimal('0')),
+                             output_field=BALANCE_FIELD)
+        for bucket in BUCKETS
+    }
+    rows = queryset.values(client_field).annotate(**amount_sum).order_by()
+    return {row[client_field]: [row[bucket.key] for bucket in BUCKETS] for row in rows}
+
+def apply_credits(amounts, credit):
+    """
+    Take credit (payments on account and overpaid documents) off the oldest buckets first
+    """
+    amounts = list(amounts)
+    credit += sum(-value for value in amounts if value < 0)
+    amounts = [max(value, Decimal('0')) for value in amounts]
+    for i in reversed(range(len(amounts))):
+        taken = min(amounts[i], credit)
+        amounts[i] -= taken
+        credit -= taken
+    return amounts
+
+def aging_rows(today=None, client_ids=None):
+    """
+    Outstanding receivables per client bucketed by days past due, largest balance first
+    Credit sales are due on the sale date and credit invoices on their due date (or invoice
+    date when none is set). Only clients with a positive stored balance are read
+    """
+    today = today or timezone.localdate()
+    clients = Client.objects.filter(balance__gt=0)
+    if client_ids is not None:
+        clients = clients.filter(pk__in=client_ids)
+    names = dict(clients.values_list('pk', 'name'))
+    ids = clients.values('pk')
+
+    sales = bucket_totals(
+        Sale.objects.filter(is_credit=True, client__in=ids), 'client_id',
+        F('quantity') * F('price_at_sale') - F('amount_paid'), today, due_datetime='date'
+    )
+    invoices = bucket_totals(
+        Invoice.objects.filter(is_credit=True, client__in=ids), 'client_id',
+        F('balance_due'), today, due_date='due_date', due_datetime='date'
+    )
+    payments = dict(
+        DebtPayment.objects.filter(client__in=ids).values('client_id').annotate(total=Sum('amount'))
+        .values_list('client_id', 'total').order_by()
+    )
+
+    zero = [Decimal('0')] * len(BUCKETS)
+    rows = []
+    for client_id, name in names.items():
+        charged = [s + i for s, i in zip(sales.get(client_id, zero), invoices.get(client_id, zero))]
+        amounts = [amount.quantize(CENT) for amount in apply_credits(charged, payments.get(client_id) or Decimal('0'))]
+        total = sum(amounts)
+        if total > 0:
+            rows.append({'client_id': client_id, 'name': name, 'total': total, 'amounts': amounts,
+                         'buckets': dict(zip((bucket.key for bucket in BUCKETS), amounts))})
+    rows.sort(key=lambda row: (-row['total'], row['name']))
+    return rows
+
+def aging_totals(rows):
+    totals = {bucket.key: sum((row['buckets'][bucket.key] for row in rows), Decimal('0')) for bucket in BUCKETS}
+    totals['total'] = sum((row['total'] for row in rows), Decimal('0'))
+    return totals
+
+def open_documents(client_id, today=None):
+    """
+    A client's credit sales and invoices that are not fully paid, oldest due first, with days past due
+    Payments on account are not allocated to individual documents here
+    """
+    today = today or timezone.localdate()
+    documents = []
+    sales = (
+        Sale.objects.filter(client_id=client_id, is_credit=True)
+        .annotate(outstanding=F('quantity') * F('price_at_sale') - F('amount_paid'))
+        .filter(outstanding__gt=0)
+        .select_related('product')
+    )
+    for sale in sales:
+        due = timezone.localdate(sale.date)
+        documents.append({'reference': f'Sale #{sale.pk}', 'description': sale.product.name,
+                          'due': due, 'days': (today - due).days, 'outstanding': sale.outstanding})
+    for invoice in Invoice.objects.filter(client_id=client_id, is_credit=True, balance_due__gt=0):
+        due = invoice.due_date or timezone.localdate(invoice.date)
+        documents.append({'reference': f'Invoice #{invoice.pk}', 'description': invoice.notes or '',
+                          'due': due, 'days': (today - due).days, 'outstanding': invoice.balance_due})
+    documents.sort(key=lambda document: document['due'])
+    return documents
@@ -0,0 +1,175 @@
+import math
+import statistics
+import time
+from contextlib import closing
+from decimal import Decimal
+from django.db import connection, transaction
+from django.utils import timezone
+from .costing import get_strategy
+from .fifo import rebuild_product
+from .models import Product, InventoryMovement, FifoLayer, FifoAllocation, Sale, allocate_batches
+
+# Operation name, expected growth exponent in the number of layers/history size, description
+OPERATIONS = [
+    ('lookup', 0, 'cost of the next units from the open layers, nothing written'),
+    ('deduct', 0, 'consume stock and record its allocations'),
+    ('reverse', 0, 'hand a consumption back to its layers'),
+    ('rebuild', 1, 'recompute layers and costs from the full history'),
+]
+
+DEDUCT_QUANTITY = Decimal('2.50')
+
+def build_product(size, history_factor=1, batch_size=5000):
+    """
+    Create a FIFO product with size open layers of one unit each, preceded by
+    history_factor * size batches that were fully consumed by one sale each
+    The history is bulk inserted: 2 * history_factor * size + size movements in total
+    """
+    product = Product.objects.create(
+        name=f"Benchmark {size}",
+        unit_price=Decimal('10.00'),
+        cost_price=Decimal('5.00'),
+        current_stock=size
+    )
+    history = history_factor * size
+    start = timezone.now() - timezone.timedelta(seconds=3 * (history + size) + 60)
+
+    def at(step):
+        return start + timezone.timedelta(seconds=step)
+
+    batches = InventoryMovement.objects.bulk_create(
+        (
+            InventoryMovement(product=product, movement_type='IN', quantity=1,
+                              cost_price=Decimal(5 + i % 7), date=at(3 * i), reference='Benchmark')
+            for i in range(history + size)
+        ),
+        batch_size=batch_size
+    )
+    sales = Sale.objects.bulk_create(
+        (
+            Sale(product=product, quantity=1, price_at_sale=Decimal('10.00'),
+                 cost_price=batch.cost_price, date=at(3 * i + 1))
+            for i, batch in enumerate(batches[:history])
+        ),
+        batch_size=batch_size
+    )
+    InventoryMovement.objects.bulk_create(
+        (
+            InventoryMovement(product=product, sale=sale, movement_type='OUT', quantity=1,
+                              cost_price=sale.cost_price, date=sale.date, reference='Benchmark')
+            for sale in sales
+        ),
+        batch_size=batch_size
+    )
+    FifoAllocation.objects.bulk_create(
+        (FifoAllocation(batch=batch, sale=sale, quantity=1) for batch, sale in zip(batches, sales)),
+        batch_size=batch_size
+    )
+    FifoLayer.objects.bulk_create(
+        (
+            FifoLayer(product=product, movement=batch, date=batch.date, cost_price=batch.cost_price,
+                      remaining_quantity=1)
+            for batch in batches[history:]
+        ),
+        batch_size=batch_size
+    )
+    return product
+
+def lookup(product):
+    strategy = get_strategy(product)
+    layers = product.fifo_layers.order_by(*strategy.layer_ordering)
+    with closing(layers.iterator(chunk_size=100)) as open_layers:
+        return allocate_batches(open_layers, DEDUCT_QUANTITY, fallback_cost=product.cost_price)
+
+def timed(operation, repeat):
+    """
+    Median wall time in seconds of repeat calls of operation
+    """
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+def measure(product, repeat=5):
+    """
+    Median seconds per operation for one product
+    Every deduction is reversed again so each repeat sees the same layers
+    """
+    seconds = {'lookup': timed(lambda: lookup(product), repeat)}
+
+    deduct, reverse = [], []
+    for _ in range(repeat):
+        movement = InventoryMovement.objects.create(
+            product=product, movement_type='OUT', quantity=DEDUCT_QUANTITY, reference='Benchmark'
+        )
+        started = time.perf_counter()
+        consumption = product.consume_fifo(DEDUCT_QUANTITY)
+        FifoAllocation.record(consumption.allocations, stock_out=movement)
+        deduct.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        FifoAllocation.release(movement.out_allocations.all())
+        reverse.append(time.perf_counter() - started)
+        movement.delete()
+    seconds['deduct'] = statistics.median(deduct)
+    seconds['reverse'] = statistics.median(reverse)
+
+    seconds['rebuild'] = timed(lambda: rebuild_product(product.id), max(1, repeat // 5))
+    return seconds
+
+def growth_exponents(sizes, seconds):
+    """
+    Growth exponent between each pair of consecutive sizes: 0 for constant time, 1 for linear
+    Fixed overheads flatten the small sizes, so the largest step is the one that matters
+    """
+    steps = zip(sizes, sizes[1:], seconds, seconds[1:])
+    return [
+        math.log(max(slow, 1e-9) / max(fast, 1e-9)) / math.log(large / small)
+        for small, large, fast, slow in steps
+    ]
+
+def run_benchmark(sizes=(10, 1000, 100000), history_factor=1, repeat=5, tolerance=0.3):
+    """
+    Build one product per size, time every operation and compare how each one grows
+    with the expected exponent. Everything is rolled back afterwards
+    Returns a JSON-serialisable report; report['ok'] is False on a complexity regression
+    """
+    sizes = sorted(set(sizes))
+    timings = {name: [] for name, _, _ in OPERATIONS}
+    build_seconds = []
+    with transaction.atomic():
+        for size in sizes:
+            started = time.perf_counter()
+            product = build_product(size, history_factor)
+            build_seconds.append(time.perf_counter() - started)
+            for name, value in measure(product, repeat).items():
+                timings[name].append(value)
+        transaction.set_rollback(True)
+
+    operations = {}
+    for name, expected, description in OPERATIONS:
+        exponents = growth_exponents(sizes, timings[name])
+        exponent = max(exponents, default=0.0)
+        operations[name] = {
+            'description': description,
+            'expected_exponent': expected,
+            'limit': expected + tolerance,
+            'exponent': round(exponent, 3),
+            'step_exponents': [round(value, 3) for value in exponents],
+            'seconds': dict(zip((str(size) for size in sizes), timings[name])),
+            'ok': exponent <= expected + tolerance,
+        }
+
+    return {
+        'generated': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'sizes': sizes,
+        'history_factor': history_factor,
+        'movements': {str(size): size * (2 * history_factor + 1) for size in sizes},
+        'repeat': repeat,
+        'build_seconds': dict(zip((str(size) for size in sizes), build_seconds)),
+        'operations': operations,
+        'ok': all(result['ok'] for result in operations.values()),
+    }
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import threading
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+# Cached contexts also expire on their own, in case a write ever bypasses the version bumps
+CONTEXT_TIMEOUT = 600
+
+# Models bumped in this thread whose new versions have not been written yet
+pending = threading.local()
+
+def new_version():
+    # Unique across worker processes, so concurrent bumps can never land on the same value
+    return f'{time.time_ns():x}-{os.getpid()}'
+
+def bump_versions(*models):
+    """
+    Give each model a new version so contexts cached from its rows are no longer used
+    The versions are written once the surrounding transaction commits (right away outside
+    one), all of the transaction's bumps in one upsert, so a write transaction does no
+    cache I/O while it holds the database lock. A context built before the commit is
+    cached under the old versions and is not reused after it
+    """
+    labels = getattr(pending, 'labels', None)
+    if labels is None:
+        labels = pending.labels = set()
+    labels.update(model._meta.label_lower for model in models)
+    # Every bump registers the write, so a rolled back savepoint cannot drop it; only the first one writes
+    transaction.on_commit(write_versions, robust=True)
+
+def write_versions():
+    from .models import CacheVersion
+
+    labels = getattr(pending, 'labels', None)
+    if not labels:
+        return
+    pending.labels = set()
+    version = new_version()
+    CacheVersion.objects.bulk_create(
+        [CacheVersion(model=label, version=version) for label in sorted(labels)],
+        update_conflicts=True, unique_fields=['model'], update_fields=['version']
+    )
+
+def model_versions(models):
+    from .models import CacheVersion
+
+    labels = [model._meta.label_lower for model in models]
+    versions = dict(CacheVersion.objects.filter(model__in=labels).values_list('model', 'version'))
+    return [versions.get(label, '') for label in labels]
+
+def cached_context(name, models, params, build, timeout=CONTEXT_TIMEOUT):
+    """
+    Return build() through the cache. The key covers name, the request parameters
+    (e.g. the date range) and the current version of every model the context is built from
+    """
+    signature = repr((sorted(params.items()), model_versions(models)))
+    key = f'shop:context:{name}:{hashlib.sha1(signature.encode()).hexdigest()}'
+    context = cache.get(key)
+    if context is None:
+        context = build()
+        cache.set(key, context, timeout)
+    return context
@@ -0,0 +1,274 @@
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from .cache import bump_versions
+from .costing import get_strategy, quantize_cost
+from .models import Product, InventoryMovement, FifoLayer, FifoAllocation, Invoice, SaleItem, allocate_batches
+
+CheckoutLine = namedtuple('CheckoutLine', ['product_id', 'quantity', 'price'])
+# What an invoice edit changes: (item, movement, new quantity) updated in place, (item, extra
+# quantity) grown, (item, quantity handed back) shrunk, (item, movement) removed, new lines
+# added and the net stock change per product
+LineChanges = namedtuple('LineChanges', ['changed', 'grown', 'shrunk', 'removed', 'added', 'stock_change'])
+
+def parse_lines(items_data):
+    """
+    Turn the JSON items of an invoice into CheckoutLines, dropping empty quantities
+    """
+    lines = []
+    for item in items_data:
+        quantity = Decimal(item['quantity'])
+        if quantity <= 0:
+            continue
+        lines.append(CheckoutLine(int(item['product_id']), quantity, Decimal(item['price'])))
+    return lines
+
+def load_products(product_ids):
+    products = Product.objects.in_bulk(product_ids)
+    missing = set(product_ids) - set(products)
+    if missing:
+        raise Product.DoesNotExist(f"Product {min(missing)} does not exist.")
+    return products
+
+def check_stock(products, requested):
+    for product_id, quantity in requested.items():
+        product = products[product_id]
+        if product.current_stock < quantity:
+            raise ValueError(f"Not enough stock for {product.name}")
+
+def lock_layers(products):
+    """
+    Open layers of the layered products among products, locked and in consumption order
+    """
+    layers = defaultdict(list)
+    layered_ids = [pk for pk, product in products.items() if get_strategy(product).uses_layers]
+    for layer in FifoLayer.objects.select_for_update().filter(product_id__in=layered_ids):
+        layers[layer.product_id].append(layer)
+    for product_id, product_layers in layers.items():
+        product_layers.sort(key=get_strategy(products[product_id]).sort_key)
+    return layers
+
+def consume(product, layers, quantity):
+    """
+    Take quantity of product from its in-memory layers (or its costing strategy when it keeps none)
+    """
+    strategy = get_strategy(product)
+    if strategy.uses_layers:
+        open_layers = (layer for layer in layers[product.id] if layer.remaining_quantity > 0)
+        return allocate_batches(open_layers, quantity, fallback_cost=product.cost_price)
+    return strategy.consume(product, quantity)
+
+def add_lines(invoice, products, layers, lines, reference):
+    """
+    Consume stock for new lines and build their SaleItems, OUT movements and allocations (unsaved)
+    Returns the items, movements, per-item allocations and every (layer, quantity) taken
+    """
+    items, movements, line_allocations, taken = [], [], [], []
+    for line in lines:
+        product = products[line.product_id]
+        consumption = consume(product, layers, line.quantity)
+        taken += consumption.allocations
+
+        items.append(SaleItem(
+            invoice=invoice,
+            product=product,
+            quantity=line.quantity,
+            price_at_sale=line.price,
+            cost_price=consumption.cost_price
+        ))
+        movements.append(InventoryMovement(
+            product=product,
+            invoice=invoice,
+            movement_type='OUT',
+            quantity=line.quantity,
+            date=invoice.date,
+            reference=reference,
+            cost_price=consumption.cost_price
+        ))
+        line_allocations.append(consumption.allocations)
+    return items, movements, line_allocations, taken
+
+def save_lines(items, movements, line_allocations):
+    SaleItem.objects.bulk_create(items)
+    InventoryMovement.objects.bulk_create(movements)
+    FifoAllocation.objects.bulk_create([
+        FifoAllocation(batch_id=layer.movement_id, quantity=quantity, sale_item=item)
+        for item, allocations in zip(items, line_allocations)
+        for layer, quantity in allocations
+    ])
+
+def refresh_invoice(invoice):
+    bump_versions(SaleItem, InventoryMovement)
+    Invoice.refresh_totals([invoice.pk])
+    invoice.refresh_from_db(fields=Invoice.TOTAL_FIELDS)
+
+def checkout_invoice(invoice, lines, reference):
+    """
+    Add lines to an invoice with a constant number of queries and refresh its stored totals
+    All line products and their open layers are loaded in two queries, stock and
+    costs are worked out in memory, and items, OUT movements, allocations, layers
+    and stock levels are written with bulk statements; stock and layers are taken
+    with guarded F() updates so a concurrent checkout can never oversell
+    Raises ValueError (InsufficientStock) when a product does not have enough stock for its lines
+    Returns the created SaleItems and the total sale price
+    """
+    products = load_products({line.product_id for line in lines})
+    requested = defaultdict(Decimal)
+    for line in lines:
+        requested[line.product_id] += line.quantity
+    check_stock(products, requested)
+
+    layers = lock_layers(products)
+    items, movements, line_allocations, taken = add_lines(invoice, products, layers, lines, reference)
+
+    Product.adjust_stock({product_id: -quantity for product_id, quantity in requested.items()})
+    save_lines(items, movements, line_allocations)
+    FifoLayer.save_allocations(taken)
+    refresh_invoice(invoice)
+    return items, sum(line.quantity * line.price for line in lines)
+
+def blend_cost(first_cost, first_quantity, second_cost, second_quantity):
+    """
+    Weighted average of two cost prices; a missing cost gives way to the other one
+    """
+    if first_cost is None or second_cost is None:
+        return first_cost if second_cost is None else second_cost
+    return quantize_cost((first_cost * first_quantity + second_cost * second_quantity) / (first_quantity + second_quantity))
+
+def shrink_allocations(shrunk):
+    """
+    Hand quantity of each (item, quantity) back to the layers it came from, last consumed first
+    Returns {item_id: remaining allocations}
+    """
+    allocations = defaultdict(list)
+    queryset = FifoAllocation.objects.filter(sale_item__in=[item for item, _ in shrunk]).select_related('batch__product')
+    for allocation in queryset.order_by('-id'):
+        allocations[allocation.sale_item_id].append(allocation)
+
+    returned, batches, emptied, reduced = defaultdict(Decimal), {}, [], []
+    for item, quantity in shrunk:
+        for allocation in allocations[item.pk]:
+            if quantity <= 0:
+                break
+            given = min(quantity, allocation.quantity)
+            returned[allocation.batch_id] += given
+            batches[allocation.batch_id] = allocation.batch
+            allocation.quantity -= given
+            quantity -= given
+            (emptied if allocation.quantity <= 0 else reduced).append(allocation)
+
+    FifoAllocation.restore_layers(returned, batches)
+    FifoAllocation.objects.filter(pk__in=[allocation.pk for allocation in emptied]).delete()
+    FifoAllocation.objects.bulk_update(reduced, ['quantity'])
+    return {
+        item_id: [allocation for allocation in item_allocations if allocation.quantity > 0]
+        for item_id, item_allocations in allocations.items()
+    }
+
+def diff_lines(invoice, lines):
+    """
+    Pair an invoice's items with new lines per product, in order, and work out what changed
+    """
+    old_items = defaultdict(list)
+    for item in invoice.items.order_by('id'):
+        old_items[item.product_id].append(item)
+    old_movements = defaultdict(list)
+    for movement in invoice.inventory_movements.filter(movement_type='OUT').order_by('id'):
+        old_movements[movement.product_id].append(movement)
+    new_lines = defaultdict(list)
+    for line in lines:
+        new_lines[line.product_id].append(line)
+
+    changes = LineChanges([], [], [], [], [], defaultdict(Decimal))
+    for product_id in old_items.keys() | new_lines.keys():
+        items, product_lines = old_items[product_id], new_lines[product_id]
+        movements = dict(zip((item.pk for item in items), old_movements[product_id]))
+        for item, line in zip(items, product_lines):
+            if (item.quantity, item.price_at_sale) == (line.quantity, line.price):
+                continue
+            delta = line.quantity - item.quantity
+            if delta > 0:
+                changes.grown.append((item, delta))
+            elif delta < 0:
+                changes.shrunk.append((item, -delta))
+            item.price_at_sale = line.price
+            changes.changed.append((item, movements.get(item.pk), line.quantity))
+            changes.stock_change[product_id] -= delta
+        for item in items[len(product_lines):]:
+            changes.removed.append((item, movements.get(item.pk)))
+            changes.stock_change[product_id] += item.quantity
+        for line in product_lines[len(items):]:
+            changes.added.append(line)
+            changes.stock_change[product_id] -= line.quantity
+    return changes
+
+def update_invoice_lines(invoice, lines, reference):
+    """
+    Bring an invoice's items in line with lines by applying only what changed
+    A paired line keeps its item and OUT movement and is updated in place: a new price is
+    just written, a larger quantity consumes only the extra units and a smaller one hands
+    the last consumed units back to their layers. Unpaired old lines are returned to stock
+    and unpaired new lines are checked out. Stock moves by the net change per product in
+    one guarded F() update
+    Raises ValueError (InsufficientStock) when a product does not have enough stock for the increase
+    Returns the total sale price
+    """
+    changes = diff_lines(invoice, lines)
+    if changes.changed or changes.removed or changes.added:
+        apply_line_changes(invoice, changes, reference)
+    refresh_invoice(invoice)
+    return sum(line.quantity * line.price for line in lines)
+
+def apply_line_changes(invoice, changes, reference):
+    changed, grown, shrunk, removed, added, stock_change = changes
+    products = load_products({line.product_id for line in added} | {item.product_id for item, _ in grown})
+    check_stock(products, {pk: -change for pk, change in stock_change.items() if change < 0 and pk in products})
+
+    # Hand stock back first, so the units can be taken again by the growing lines
+    if removed:
+        FifoAllocation.release(FifoAllocation.objects.filter(sale_item__in=[item for item, _ in removed]))
+        InventoryMovement.objects.filter(pk__in=[movement.pk for _, movement in removed if movement]).delete()
+        SaleItem.objects.filter(pk__in=[item.pk for item, _ in removed]).delete()
+    remaining = shrink_allocations(shrunk) if shrunk else {}
+
+    layers = lock_layers(products)
+    taken, new_allocations = [], []
+    for item, delta in grown:
+        consumption = consume(products[item.product_id], layers, delta)
+        taken += consumption.allocations
+        new_allocations += [
+            FifoAllocation(batch_id=layer.movement_id, quantity=quantity, sale_item=item)
+            for layer, quantity in consumption.allocations
+        ]
+        item.cost_price = blend_cost(item.cost_price, item.quantity, consumption.cost_price, delta)
+    for item, _ in shrunk:
+        costed = [allocation for allocation in remaining.get(item.pk, []) if allocation.batch.cost_price is not None]
+        if costed:
+            quantity = sum(allocation.quantity for allocation in costed)
+            item.cost_price = quantize_cost(sum(a.quantity * a.batch.cost_price for a in costed) / quantity)
+
+    updated_movements = []
+    for item, movement, quantity in changed:
+        item.quantity = quantity
+        if movement:
+            movement.quantity, movement.cost_price = item.quantity, item.cost_price
+            updated_movements.append(movement)
+    SaleItem.objects.bulk_update([item for item, _, _ in changed], ['quantity', 'price_at_sale', 'cost_price'])
+    InventoryMovement.objects.bulk_update(updated_movements, ['quantity', 'cost_price'])
+    FifoAllocation.objects.bulk_create(new_allocations)
+
+    items, movements, line_allocations, added_taken = add_lines(invoice, products, layers, added, reference)
+    Product.adjust_stock({pk: change for pk, change in stock_change.items() if change})
+    save_lines(items, movements, line_allocations)
+    FifoLayer.save_allocations(taken + added_taken)
+
+def return_invoice_stock(invoice):
+    """
+    Put every line of an invoice back into stock: current_stock in one F() update
+    and the consumed quantities back onto their layers
+    """
+    returned = defaultdict(Decimal)
+    for product_id, quantity in invoice.items.values_list('product_id', 'quantity'):
+        returned[product_id] += quantity
+    Product.adjust_stock(returned)
+
+    FifoAllocation.release(FifoAllocation.objects.filter(sale_item__invoice=invoice))
@@ -0,0 +1,104 @@
+from datetime import date
+from decimal import Decimal
+from django.db.models import F, Sum
+from .models import StockConsumption
+
+CENT = Decimal('0.01')
+
+def quantize_cost(cost_price):
+    if cost_price is None:
+        return None
+    return Decimal(cost_price).quantize(CENT)
+
+class FifoCosting:
+    """
+    Consume the oldest open layers first
+    """
+    code = 'FIFO'
+    uses_layers = True
+    layer_ordering = ('date', 'id')
+
+    def sort_key(self, layer):
+        return (layer.date, layer.movement_id)
+
+    def receive(self, product, movement):
+        return product.add_fifo_layer(movement)
+
+    def consume(self, product, quantity):
+        return product.consume_fifo(quantity, ordering=self.layer_ordering)
+
+class FefoCosting(FifoCosting):
+    """
+    Consume the open layers that expire first; layers without an expiry date go last
+    """
+    code = 'FEFO'
+    layer_ordering = (F('expiry_date').asc(nulls_last=True), 'date', 'id')
+
+    def sort_key(self, layer):
+        return (layer.expiry_date is None, layer.expiry_date or date.max, layer.date, layer.movement_id)
+
+class MovingAverageCosting:
+    """
+    Keep a running weighted average cost on the product; no layers are kept or
+    scanned, so a sale costs the same whatever the stock history looks like
+    """
+    code = 'AVG'
+    uses_layers = False
+
+    def receive(self, product, movement):
+        """
+        Fold a stock-in into the running average. Call before current_stock is increased
+        """
+        if movement.cost_price is None:
+            return
+        # Read the stock and average under a row lock so concurrent stock-ins fold in one after another
+        product.current_stock, product.average_cost = type(product).objects.select_for_update().filter(
+            pk=product.pk
+        ).values_list('current_stock', 'average_cost').get()
+        stock = max(product.current_stock, 0)
+        average = product.average_cost if product.average_cost is not None else movement.cost_price
+        product.average_cost = quantize_cost(
+            (stock * average + movement.quantity * movement.cost_price) / (stock + movement.quantity)
+        )
+        product.save(update_fields=['average_cost'])
+
+    def consume(self, product, quantity):
+        cost_price = product.average_cost if product.average_cost is not None else product.cost_price
+        return StockConsumption(cost_price, [], 0)
+
+COSTING_STRATEGIES = {
+    strategy.code: strategy for strategy in (FifoCosting(), FefoCosting(), MovingAverageCosting())
+}
+
+def get_strategy(product):
+    return COSTING_STRATEGIES.get(product.costing_method, COSTING_STRATEGIES['FIFO'])
+
+def receive_stock(product, movement):
+    """
+    Record a stock-in movement with the product's costing strategy
+    """
+    return get_strategy(product).receive(product, movement)
+
+def consume_stock(product, quantity):
+    """
+    Take quantity out of stock with the product's costing strategy
+    Returns a StockConsumption(cost_price, allocations, shortfall)
+    """
+    return get_strategy(product).consume(product, quantity)
+
+def carry_over_stock(product, previous_method):
+    """
+    Hand the stock a product holds over to its new costing method after a change from previous_method
+    Leaving FIFO/FEFO for the moving average starts the average at the cost of the open
+    layers, which are then dropped. Moving onto layers is only allowed with no stock on
+    hand (see ProductForm), so there is nothing to carry over that way
+    """
+    if not COSTING_STRATEGIES[previous_method].uses_layers or get_strategy(product).uses_layers:
+        return
+    layers = product.fifo_layers.filter(cost_price__isnull=False).aggregate(
+        quantity=Sum('remaining_quantity'), value=Sum(F('remaining_quantity') * F('cost_price'))
+    )
+    if layers['quantity']:
+        product.average_cost = quantize_cost(layers['value'] / layers['quantity'])
+        product.save(update_fields=['average_cost'])
+    product.fifo_layers.all().delete()
@@ -0,0 +1,84 @@
+import logging
+import random
+import threading
+import time
+from functools import wraps
+from django.contrib import messages
+from django.db import OperationalError, transaction
+
+logger = logging.getLogger(__name__)
+
+_stats_lock = threading.Lock()
+_stats = {'transactions': 0, 'retries': 0, 'failures': 0, 'lock_wait': 0.0}
+
+def _record(**counts):
+    with _stats_lock:
+        for key, value in counts.items():
+            _stats[key] += value
+
+def lock_stats():
+    """
+    Counters of this process since start (or the last reset): committed write
+    transactions, lock retries, transactions that gave up and seconds spent waiting for the lock
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+def reset_lock_stats():
+    with _stats_lock:
+        _stats.update(transactions=0, retries=0, failures=0, lock_wait=0.0)
+
+def is_lock_error(exc):
+    return isinstance(exc, OperationalError) and 'locked' in str(exc)
+
+def write_transaction(func=None, *, using=None, attempts=5, base_delay=0.05, max_delay=1.0):
+    """
+    Run func in a write transaction, retrying it when SQLite reports the database as locked
+    The transaction begins with BEGIN IMMEDIATE (see DATABASES OPTIONS), so the write lock
+    is taken up front and a busy database fails before any work is done. Each retry
+    re-runs func from the start after a jittered exponential backoff. Inside an existing
+    atomic block only the outermost transaction can be retried, so func simply joins it
+    Usable as @write_transaction or @write_transaction(attempts=...)
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if transaction.get_connection(using).in_atomic_block:
+                with transaction.atomic(using=using):
+                    return func(*args, **kwargs)
+
+            for attempt in range(1, attempts + 1):
+                started = time.monotonic()
+                waited = 0.0
+                try:
+                    with transaction.atomic(using=using):
+                        # Entering the block issued BEGIN IMMEDIATE, which waits for the lock
+                        waited = time.monotonic() - started
+                        result = func(*args, **kwargs)
+                    _record(transactions=1, lock_wait=waited)
+                    return result
+                except OperationalError as e:
+                    if not is_lock_error(e):
+                        raise
+                    # A lock error after BEGIN comes from COMMIT waiting on readers
+                    waited = time.monotonic() - started
+                    if attempt == attempts:
+                        _record(failures=1, lock_wait=waited)
+                        logger.error("%s gave up after %d locked attempts", func.__qualname__, attempts)
+                        raise
+                    delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+                    _record(retries=1, lock_wait=waited + delay)
+                    logger.warning("%s: database is locked, retry %d in %.3fs", func.__qualname__, attempt, delay)
+                    time.sleep(delay)
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+def message_on_commit(request, level, message):
+    """
+    Add a flash message once the surrounding write transaction commits, so an attempt
+    that is rolled back and retried does not leave its message behind
+    """
+    transaction.on_commit(lambda: messages.add_message(request, level, message))
@@ -0,0 +1,338 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Q
+from .cache import bump_versions
+from .costing import get_strategy, quantize_cost
+from .models import Product, InventoryMovement, FifoLayer, FifoAllocation, Invoice, Sale, SaleItem, StockConsumption, allocate_batches
+from .periods import open_since
+from .rollups import business_date, sale_key, refresh_sale_rollups, rebuild_rollups
+
+# Invoice edits used to put every line back as a stock-in like this and keep the invoice's old
+# OUT movements; the two cancel out, so a rebuild that replays the current lines skips them
+LEGACY_REVERSAL = Q(movement_type='IN', invoice__isnull=True, reference__regex=r'^Invoice #\d+ edited \(revert\)$')
+
+def replay(layers, events, fallback_cost=None):
+    """
+    Consume events in the order given from layers already in consumption order, in memory only
+    events are (owner, quantity) pairs; returns a list of (owner, StockConsumption)
+    """
+    results = []
+    start = 0
+    for owner, quantity in events:
+        # Layers only shrink while replaying, so emptied ones form a prefix that is never rescanned
+        while start < len(layers) and layers[start].remaining_quantity <= 0:
+            start += 1
+        open_layers = (layers[i] for i in range(start, len(layers)) if layers[i].remaining_quantity > 0)
+        results.append((owner, allocate_batches(open_layers, quantity, fallback_cost=fallback_cost)))
+    return results
+
+def window_events(product, since=None):
+    """
+    Sales, invoice lines and manual stock-outs of product dated on or after since
+    (its whole history when since is None), in chronological order as (owner, quantity) pairs
+    """
+    sales = product.sales.all()
+    items = SaleItem.objects.filter(product=product).select_related('invoice')
+    stock_outs = product.movements.filter(movement_type='OUT', sale__isnull=True, invoice__isnull=True)
+    if since is not None:
+        sales = sales.filter(date__gte=since)
+        items = items.filter(invoice__date__gte=since)
+        stock_outs = stock_outs.filter(date__gte=since)
+
+    events = [(sale.date, 0, sale.id, sale, sale.quantity) for sale in sales]
+    events += [(item.invoice.date, 1, item.id, item, item.quantity) for item in items]
+    events += [(movement.date, 2, movement.id, movement, movement.quantity) for movement in stock_outs]
+    events.sort(key=lambda event: event[:3])
+    return [(owner, quantity) for _, _, _, owner, quantity in events]
+
+def owner_kwargs(owner):
+    if isinstance(owner, Sale):
+        return {'sale': owner}
+    if isinstance(owner, SaleItem):
+        return {'sale_item': owner}
+    return {'stock_out': owner}
+
+def allocation_owner(owner):
+    # (sale_id, sale_item_id, stock_out_id) of the allocations a consumption owns
+    if isinstance(owner, Sale):
+        return (owner.id, None, None)
+    if isinstance(owner, SaleItem):
+        return (None, owner.id, None)
+    return (None, None, owner.id)
+
+def recost_product(product, since):
+    """
+    Re-run FIFO for one product from since forward, e.g. after a backdated stock-in
+    Only the consumptions dated on or after since are replayed: their allocations
+    are handed back in memory, the open layers plus those batches are consumed again
+    in date order, and changed cost prices, layers and allocations are written in bulk
+    A window with consumptions that are not fully allocated is rebuilt from the full history instead
+    Moving-average products keep no layers and are left as they are
+    Returns the number of consumptions whose cost price changed
+    """
+    strategy = get_strategy(product)
+    if not strategy.uses_layers:
+        return 0
+
+    events = window_events(product, since)
+    if not events:
+        return 0
+
+    allocations = FifoAllocation.objects.filter(
+        Q(sale__product=product, sale__date__gte=since) |
+        Q(sale_item__product=product, sale_item__invoice__date__gte=since) |
+        Q(stock_out__product=product, stock_out__date__gte=since)
+    ).select_related('batch')
+
+    # A consumption that took more than its allocations record (e.g. one from before they were
+    # recorded, or one short of stock) cannot be handed back exactly, so replay the whole history
+    rows = list(allocations)
+    allocated = defaultdict(int)
+    for allocation in rows:
+        allocated[(allocation.sale_id, allocation.sale_item_id, allocation.stock_out_id)] += allocation.quantity
+    if any(allocated[allocation_owner(owner)] != quantity for owner, quantity in events):
+        results = [rebuild_product(product.id)]
+        apply_rebuild(results)
+        return len(results[0]['sale_costs']) + len(results[0]['item_costs'])
+
+    # Rebuild the layer state as it was just before the window
+    layers = {layer.movement_id: layer for layer in product.fifo_layers.all()}
+    open_remaining = {layer.pk: layer.remaining_quantity for layer in layers.values()}
+    for allocation in rows:
+        layer = layers.get(allocation.batch_id)
+        if layer is None:
+            batch = allocation.batch
+            layer = layers[batch.id] = FifoLayer(
+                product=product,
+                movement=batch,
+                date=batch.date,
+                expiry_date=batch.expiry_date,
+                cost_price=batch.cost_price,
+                remaining_quantity=0
+            )
+        layer.remaining_quantity += allocation.quantity
+
+    ordered_layers = sorted(layers.values(), key=strategy.sort_key)
+    results = replay(ordered_layers, events, fallback_cost=product.cost_price)
+
+    changed = {Sale: [], SaleItem: [], InventoryMovement: []}
+    new_allocations = []
+    for owner, consumption in results:
+        cost_price = quantize_cost(consumption.cost_price)
+        # Manual stock-outs keep the cost price they were entered with
+        if not isinstance(owner, InventoryMovement) and owner.cost_price != cost_price:
+            owner.cost_price = cost_price
+            changed[type(owner)].append(owner)
+        new_allocations += [
+            FifoAllocation(batch_id=layer.movement_id, quantity=quantity, **owner_kwargs(owner))
+            for layer, quantity in consumption.allocations
+        ]
+
+    # Keep the OUT movements of re-costed sales and invoice lines in step
+    if changed[Sale] or changed[SaleItem]:
+        sale_costs = {sale.id: sale.cost_price for sale in changed[Sale]}
+        item_costs = {(item.invoice_id, item.product_id): item.cost_price for item in changed[SaleItem]}
+        out_movements = product.movements.filter(movement_type='OUT', date__gte=since).filter(
+            Q(sale_id__in=list(sale_costs)) | Q(invoice_id__in=[key[0] for key in item_costs])
+        )
+        for movement in out_movements:
+            if movement.sale_id in sale_costs:
+                movement.cost_price = sale_costs[movement.sale_id]
+            else:
+                movement.cost_price = item_costs[(movement.invoice_id, movement.product_id)]
+            changed[InventoryMovement].append(movement)
+
+    for model, objects in changed.items():
+        model.objects.bulk_update(objects, ['cost_price'], batch_size=500)
+    recosted = len(changed[Sale]) + len(changed[SaleItem])
+    if recosted:
+        bump_versions(Sale, SaleItem, InventoryMovement)
+    Invoice.refresh_totals({item.invoice_id for item in changed[SaleItem]})
+    refresh_sale_rollups(
+        {sale_key(sale) for sale in changed[Sale]} |
+        {(business_date(item.invoice.date), item.product_id) for item in changed[SaleItem]}
+    )
+
+    allocations.delete()
+    FifoAllocation.objects.bulk_create(new_allocations, batch_size=500)
+
+    emptied = [layer.pk for layer in layers.values() if layer.pk and layer.remaining_quantity <= 0]
+    FifoLayer.objects.filter(pk__in=emptied).delete()
+    FifoLayer.objects.bulk_update(
+        [
+            layer for layer in layers.values()
+            if layer.pk and layer.remaining_quantity > 0
+            and layer.remaining_quantity != open_remaining[layer.pk]
+        ],
+        ['remaining_quantity'],
+        batch_size=500
+    )
+    FifoLayer.objects.bulk_create(
+        [layer for layer in layers.values() if not layer.pk and layer.remaining_quantity > 0],
+        batch_size=500
+    )
+
+    return recosted
+
+def rebuild_product(product_id):
+    """
+    Recompute the FIFO state of one product from its full history, without writing
+    Every stock-in is a layer (bar legacy invoice-edit reversals), and all sales, invoice lines
+    and manual stock-outs are replayed in chronological order. Returns plain data (so it can
+    come back from a worker process): the changed cost prices plus the full set of layers and
+    allocations, and how far the rebuilt layers are off current_stock (None without layers)
+    Moving-average products get their running average replayed instead of layers
+    """
+    product = Product.objects.get(pk=product_id)
+    strategy = get_strategy(product)
+    batches = product.movements.filter(movement_type='IN').exclude(LEGACY_REVERSAL).order_by('date', 'id')
+    events = window_events(product)
+    average_cost = None
+
+    if strategy.uses_layers:
+        layers = sorted(
+            (
+                FifoLayer(
+                    product_id=product_id,
+                    movement_id=batch.id,
+                    date=batch.date,
+                    expiry_date=batch.expiry_date,
+                    cost_price=batch.cost_price,
+                    remaining_quantity=batch.quantity
+                )
+                for batch in batches.iterator()
+            ),
+            key=strategy.sort_key
+        )
+        results = replay(layers, events, fallback_cost=product.cost_price)
+    else:
+        layers = []
+        results, average_cost = replay_average(product, batches, events)
+
+    # Consumptions in closed months are replayed to seed the layers, but keep their frozen cost
+    since = open_since()
+    sale_costs, item_costs, allocations = {}, {}, []
+    for owner, consumption in results:
+        cost_price = quantize_cost(consumption.cost_price)
+        if isinstance(owner, Sale):
+            if owner.cost_price != cost_price and (since is None or owner.date >= since):
+                sale_costs[owner.id] = cost_price
+            owner_field = 'sale_id'
+        elif isinstance(owner, SaleItem):
+            if owner.cost_price != cost_price and (since is None or owner.invoice.date >= since):
+                item_costs[(owner.invoice_id, owner.id)] = cost_price
+            owner_field = 'sale_item_id'
+        else:
+            owner_field = 'stock_out_id'
+        allocations += [(layer.movement_id, owner_field, owner.id, quantity) for layer, quantity in consumption.allocations]
+
+    # OUT movements of sales and invoice lines carry the same cost price
+    invoice_costs = {invoice_id: cost for (invoice_id, _), cost in item_costs.items()}
+    movement_costs = {}
+    if sale_costs or invoice_costs:
+        out_movements = product.movements.filter(movement_type='OUT').filter(
+            Q(sale_id__in=list(sale_costs)) | Q(invoice_id__in=list(invoice_costs))
+        ).only('id', 'sale_id', 'invoice_id')
+        for movement in out_movements:
+            movement_costs[movement.id] = sale_costs.get(movement.sale_id, invoice_costs.get(movement.invoice_id))
+
+    current_layers = dict(product.fifo_layers.values_list('movement_id', 'remaining_quantity'))
+    new_layers = [
+        (layer.movement_id, layer.date, layer.expiry_date, layer.cost_price, layer.remaining_quantity)
+        for layer in layers if layer.remaining_quantity > 0
+    ]
+    layers_changed = current_layers != {layer[0]: layer[-1] for layer in new_layers}
+    stock_difference = None
+    if strategy.uses_layers:
+        stock_difference = sum(layer[-1] for layer in new_layers) - product.current_stock
+
+    return {
+        'product_id': product_id,
+        'product_name': product.name,
+        'average_cost': average_cost,
+        'sale_costs': sale_costs,
+        'item_costs': {item_id: cost for (_, item_id), cost in item_costs.items()},
+        'movement_costs': movement_costs,
+        'layers': new_layers,
+        'layers_changed': layers_changed,
+        'stock_difference': stock_difference,
+        'allocations': allocations,
+    }
+
+def replay_average(product, batches, events):
+    """
+    Replay stock-ins and consumptions of a moving-average product in date order
+    Returns the (owner, StockConsumption) results and the final average cost
+    """
+    def event_date(owner):
+        return owner.invoice.date if isinstance(owner, SaleItem) else owner.date
+
+    stream = [(batch.date, 0, batch, batch.quantity) for batch in batches]
+    stream += [(event_date(owner), 1, owner, quantity) for owner, quantity in events]
+    stream.sort(key=lambda entry: entry[:2])
+
+    stock, average, results = 0, None, []
+    for _, is_consumption, owner, quantity in stream:
+        if is_consumption:
+            cost_price = average if average is not None else product.cost_price
+            results.append((owner, StockConsumption(cost_price, [], 0)))
+            stock -= quantity
+        elif owner.cost_price is not None:
+            held = max(stock, 0)
+            current = average if average is not None else owner.cost_price
+            average = quantize_cost((held * current + quantity * owner.cost_price) / (held + quantity))
+            stock += quantity
+        else:
+            stock += quantity
+    return results, average
+
+def rebuild_products(product_ids):
+    return [rebuild_product(product_id) for product_id in product_ids]
+
+def apply_rebuild(results, batch_size=1000):
+    """
+    Write rebuilt FIFO state for a group of products with chunked bulk statements
+    The products' daily rollups and invoice totals are recomputed with their new costs,
+    except in closed months
+    """
+    product_ids = [result['product_id'] for result in results]
+    with transaction.atomic():
+        Product.objects.bulk_update(
+            [Product(id=result['product_id'], average_cost=result['average_cost'])
+             for result in results if result['average_cost'] is not None],
+            ['average_cost'],
+            batch_size=batch_size
+        )
+        for model, key in ((Sale, 'sale_costs'), (SaleItem, 'item_costs'), (InventoryMovement, 'movement_costs')):
+            model.objects.bulk_update(
+                [model(id=pk, cost_price=cost) for result in results for pk, cost in result[key].items()],
+                ['cost_price'],
+                batch_size=batch_size
+            )
+
+        FifoAllocation.objects.filter(batch__product_id__in=product_ids).delete()
+        FifoLayer.objects.filter(product_id__in=product_ids).delete()
+        FifoLayer.objects.bulk_create(
+            (
+                FifoLayer(product_id=result['product_id'], movement_id=movement_id, date=date,
+                          expiry_date=expiry_date, cost_price=cost_price, remaining_quantity=remaining)
+                for result in results
+                for movement_id, date, expiry_date, cost_price, remaining in result['layers']
+            ),
+            batch_size=batch_size
+        )
+        FifoAllocation.objects.bulk_create(
+            (
+                FifoAllocation(batch_id=batch_id, quantity=quantity, **{owner_field: owner_id})
+                for result in results
+                for batch_id, owner_field, owner_id, quantity in result['allocations']
+            ),
+            batch_size=batch_size
+        )
+        rebuild_rollups(product_ids, journal=False, batch_size=batch_size)
+        invoices = Invoice.objects.filter(items__product_id__in=product_ids)
+        since = open_since()
+        if since is not None:
+            invoices = invoices.filter(date__gte=since)
+        Invoice.refresh_totals(invoices.values('pk'))
+        bump_versions(Product, Sale, SaleItem, InventoryMovement)
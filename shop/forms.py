@@ -1,5 +1,42 @@
 from django import forms
-from .models import Product, InventoryMovement, Sale, MoneyJournal, Client, DebtPayment
+from .models import Product, InventoryMovement, Sale, MoneyJournal, Client, DebtPayment, PeriodClosed
+from .periods import closed_through, check_open
+from .costing import COSTING_STRATEGIES, get_strategy
+
+class OpenPeriodMixin:
+    """
+    Refuse a date in a closed month, and any edit of a record dated in one
+    """
+    def clean_date(self):
+        value = self.cleaned_data.get('date')
+        boundary = closed_through()
+        try:
+            check_open(value, boundary)
+            if self.instance.pk:
+                check_open(self.instance.date, boundary)
+        except PeriodClosed as e:
+            raise forms.ValidationError(str(e))
+        return value
+
+class ProductForm(forms.ModelForm):
+    """
+    Refuse moving a product onto FIFO/FEFO while it holds stock: the moving average keeps no
+    batches to build its layers from. The other way round is carried over by carry_over_stock
+    """
+    class Meta:
+        model = Product
+        fields = ['name', 'current_stock', 'unit_price', 'cost_price', 'costing_method']
+
+    def clean_costing_method(self):
+        method = self.cleaned_data.get('costing_method')
+        product = self.instance
+        if (product.pk and method != product.costing_method and product.current_stock
+                and not get_strategy(product).uses_layers and COSTING_STRATEGIES[method].uses_layers):
+            raise forms.ValidationError(
+                f"{product.name} still holds {product.current_stock} in stock at its average cost. "
+                "Sell or adjust it out before switching to a batch-based costing method."
+            )
+        return method
 
 class ClientForm(forms.ModelForm):
     class Meta:
@@ -11,7 +48,7 @@ class ClientForm(forms.ModelForm):
             'address': forms.Textarea(attrs={'class': 'form-control', 'placeholder': 'Address', 'rows': 2}),
         }
 
-class SaleForm(forms.ModelForm):
+class SaleForm(OpenPeriodMixin, forms.ModelForm):
     class Meta:
         model = Sale
         fields = ['product', 'client', 'quantity', 'price_at_sale', 'date', 'is_credit', 'amount_paid']
@@ -34,15 +71,19 @@ class SaleForm(forms.ModelForm):
         client = cleaned_data.get('client')
 
         if product and quantity:
-            if product.current_stock < quantity:
-                raise forms.ValidationError(f"Insufficient stock! Only {product.current_stock} units available.")
+            # An edited sale can reuse the stock it already holds; the view re-checks atomically
+            available = product.current_stock
+            if self.instance.pk and self.instance.product_id == product.pk:
+                available += self.instance.quantity
+            if available < quantity:
+                raise forms.ValidationError(f"Insufficient stock! Only {available} units available.")
         
         if is_credit and not client:
             raise forms.ValidationError("A client must be selected for credit sales.")
             
         return cleaned_data
 
-class DebtPaymentForm(forms.ModelForm):
+class DebtPaymentForm(OpenPeriodMixin, forms.ModelForm):
     class Meta:
         model = DebtPayment
         fields = ['client', 'amount', 'date', 'notes']
@@ -59,10 +100,10 @@ class DebtPaymentForm(forms.ModelForm):
             raise forms.ValidationError("Payment amount must be a positive number greater than zero.")
         return amount
 
-class MovementForm(forms.ModelForm):
+class MovementForm(OpenPeriodMixin, forms.ModelForm):
     class Meta:
         model = InventoryMovement
-        fields = ['product', 'movement_type', 'quantity', 'date', 'cost_price', 'reference']
+        fields = ['product', 'movement_type', 'quantity', 'date', 'cost_price', 'expiry_date', 'reference']
         widgets = {
             'product': forms.Select(attrs={'class': 'form-select'}),
             'movement_type': forms.Select(attrs={'class': 'form-select'}),
@@ -70,9 +111,10 @@ class MovementForm(forms.ModelForm):
             'date': forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
             'cost_price': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01', 'placeholder': 'Cost price per unit'}),
             'reference': forms.TextInput(attrs={'class': 'form-control'}),
+            'expiry_date': forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
         }
 
-class MoneyJournalForm(forms.ModelForm):
+class MoneyJournalForm(OpenPeriodMixin, forms.ModelForm):
     class Meta:
         model = MoneyJournal
         fields = ['entry_type', 'amount', 'date', 'category', 'description']
@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from shop.models import Invoice
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored total price, total cost and balance due of every invoice from its items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Invoices per UPDATE')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        batch_size = options['batch_size']
+        ids = list(Invoice.objects.order_by('pk').values_list('pk', flat=True))
+
+        # One short transaction per batch, so writers are never blocked for the whole run
+        for i in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                Invoice.refresh_totals(ids[i:i + batch_size])
+
+        self.stdout.write(f"Recomputed {len(ids)} invoice(s) in {time.perf_counter() - started:.2f}s")
+        self.stdout.write(self.style.SUCCESS('Invoice totals backfilled.'))
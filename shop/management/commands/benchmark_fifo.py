@@ -0,0 +1,50 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from shop.benchmarks import run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Times FIFO cost lookup, deduction, reversal and rebuild on products with growing '
+        'numbers of layers and fails when an operation grows faster than expected. '
+        'All benchmark data is rolled back, but the run holds the write lock: use a copy of the database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000], help='Open layers per benchmark product')
+        parser.add_argument('--history-factor', type=int, default=1, help='Consumed batches and sales per open layer')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed repeats per operation (the median is reported)')
+        parser.add_argument('--tolerance', type=float, default=0.3, help='Allowed growth exponent above the expected one')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--json', action='store_true', help='Print the JSON report instead of the summary')
+
+    def handle(self, *args, **options):
+        report = run_benchmark(
+            sizes=options['sizes'],
+            history_factor=options['history_factor'],
+            repeat=max(options['repeat'], 1),
+            tolerance=options['tolerance']
+        )
+
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(f"Sizes: {', '.join(str(size) for size in report['sizes'])} layers, "
+                              f"up to {max(report['movements'].values())} movements")
+            for name, result in report['operations'].items():
+                timings = ', '.join(f"{size}: {seconds * 1000:.2f}ms" for size, seconds in result['seconds'].items())
+                status = 'ok' if result['ok'] else 'TOO SLOW'
+                self.stdout.write(
+                    f"{name}: {timings} - grows as n^{result['exponent']} "
+                    f"(expected n^{result['expected_exponent']}) {status}"
+                )
+
+        if not report['ok']:
+            slow = [name for name, result in report['operations'].items() if not result['ok']]
+            raise CommandError(f"FIFO complexity regression in: {', '.join(slow)}")
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('FIFO benchmark passed.'))
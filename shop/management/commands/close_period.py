@@ -0,0 +1,25 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from shop.models import PeriodClosed
+from shop.periods import close_period
+
+
+class Command(BaseCommand):
+    help = 'Closes a month: freezes its sales, expenses, receivables and stock valuation and refuses backdated writes into it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('month', help='Month to close, as YYYY-MM')
+
+    def handle(self, *args, **options):
+        try:
+            month = datetime.strptime(options['month'], '%Y-%m').date()
+        except ValueError:
+            raise CommandError(f"Invalid month '{options['month']}', expected YYYY-MM")
+
+        try:
+            period = close_period(month)
+        except PeriodClosed as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f"Stored {period.snapshots.count()} snapshot row(s)")
+        self.stdout.write(self.style.SUCCESS(f'{period} closed.'))
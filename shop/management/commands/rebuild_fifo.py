@@ -0,0 +1,99 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connections
+from shop.models import Product
+from shop.fifo import rebuild_products, apply_rebuild
+
+
+def init_worker():
+    # Each worker opens its own database connection
+    import django
+    django.setup()
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds FIFO layers, allocations and sale cost prices from the full movement history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes (1 runs inline)')
+        parser.add_argument('--chunk-size', type=int, default=50, help='Products handed to a worker at a time')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per bulk statement')
+        parser.add_argument('--product', type=int, action='append', dest='product_ids', help='Only rebuild this product id (repeatable)')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        dry_run = options['dry_run']
+
+        product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+        if options['product_ids']:
+            product_ids = [pk for pk in product_ids if pk in set(options['product_ids'])]
+        chunk_size = max(options['chunk_size'], 1)
+        chunks = [product_ids[i:i + chunk_size] for i in range(0, len(product_ids), chunk_size)]
+
+        totals = {'products_changed': 0, 'sale_costs': 0, 'item_costs': 0, 'layers': 0, 'allocations': 0, 'mismatched': 0}
+        compute_seconds = 0
+        write_seconds = 0
+
+        def process(results):
+            nonlocal write_seconds
+            for result in results:
+                changed = result['sale_costs'] or result['item_costs'] or result['layers_changed']
+                if changed:
+                    totals['products_changed'] += 1
+                    if dry_run:
+                        self.stdout.write(
+                            f"{result['product_name']}: {len(result['sale_costs'])} sale cost(s), "
+                            f"{len(result['item_costs'])} invoice line cost(s) changed"
+                            f"{', layers differ' if result['layers_changed'] else ''}"
+                        )
+                # History that does not add up to the stock on hand needs a look whether or not anything is written
+                if result['stock_difference']:
+                    totals['mismatched'] += 1
+                    self.stdout.write(self.style.WARNING(
+                        f"{result['product_name']}: rebuilt layers are {result['stock_difference']:+} "
+                        f"off current stock"
+                    ))
+                totals['sale_costs'] += len(result['sale_costs'])
+                totals['item_costs'] += len(result['item_costs'])
+                totals['layers'] += len(result['layers'])
+                totals['allocations'] += len(result['allocations'])
+            if not dry_run:
+                write_started = time.perf_counter()
+                apply_rebuild(results, batch_size=options['batch_size'])
+                write_seconds += time.perf_counter() - write_started
+
+        if options['workers'] <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                compute_started = time.perf_counter()
+                results = rebuild_products(chunk)
+                compute_seconds += time.perf_counter() - compute_started
+                process(results)
+        else:
+            # Workers only read; all writes happen here so SQLite sees a single writer
+            connections.close_all()
+            compute_started = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=init_worker) as pool:
+                for results in pool.map(rebuild_products, chunks):
+                    process(results)
+            compute_seconds = time.perf_counter() - compute_started - write_seconds
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{'Would change' if dry_run else 'Changed'} {totals['products_changed']} of {len(product_ids)} products: "
+            f"{totals['sale_costs']} sale cost(s), {totals['item_costs']} invoice line cost(s); "
+            f"{totals['layers']} open layer(s), {totals['allocations']} allocation(s)"
+        )
+        if totals['mismatched']:
+            self.stdout.write(self.style.WARNING(
+                f"{totals['mismatched']} product(s) have layers that do not match current stock; "
+                "check their stock history"
+            ))
+        self.stdout.write(
+            f"Timing: compute {compute_seconds:.2f}s, write {write_seconds:.2f}s, total {elapsed:.2f}s "
+            f"({len(product_ids) / elapsed if elapsed else 0:.1f} products/s, {options['workers']} worker(s))"
+        )
+        self.stdout.write(self.style.SUCCESS('Dry run complete, nothing written.' if dry_run else 'FIFO rebuild complete.'))
@@ -0,0 +1,33 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from shop.models import Client
+
+CENT = Decimal('0.01')
+
+
+class Command(BaseCommand):
+    help = 'Checks every stored client balance against their sales, invoices and payments and fixes the ones that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drifted balances without fixing them')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        with transaction.atomic():
+            rows = Client.objects.annotate(expected=Client.balance_expression()).values_list(
+                'pk', 'name', 'balance', 'expected'
+            )
+            drifted = []
+            for pk, name, balance, expected in rows:
+                expected = Decimal(expected).quantize(CENT)
+                if balance != expected:
+                    drifted.append(pk)
+                    self.stdout.write(f"{name}: stored {balance}, expected {expected}")
+
+            if drifted and not dry_run:
+                Client.refresh_balances(drifted)
+
+        self.stdout.write(f"{len(drifted)} of {len(rows)} client balance(s) {'drifted' if dry_run else 'fixed'}")
+        self.stdout.write(self.style.SUCCESS('Dry run complete, nothing written.' if dry_run else 'Client balances reconciled.'))
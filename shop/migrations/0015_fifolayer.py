@@ -0,0 +1,74 @@
+# Generated by Django 6.0.4 on 2026-10-17 07:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def open_layers_from_movements(apps, schema_editor):
+    """
+    Create one FIFO layer per stock-in movement that still has stock remaining
+    """
+    InventoryMovement = apps.get_model('shop', 'InventoryMovement')
+    FifoLayer = apps.get_model('shop', 'FifoLayer')
+
+    open_batches = InventoryMovement.objects.filter(
+        movement_type='IN',
+        remaining_quantity__gt=0
+    ).iterator()
+
+    FifoLayer.objects.bulk_create(
+        (
+            FifoLayer(
+                product_id=movement.product_id,
+                movement_id=movement.id,
+                date=movement.date,
+                cost_price=movement.cost_price,
+                remaining_quantity=movement.remaining_quantity
+            )
+            for movement in open_batches
+        ),
+        batch_size=500
+    )
+
+
+def restore_remaining_quantities(apps, schema_editor):
+    """
+    Reverse function: copy layer remainders back onto their stock-in movements
+    """
+    InventoryMovement = apps.get_model('shop', 'InventoryMovement')
+    FifoLayer = apps.get_model('shop', 'FifoLayer')
+
+    for layer in FifoLayer.objects.all().iterator():
+        InventoryMovement.objects.filter(pk=layer.movement_id).update(
+            remaining_quantity=layer.remaining_quantity
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_invoice_due_date_product_barcode_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FifoLayer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('cost_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('remaining_quantity', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('movement', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='fifo_layer', to='shop.inventorymovement')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fifo_layers', to='shop.product')),
+            ],
+            options={
+                'ordering': ['date', 'id'],
+                'indexes': [models.Index(fields=['product', 'date'], name='shop_fifola_product_3a220e_idx')],
+            },
+        ),
+        migrations.RunPython(open_layers_from_movements, restore_remaining_quantities),
+        migrations.RemoveField(
+            model_name='inventorymovement',
+            name='remaining_quantity',
+        ),
+    ]
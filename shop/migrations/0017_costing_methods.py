@@ -0,0 +1,37 @@
+# Generated by Django 6.0.4 on 2026-10-17 08:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0016_fifoallocation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fifolayer',
+            name='expiry_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='inventorymovement',
+            name='expiry_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='average_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='costing_method',
+            field=models.CharField(choices=[('FIFO', 'FIFO (First In, First Out)'), ('AVG', 'Moving Weighted Average'), ('FEFO', 'FEFO (First Expired, First Out)')], default='FIFO', max_length=4),
+        ),
+        migrations.AddIndex(
+            model_name='fifolayer',
+            index=models.Index(fields=['product', 'expiry_date'], name='shop_fifola_product_f8d7fc_idx'),
+        ),
+    ]
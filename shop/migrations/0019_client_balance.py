@@ -0,0 +1,50 @@
+# Generated by Django 6.0.4 on 2026-10-17 11:40
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def compute_balances(apps, schema_editor):
+    """
+    Store every client's outstanding balance from their credit sales, credit invoices and payments
+    """
+    Client = apps.get_model('shop', 'Client')
+    Sale = apps.get_model('shop', 'Sale')
+    SaleItem = apps.get_model('shop', 'SaleItem')
+    Invoice = apps.get_model('shop', 'Invoice')
+    DebtPayment = apps.get_model('shop', 'DebtPayment')
+
+    def totals(queryset, client_field, expression):
+        rows = queryset.values(client_field).annotate(total=Sum(expression)).order_by()
+        return {row[client_field]: row['total'] or 0 for row in rows}
+
+    sales = totals(Sale.objects.filter(is_credit=True, client__isnull=False), 'client',
+                   F('quantity') * F('price_at_sale') - F('amount_paid'))
+    items = totals(SaleItem.objects.filter(invoice__is_credit=True, invoice__client__isnull=False), 'invoice__client',
+                   F('quantity') * F('price_at_sale'))
+    paid = totals(Invoice.objects.filter(is_credit=True, client__isnull=False), 'client', F('amount_paid'))
+    payments = totals(DebtPayment.objects.all(), 'client', F('amount'))
+
+    clients = list(Client.objects.all())
+    for client in clients:
+        client.balance = Decimal(
+            sales.get(client.pk, 0) + items.get(client.pk, 0) - paid.get(client.pk, 0) - payments.get(client.pk, 0)
+        ).quantize(Decimal('0.01'))
+    Client.objects.bulk_update(clients, ['balance'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0018_dailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='balance',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.RunPython(compute_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 6.0.4 on 2026-10-17 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0019_client_balance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['client', 'due_date'], name='shop_invoic_client__aa7c86_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['client', 'date'], name='shop_sale_client__9da553_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 6.0.4 on 2026-10-17 13:40
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def compute_totals(apps, schema_editor):
+    """
+    Store every invoice's total price, total cost and balance due from its items
+    """
+    Invoice = apps.get_model('shop', 'Invoice')
+    SaleItem = apps.get_model('shop', 'SaleItem')
+
+    rows = SaleItem.objects.values('invoice').annotate(
+        price=Sum(F('quantity') * F('price_at_sale')),
+        cost=Sum(F('quantity') * F('cost_price'))
+    ).order_by()
+    totals = {row['invoice']: (row['price'] or 0, row['cost'] or 0) for row in rows}
+
+    invoices = list(Invoice.objects.all())
+    for invoice in invoices:
+        price, cost = totals.get(invoice.pk, (0, 0))
+        invoice.total_price = Decimal(price).quantize(Decimal('0.01'))
+        invoice.total_cost = Decimal(cost).quantize(Decimal('0.01'))
+        invoice.balance_due = invoice.total_price - invoice.amount_paid if invoice.is_credit else Decimal('0')
+    Invoice.objects.bulk_update(invoices, ['total_price', 'total_cost', 'balance_due'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0020_aging_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='balance_due',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='total_price',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.RunPython(compute_totals, migrations.RunPython.noop),
+    ]
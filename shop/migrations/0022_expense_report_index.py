@@ -0,0 +1,17 @@
+# Generated by Django 6.0.4 on 2026-10-17 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0021_invoice_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='moneyjournal',
+            index=models.Index(fields=['entry_type', 'date'], name='shop_moneyj_entry_t_4b4cfd_idx'),
+        ),
+    ]
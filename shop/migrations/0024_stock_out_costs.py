@@ -0,0 +1,36 @@
+# Generated by Django 6.0.4 on 2026-10-17 18:20
+
+from decimal import Decimal
+from django.db import migrations
+from django.db.models import F, Sum
+
+
+def populate_stock_out_costs(apps, schema_editor):
+    """
+    Store the cost manual stock-outs were consumed at, from the batches their allocations took
+    """
+    InventoryMovement = apps.get_model('shop', 'InventoryMovement')
+    FifoAllocation = apps.get_model('shop', 'FifoAllocation')
+
+    rows = FifoAllocation.objects.filter(
+        stock_out__cost_price__isnull=True, batch__cost_price__isnull=False
+    ).values('stock_out').annotate(
+        taken=Sum('quantity'), cost=Sum(F('quantity') * F('batch__cost_price'))
+    ).order_by()
+    costs = {row['stock_out']: row['cost'] / row['taken'] for row in rows if row['taken']}
+
+    movements = list(InventoryMovement.objects.filter(pk__in=costs))
+    for movement in movements:
+        movement.cost_price = Decimal(costs[movement.pk]).quantize(Decimal('0.01'))
+    InventoryMovement.objects.bulk_update(movements, ['cost_price'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0023_closed_periods'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_stock_out_costs, migrations.RunPython.noop),
+    ]
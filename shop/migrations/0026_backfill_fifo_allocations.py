@@ -0,0 +1,82 @@
+# Generated by Django 6.0.4 on 2026-10-17 19:30
+
+from collections import defaultdict
+from datetime import date
+from django.db import migrations
+from django.db.models import Sum
+
+
+def backfill_allocations(apps, schema_editor):
+    """
+    Record which stock-in batches the consumptions from before allocations existed took
+    What each batch has given out is its quantity less its open layer and the allocations
+    already recorded against it; that is handed to the product's sales, invoice lines and
+    manual stock-outs without allocations in date order, taking batches in the product's
+    consumption order. Layers and cost prices are left as they are, so deleting or editing
+    one of those consumptions puts back exactly what the layers are missing for it
+    """
+    Product = apps.get_model('shop', 'Product')
+    InventoryMovement = apps.get_model('shop', 'InventoryMovement')
+    FifoLayer = apps.get_model('shop', 'FifoLayer')
+    FifoAllocation = apps.get_model('shop', 'FifoAllocation')
+    Sale = apps.get_model('shop', 'Sale')
+    SaleItem = apps.get_model('shop', 'SaleItem')
+
+    remaining = dict(FifoLayer.objects.values_list('movement_id', 'remaining_quantity'))
+    recorded = dict(FifoAllocation.objects.values('batch').annotate(total=Sum('quantity')).values_list('batch', 'total'))
+
+    new_allocations = []
+    for product in Product.objects.exclude(costing_method='AVG').iterator():
+        batches = list(InventoryMovement.objects.filter(product=product, movement_type='IN'))
+        if product.costing_method == 'FEFO':
+            batches.sort(key=lambda batch: (batch.expiry_date is None, batch.expiry_date or date.max, batch.date, batch.id))
+        else:
+            batches.sort(key=lambda batch: (batch.date, batch.id))
+        given_out = {
+            batch.id: batch.quantity - remaining.get(batch.id, 0) - recorded.get(batch.id, 0) for batch in batches
+        }
+
+        events = [
+            (sale.date, 0, sale.id, 'sale_id', sale.quantity)
+            for sale in Sale.objects.filter(product=product, fifo_allocations__isnull=True)
+        ]
+        events += [
+            (item.invoice.date, 1, item.id, 'sale_item_id', item.quantity)
+            for item in SaleItem.objects.filter(product=product, fifo_allocations__isnull=True).select_related('invoice')
+        ]
+        events += [
+            (movement.date, 2, movement.id, 'stock_out_id', movement.quantity)
+            for movement in InventoryMovement.objects.filter(
+                product=product, movement_type='OUT', sale__isnull=True, invoice__isnull=True,
+                out_allocations__isnull=True
+            )
+        ]
+        events.sort(key=lambda event: event[:3])
+
+        for _, _, owner_id, owner_field, quantity in events:
+            taken = defaultdict(int)
+            for batch in batches:
+                if quantity <= 0:
+                    break
+                portion = min(quantity, given_out[batch.id])
+                if portion > 0:
+                    given_out[batch.id] -= portion
+                    taken[batch.id] += portion
+                    quantity -= portion
+            new_allocations += [
+                FifoAllocation(batch_id=batch_id, quantity=portion, **{owner_field: owner_id})
+                for batch_id, portion in taken.items()
+            ]
+
+    FifoAllocation.objects.bulk_create(new_allocations, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0025_cache_versions'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_allocations, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,13 @@
+import csv
+from itertools import chain
+from django.contrib import messages
 from django.contrib.auth.mixins import UserPassesTestMixin
+from django.core.exceptions import ImproperlyConfigured
+from django.http import StreamingHttpResponse
 from django.shortcuts import redirect
+from .models import PeriodClosed
+from .periods import check_open
+from .db import write_transaction, message_on_commit
 
 class ManagerRequiredMixin(UserPassesTestMixin):
     def test_func(self):
@@ -38,3 +46,64 @@ class DateFilterMixin:
                 pass
                 
         return queryset
+
+class Echo:
+    # File-like object for csv.writer that hands each line back instead of buffering it
+    def write(self, value):
+        return value
+
+class CSVExportMixin:
+    """
+    ?export=csv streams every row of the (filtered, unpaginated) queryset as CSV instead of
+    rendering the page. Rows are read with a server-side iterator in chunks of export_chunk_size
+    and written as they arrive, so memory stays flat however many rows are exported
+    Views set export_filename and export_header and must define export_row(obj), which turns
+    each object into a list
+    """
+    export_filename = 'export'
+    export_header = []
+    export_chunk_size = 2000
+    export_row = None
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('export') == 'csv':
+            return self.export_csv()
+        return super().get(request, *args, **kwargs)
+
+    def get_export_queryset(self):
+        return self.get_queryset()
+
+    def export_csv(self):
+        if self.export_row is None:
+            raise ImproperlyConfigured(f"{type(self).__name__} is missing an export_row method.")
+        writer = csv.writer(Echo())
+        rows = (self.export_row(obj) for obj in self.get_export_queryset().iterator(chunk_size=self.export_chunk_size))
+        response = StreamingHttpResponse(
+            (writer.writerow(row) for row in chain([self.export_header], rows)), content_type='text/csv'
+        )
+        response['Content-Disposition'] = f'attachment; filename="{self.export_filename}.csv"'
+        return response
+
+class OpenPeriodDeleteMixin:
+    """
+    Send the user back with the reason instead of deleting a record dated in a closed month
+    """
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        try:
+            check_open(self.object.date)
+        except PeriodClosed as e:
+            message_on_commit(request, messages.ERROR, str(e))
+            return redirect(self.get_success_url())
+        return super().post(request, *args, **kwargs)
+
+def export_date(value):
+    return timezone.localtime(value).strftime('%Y-%m-%d %H:%M') if value else ''
+
+class WriteTransactionMixin:
+    """
+    Run the whole POST in one write transaction that is retried while SQLite is locked
+    The form is rebuilt from the request on every attempt, so a retry starts clean
+    """
+    def post(self, request, *args, **kwargs):
+        return write_transaction(super().post)(request, *args, **kwargs)
@@ -1,13 +1,61 @@
+from contextlib import closing
+from collections import defaultdict, namedtuple
+from decimal import Decimal
 from django.db import models
+from django.db.models import Case, DecimalField, Exists, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.utils import timezone
+from .cache import bump_versions
+
+BALANCE_FIELD = DecimalField(max_digits=14, decimal_places=2)
+
+class InsufficientStock(ValueError):
+    """
+    Raised when a guarded stock or layer update finds less stock than requested
+    """
+
+class PeriodClosed(ValueError):
+    """
+    Raised when a write is dated in (or moves a record out of) a closed month
+    """
+
+def apply_deltas(model, field, changes):
+    """
+    Add {pk: delta} to a numeric field of model rows in a single UPDATE built from
+    F() expressions, so concurrent writers never overwrite each other
+    Rows with a negative delta are only updated while the field still covers it;
+    raises InsufficientStock if any row could not be updated. Call inside a
+    transaction so a failed guard rolls back the rows that were updated
+    """
+    changes = {pk: delta for pk, delta in changes.items() if delta}
+    if not changes:
+        return
+    field_object = model._meta.get_field(field)
+    guard = Q()
+    for pk, delta in changes.items():
+        guard |= Q(pk=pk, **{f'{field}__gte': -delta}) if delta < 0 else Q(pk=pk)
+    delta = Case(
+        *[When(pk=pk, then=Value(delta)) for pk, delta in changes.items()],
+        output_field=field_object
+    )
+    updated = model.objects.filter(guard).update(**{field: F(field) + delta})
+    if updated != len(changes):
+        raise InsufficientStock(f"Not enough stock left to apply the change to {model._meta.verbose_name}.")
 
 class Product(models.Model):
+    COSTING_METHODS = [
+        ('FIFO', 'FIFO (First In, First Out)'),
+        ('AVG', 'Moving Weighted Average'),
+        ('FEFO', 'FEFO (First Expired, First Out)'),
+    ]
     name = models.CharField(max_length=255)
     current_stock = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     minimum_stock_threshold = models.DecimalField(max_digits=10, decimal_places=2, default=5)
     barcode = models.CharField(max_length=255, null=True, blank=True, unique=True)
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     cost_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    costing_method = models.CharField(max_length=4, choices=COSTING_METHODS, default='FIFO')
+    average_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)  # Maintained for AVG costing
 
     class Meta:
         ordering = ['name']
@@ -20,67 +68,92 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
-    def get_fifo_cost_price(self, quantity):
+    @staticmethod
+    def adjust_stock(changes):
+        """
+        Apply {product_id: delta} to current_stock atomically in one UPDATE
+        Never lets stock go below zero; raises InsufficientStock naming the product instead
+        """
+        try:
+            apply_deltas(Product, 'current_stock', changes)
+            bump_versions(Product)
+        except InsufficientStock:
+            short = Product.objects.filter(
+                pk__in=[pk for pk, delta in changes.items() if delta < 0]
+            ).values_list('pk', 'name', 'current_stock')
+            for pk, name, current_stock in short:
+                if current_stock < -changes[pk]:
+                    raise InsufficientStock(f"Not enough stock for {name}")
+            raise
+
+    def add_stock(self, quantity):
+        Product.adjust_stock({self.pk: quantity})
+        self.current_stock += quantity
+
+    def remove_stock(self, quantity):
+        Product.adjust_stock({self.pk: -quantity})
+        self.current_stock -= quantity
+
+    def add_fifo_layer(self, movement):
         """
-        Calculate FIFO cost price for a given quantity
-        Returns the weighted average cost price based on available stock batches
+        Open a FIFO layer for a stock-in movement
+        The layer holds the batch's remaining stock until it is fully consumed
         """
-        # Get all stock-in movements with cost prices and remaining stock, ordered by date (FIFO)
-        stock_in_movements = self.movements.filter(
-            movement_type='IN',
-            cost_price__isnull=False,
-            remaining_quantity__gt=0  # Only batches with available stock
-        ).order_by('date')
-        
-        if not stock_in_movements:
-            return self.cost_price  # Fallback to product's base cost price
-        
-        total_cost = 0
-        remaining_quantity = quantity
-        
-        for movement in stock_in_movements:
-            if remaining_quantity <= 0:
-                break
-            
-            # Calculate how much we can take from this batch
-            batch_quantity = min(remaining_quantity, movement.remaining_quantity)
-            total_cost += batch_quantity * movement.cost_price
-            remaining_quantity -= batch_quantity
-        
-        if quantity - remaining_quantity > 0:
-            return total_cost / (quantity - remaining_quantity)
-        
-        return self.cost_price  # Fallback if no stock available
-
-    def deduct_from_batches(self, quantity):
+        return FifoLayer.objects.create(
+            product=self,
+            movement=movement,
+            date=movement.date,
+            expiry_date=movement.expiry_date,
+            cost_price=movement.cost_price,
+            remaining_quantity=movement.quantity
+        )
+
+    def consume_fifo(self, quantity, ordering=('date', 'id')):
         """
-        Deduct quantity from available batches using FIFO logic
-        Returns list of (batch, quantity_deducted) tuples
+        Consume quantity from open FIFO layers in a single pass
+        Reads the open layers in order, stopping once quantity is covered; emptied layers are
+        deleted and the one partially consumed layer (if any) is updated
+        ordering lets FEFO take the earliest expiring layers first
+        Returns a StockConsumption(cost_price, allocations, shortfall)
         """
-        # Get all stock-in movements with remaining stock, ordered by date (FIFO)
-        stock_in_movements = self.movements.filter(
-            movement_type='IN',
-            remaining_quantity__gt=0
-        ).order_by('date')
-        
-        deductions = []
-        remaining_quantity = quantity
-        
-        for movement in stock_in_movements:
-            if remaining_quantity <= 0:
-                break
-            
-            # Calculate how much to deduct from this batch
-            batch_quantity = min(remaining_quantity, movement.remaining_quantity)
-            
-            # Update the remaining quantity
-            movement.remaining_quantity -= batch_quantity
-            movement.save()
-            
-            deductions.append((movement, batch_quantity))
-            remaining_quantity -= batch_quantity
-        
-        return deductions
+        layers = self.fifo_layers.select_for_update().order_by(*ordering)
+
+        # Stream the layers so only the ones actually consumed are fetched, however many are open
+        with closing(layers.iterator(chunk_size=100)) as open_layers:
+            consumption = allocate_batches(open_layers, quantity, fallback_cost=self.cost_price)
+        FifoLayer.save_allocations(consumption.allocations)
+        return consumption
+
+StockConsumption = namedtuple('StockConsumption', ['cost_price', 'allocations', 'shortfall'])
+
+def allocate_batches(batches, quantity, fallback_cost=None):
+    """
+    Allocate quantity across batches (FIFO layers) in the order given, in memory only
+    Each touched batch has its remaining_quantity reduced; the caller persists them
+    The cost price is the weighted average over the costed batches consumed,
+    falling back to fallback_cost when no costed stock was available
+    """
+    allocations = []
+    remaining_quantity = quantity
+    costed_quantity = 0
+    total_cost = 0
+
+    for batch in batches:
+        if remaining_quantity <= 0:
+            break
+
+        # Calculate how much we can take from this batch
+        batch_quantity = min(remaining_quantity, batch.remaining_quantity)
+        batch.remaining_quantity -= batch_quantity
+        allocations.append((batch, batch_quantity))
+        remaining_quantity -= batch_quantity
+
+        if batch.cost_price is not None:
+            total_cost += batch_quantity * batch.cost_price
+            costed_quantity += batch_quantity
+
+    cost_price = total_cost / costed_quantity if costed_quantity > 0 else fallback_cost
+    return StockConsumption(cost_price, allocations, max(remaining_quantity, 0))
 
 class InventoryMovement(models.Model):
     MOVEMENT_TYPES = [
@@ -92,19 +165,89 @@ class InventoryMovement(models.Model):
     invoice = models.ForeignKey('Invoice', on_delete=models.CASCADE, null=True, blank=True, related_name='inventory_movements')
     movement_type = models.CharField(max_length=3, choices=MOVEMENT_TYPES)
     quantity = models.DecimalField(max_digits=10, decimal_places=2)
-    remaining_quantity = models.DecimalField(max_digits=10, decimal_places=2, default=0)  # Available quantity left in this batch
     date = models.DateTimeField(default=timezone.now)
     reference = models.CharField(max_length=255, null=True, blank=True)
     cost_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    expiry_date = models.DateField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.movement_type} - {self.product.name} ({self.quantity})"
 
+    def record_consumption(self, consumption, keep_cost=True):
+        """
+        Store what this manual stock-out took: its allocations and, unless a cost price was
+        entered (keep_cost), the cost it was consumed at, which month-end stock valuation subtracts
+        """
+        FifoAllocation.record(consumption.allocations, stock_out=self)
+        if consumption.cost_price is not None and (self.cost_price is None or not keep_cost):
+            self.cost_price = Decimal(consumption.cost_price).quantize(Decimal('0.01'))
+            self.save(update_fields=['cost_price'])
+
+class FifoLayer(models.Model):
+    """
+    An open stock-in batch that still has stock available for FIFO consumption
+    Created on stock-in, shrinks on consumption and is removed once empty
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='fifo_layers')
+    movement = models.OneToOneField(InventoryMovement, on_delete=models.CASCADE, related_name='fifo_layer')
+    date = models.DateTimeField()
+    expiry_date = models.DateField(null=True, blank=True)
+    cost_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    remaining_quantity = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        ordering = ['date', 'id']
+        indexes = [
+            models.Index(fields=['product', 'date']),
+            models.Index(fields=['product', 'expiry_date']),
+        ]
+
+    def __str__(self):
+        return f"Layer: {self.product.name} ({self.remaining_quantity} @ {self.cost_price})"
+
+    @staticmethod
+    def save_allocations(allocations):
+        """
+        Persist layers touched by allocate_batches: delete the emptied ones and take
+        the allocated quantity off the rest with one guarded F() update
+        An emptied layer is only deleted while its row still holds exactly what was taken;
+        if another writer changed it in the meantime the take is applied as a guarded delta
+        instead, so a restored layer keeps the difference and a shrunk one is refused
+        Raises InsufficientStock if another writer consumed the same layers first
+        """
+        taken = defaultdict(int)
+        layers = {}
+        for layer, quantity in allocations:
+            taken[layer.pk] += quantity
+            layers[layer.pk] = layer
+
+        emptied = Q()
+        emptied_ids = []
+        partial = {}
+        for pk, layer in layers.items():
+            if layer.remaining_quantity <= 0:
+                emptied |= Q(pk=pk, remaining_quantity=taken[pk])
+                emptied_ids.append(pk)
+            else:
+                partial[pk] = -taken[pk]
+
+        if emptied_ids:
+            _, per_model = FifoLayer.objects.filter(emptied).delete()
+            deleted = per_model.get(FifoLayer._meta.label, 0)
+            if deleted != len(emptied_ids):
+                # Rows still there changed since they were read; rows gone but not deleted here were consumed elsewhere
+                changed = set(FifoLayer.objects.filter(pk__in=emptied_ids).values_list('pk', flat=True))
+                if deleted + len(changed) != len(emptied_ids):
+                    raise InsufficientStock("Stock layers changed while they were being consumed.")
+                partial.update({pk: -taken[pk] for pk in changed})
+        apply_deltas(FifoLayer, 'remaining_quantity', partial)
+
 class Client(models.Model):
     name = models.CharField(max_length=255)
     phone = models.CharField(max_length=20, null=True, blank=True)
     address = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(default=timezone.now)
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0, db_index=True)  # Outstanding debt, see refresh_balances
 
     class Meta:
         ordering = ['name']
@@ -114,15 +257,55 @@ class Client(models.Model):
 
     @property
     def total_debt(self):
-        # Calculate total debt: Sum of (total_price - amount_paid) for credit sales - sum of payments
-        credit_sales = [s for s in self.sales.all() if s.is_credit]
-        unpaid_amount = sum(s.total_price - s.amount_paid for s in credit_sales)
-        
-        credit_invoices = [i for i in getattr(self, 'invoices').all() if i.is_credit] if hasattr(self, 'invoices') else []
-        unpaid_amount += sum(i.total_price - i.amount_paid for i in credit_invoices)
-        
-        payments_total = sum(p.amount for p in self.debt_payments.all())
-        return unpaid_amount - payments_total
+        # Stored balance, kept up to date by every sale, invoice and payment write
+        return self.balance
+
+    @staticmethod
+    def balance_expression():
+        """
+        A client's outstanding balance computed in SQL, for use against Client rows:
+        Sum of (total_price - amount_paid) for credit sales and invoices - sum of payments
+        """
+        def total(queryset, expression):
+            grouped = queryset.order_by().values('client_id').annotate(total=Sum(expression)).values('total')
+            return Coalesce(Subquery(grouped), Value(Decimal('0')), output_field=BALANCE_FIELD)
+
+        credit_sales = Sale.objects.filter(client=OuterRef('pk'), is_credit=True)
+        credit_items = SaleItem.objects.filter(invoice__client=OuterRef('pk'), invoice__is_credit=True).annotate(
+            client_id=F('invoice__client_id')
+        )
+        credit_invoices = Invoice.objects.filter(client=OuterRef('pk'), is_credit=True)
+        payments = DebtPayment.objects.filter(client=OuterRef('pk'))
+        return (
+            total(credit_sales, F('quantity') * F('price_at_sale') - F('amount_paid'))
+            + total(credit_items, F('quantity') * F('price_at_sale'))
+            - total(credit_invoices, F('amount_paid'))
+            - total(payments, F('amount'))
+        )
+
+    @staticmethod
+    def overdue_expression(today=None):
+        """
+        True for clients with a credit invoice past its due date (before today) that is not fully paid
+        """
+        today = today or timezone.localdate()
+        overdue = (
+            Invoice.objects.filter(client=OuterRef('pk'), is_credit=True, due_date__lt=today)
+            .values('pk')
+            .annotate(total=Sum(F('items__quantity') * F('items__price_at_sale')))
+            .filter(total__gt=F('amount_paid'))
+        )
+        return Exists(overdue)
+
+    @staticmethod
+    def refresh_balances(client_ids):
+        """
+        Recompute the stored balance of the given clients in a single UPDATE; call inside the write's transaction
+        """
+        client_ids = {pk for pk in client_ids if pk is not None}
+        if client_ids:
+            Client.objects.filter(pk__in=client_ids).update(balance=Client.balance_expression())
+            bump_versions(Client)
 
 class Sale(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='sales')
@@ -134,6 +317,11 @@ class Sale(models.Model):
     is_credit = models.BooleanField(default=False)
     amount_paid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['client', 'date']),
+        ]
+
     @property
     def total_price(self):
         return self.quantity * self.price_at_sale
@@ -178,24 +366,64 @@ class Invoice(models.Model):
     is_credit = models.BooleanField(default=False)
     amount_paid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     notes = models.TextField(null=True, blank=True)
+    # Stored from the items, see refresh_totals
+    total_price = models.DecimalField(max_digits=14, decimal_places=2, default=0, db_index=True)
+    total_cost = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    balance_due = models.DecimalField(max_digits=14, decimal_places=2, default=0, db_index=True)
 
-    @property
-    def total_price(self):
-        return sum(item.total_price for item in self.items.all())
+    TOTAL_FIELDS = ['total_price', 'total_cost', 'balance_due']
 
-    @property
-    def total_cost(self):
-        return sum(item.total_cost for item in self.items.all())
+    # payment_status values as filters on the stored totals
+    STATUS_FILTERS = {
+        'PAID': Q(is_credit=False) | Q(balance_due__lte=0),
+        'PARTIAL': Q(is_credit=True, balance_due__gt=0, amount_paid__gt=0),
+        'UNPAID': Q(is_credit=True, balance_due__gt=0, amount_paid__lte=0),
+    }
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['client', 'due_date']),
+        ]
 
     @property
     def profit(self):
         return self.total_price - self.total_cost
 
-    @property
-    def balance_due(self):
-        if self.is_credit:
-            return self.total_price - self.amount_paid
-        return 0
+    @staticmethod
+    def totals_expressions():
+        """
+        The stored totals computed in SQL from the items, for use against Invoice rows
+        """
+        def total(expression):
+            grouped = (
+                SaleItem.objects.filter(invoice=OuterRef('pk')).order_by().values('invoice_id')
+                .annotate(total=Sum(expression)).values('total')
+            )
+            return Coalesce(Subquery(grouped), Value(Decimal('0')), output_field=BALANCE_FIELD)
+
+        total_price = total(F('quantity') * F('price_at_sale'))
+        return {
+            'total_price': total_price,
+            'total_cost': total(F('quantity') * F('cost_price')),
+            'balance_due': Case(
+                When(is_credit=True, then=total_price - F('amount_paid')),
+                default=Value(Decimal('0')),
+                output_field=BALANCE_FIELD
+            ),
+        }
+
+    @staticmethod
+    def refresh_totals(invoice_ids):
+        """
+        Recompute the stored totals of the given invoices (ids or a queryset of pks) in a
+        single UPDATE; call inside the write's transaction after their items change
+        """
+        if not isinstance(invoice_ids, models.QuerySet):
+            invoice_ids = {pk for pk in invoice_ids if pk is not None}
+            if not invoice_ids:
+                return
+        Invoice.objects.filter(pk__in=invoice_ids).update(**Invoice.totals_expressions())
+        bump_versions(Invoice)
 
     @property
     def payment_status(self):
@@ -249,6 +477,78 @@ class SaleItem(models.Model):
     def __str__(self):
         return f"Item: {self.product.name} x {self.quantity}"
 
+class FifoAllocation(models.Model):
+    """
+    Quantity a sale, invoice line or manual stock-out took from one stock-in batch
+    Lets deletes and edits hand stock back to exactly the layers it came from
+    """
+    batch = models.ForeignKey(InventoryMovement, on_delete=models.CASCADE, related_name='allocations')
+    sale = models.ForeignKey(Sale, on_delete=models.CASCADE, null=True, blank=True, related_name='fifo_allocations')
+    sale_item = models.ForeignKey(SaleItem, on_delete=models.CASCADE, null=True, blank=True, related_name='fifo_allocations')
+    stock_out = models.ForeignKey(InventoryMovement, on_delete=models.CASCADE, null=True, blank=True, related_name='out_allocations')
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+
+    def __str__(self):
+        return f"Allocation: {self.quantity} from batch {self.batch_id}"
+
+    @classmethod
+    def record(cls, allocations, **owner):
+        """
+        Store the (layer, quantity) allocations of a consumption against its owner
+        (sale=..., sale_item=... or stock_out=...)
+        """
+        return cls.objects.bulk_create([
+            cls(batch_id=layer.movement_id, quantity=quantity, **owner)
+            for layer, quantity in allocations
+        ])
+
+    @classmethod
+    def release(cls, allocations):
+        """
+        Give the quantities of the given allocations back to their layers and
+        delete the allocations. Open layers grow in one bulk update; layers that
+        were emptied in the meantime are reopened from their batch in one bulk insert
+        """
+        returned = defaultdict(int)
+        batches = {}
+        for allocation in allocations.select_related('batch__product'):
+            returned[allocation.batch_id] += allocation.quantity
+            batches[allocation.batch_id] = allocation.batch
+
+        cls.restore_layers(returned, batches)
+        allocations.delete()
+
+    @staticmethod
+    def restore_layers(returned, batches):
+        """
+        Put {batch_id: quantity} back onto the layers of those batches ({batch_id: batch})
+        Batches of products that have since moved to a costing method without layers are
+        skipped, so their stock is not handed to layers nothing maintains any more
+        """
+        from .costing import get_strategy
+
+        batches = {batch_id: batch for batch_id, batch in batches.items() if get_strategy(batch.product).uses_layers}
+        returned = {batch_id: quantity for batch_id, quantity in returned.items() if batch_id in batches}
+        if not returned:
+            return
+
+        open_layers = FifoLayer.objects.select_for_update().in_bulk(list(returned), field_name='movement_id')
+        apply_deltas(FifoLayer, 'remaining_quantity', {
+            layer.pk: returned[batch_id] for batch_id, layer in open_layers.items()
+        })
+
+        FifoLayer.objects.bulk_create([
+            FifoLayer(
+                product_id=batch.product_id,
+                movement=batch,
+                date=batch.date,
+                expiry_date=batch.expiry_date,
+                cost_price=batch.cost_price,
+                remaining_quantity=returned[batch_id]
+            )
+            for batch_id, batch in batches.items() if batch_id not in open_layers
+        ])
+
 class DebtPayment(models.Model):
     client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='debt_payments')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -278,5 +578,103 @@ class MoneyJournal(models.Model):
     invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, null=True, blank=True, related_name='journal_entries')
     debt_payment = models.ForeignKey(DebtPayment, on_delete=models.CASCADE, null=True, blank=True, related_name='journal_entries')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['entry_type', 'date']),
+        ]
+
     def __str__(self):
         return f"{self.entry_type}: {self.amount}"
+
+class DailyRollup(models.Model):
+    """
+    Pre-aggregated totals for one business day
+    Sales rows carry a product and hold quantity, revenue and COGS for it; journal
+    rows have no product and hold income and expenses for one expense category
+    Rows are recomputed from the source records on every write (see shop.rollups)
+    """
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True, related_name='daily_rollups')
+    category = models.ForeignKey(ExpenseCategory, on_delete=models.SET_NULL, null=True, blank=True, related_name='daily_rollups')
+    quantity = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    cogs = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    income = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    expenses = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['date']
+        indexes = [
+            models.Index(fields=['date']),
+            models.Index(fields=['product', 'date']),
+        ]
+
+    def __str__(self):
+        return f"{self.date}: {self.product or self.category or 'Journal'}"
+
+class ClosedPeriod(models.Model):
+    """
+    A calendar month whose month-end totals are frozen in PeriodSnapshot rows
+    Months are closed in order, so every month before the latest closed one is closed
+    too; writes dated in a closed month are refused (see shop.periods)
+    """
+    month = models.DateField(unique=True)  # First day of the month
+    closed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['month']
+
+    def __str__(self):
+        return self.month.strftime('%b %Y')
+
+class PeriodSnapshot(models.Model):
+    """
+    One frozen month-end figure of a closed period
+    Sales rows hold quantity, revenue and COGS of a product sold in the month, expense rows
+    the amount spent in a category, receivable rows a client's balance at month end and
+    stock rows a product's quantity on hand and its value at cost. The label keeps the
+    product, category or client name as it was when the period was closed
+    """
+    SALES = 'SALES'
+    EXPENSES = 'EXPENSES'
+    RECEIVABLE = 'RECEIVABLE'
+    STOCK = 'STOCK'
+    KINDS = [
+        (SALES, 'Sales'),
+        (EXPENSES, 'Expenses'),
+        (RECEIVABLE, 'Receivable'),
+        (STOCK, 'Stock'),
+    ]
+    period = models.ForeignKey(ClosedPeriod, on_delete=models.CASCADE, related_name='snapshots')
+    kind = models.CharField(max_length=10, choices=KINDS)
+    label = models.CharField(max_length=255)
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True, related_name='snapshots')
+    category = models.ForeignKey(ExpenseCategory, on_delete=models.SET_NULL, null=True, blank=True, related_name='snapshots')
+    client = models.ForeignKey(Client, on_delete=models.SET_NULL, null=True, blank=True, related_name='snapshots')
+    quantity = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    cogs = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'period']),
+        ]
+
+    @property
+    def margin(self):
+        return self.revenue - self.cogs
+
+    def __str__(self):
+        return f"{self.period}: {self.get_kind_display()} {self.label}"
+
+class CacheVersion(models.Model):
+    """
+    Current version of one model's data; cached contexts are keyed by the versions
+    of the models they are built from (see shop.cache)
+    """
+    model = models.CharField(max_length=100, unique=True)  # app_label.model_name
+    version = models.CharField(max_length=40)
+
+    def __str__(self):
+        return f"{self.model}: {self.version}"
@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .cache import bump_versions
+from .models import (
+    Product, Client, Sale, Invoice, InventoryMovement, DebtPayment, DailyRollup,
+    ClosedPeriod, PeriodSnapshot, PeriodClosed, BALANCE_FIELD,
+)
+from .reports import day_bounds
+
+CENT = Decimal('0.01')
+
+def month_start(day):
+    return day.replace(day=1)
+
+def next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+def closed_through():
+    """
+    First day after the latest closed month (every earlier day is closed), or None when nothing is closed
+    """
+    last = ClosedPeriod.objects.aggregate(last=Max('month'))['last']
+    return next_month(last) if last else None
+
+def open_since():
+    """
+    Start of the first open business day as an aware datetime, or None when nothing is closed
+    Bulk rebuilds only rewrite what is dated from here on
+    """
+    boundary = closed_through()
+    return day_bounds(boundary, boundary)[0] if boundary else None
+
+def check_open(value, boundary=None):
+    """
+    Raise PeriodClosed when value (a date or datetime) falls in a closed month
+    """
+    boundary = boundary or closed_through()
+    if boundary is None or value is None:
+        return
+    day = timezone.localdate(value) if isinstance(value, datetime) else value
+    if day < boundary:
+        raise PeriodClosed(
+            f"{day:%b %Y} is closed. Entries dated before {boundary:%b %d, %Y} can no longer be added or changed."
+        )
+
+def grouped(queryset, field, **totals):
+    return {row[field]: row for row in queryset.values(field).annotate(**totals).order_by()}
+
+def amount_sum(expression, **kwargs):
+    return Coalesce(Sum(expression, **kwargs), Value(Decimal('0')), output_field=BALANCE_FIELD)
+
+def sales_snapshots(start, end):
+    rows = grouped(
+        DailyRollup.objects.filter(product__isnull=False, date__gte=start, date__lt=end), 'product',
+        quantity=amount_sum('quantity'), revenue=amount_sum('revenue'), cogs=amount_sum('cogs')
+    )
+    names = dict(Product.objects.filter(pk__in=rows).values_list('pk', 'name'))
+    return [
+        PeriodSnapshot(kind=PeriodSnapshot.SALES, label=names[product_id], product_id=product_id,
+                       quantity=row['quantity'], revenue=row['revenue'], cogs=row['cogs'])
+        for product_id, row in rows.items()
+    ]
+
+def expense_snapshots(start, end):
+    rows = (
+        DailyRollup.objects.filter(product__isnull=True, date__gte=start, date__lt=end)
+        .values('category', 'category__name').annotate(amount=amount_sum('expenses')).order_by()
+    )
+    return [
+        PeriodSnapshot(kind=PeriodSnapshot.EXPENSES, label=row['category__name'] or 'Uncategorized',
+                       category_id=row['category'], amount=row['amount'])
+        for row in rows if row['amount']
+    ]
+
+def receivable_snapshots(until):
+    """
+    Each client's balance from the credit sales, credit invoices and payments dated before until
+    """
+    sales = grouped(Sale.objects.filter(is_credit=True, client__isnull=False, date__lt=until), 'client',
+                    amount=amount_sum(F('quantity') * F('price_at_sale') - F('amount_paid')))
+    invoices = grouped(Invoice.objects.filter(is_credit=True, client__isnull=False, date__lt=until), 'client',
+                       amount=amount_sum('balance_due'))
+    payments = grouped(DebtPayment.objects.filter(date__lt=until), 'client', amount=amount_sum('amount'))
+
+    snapshots = []
+    for pk, name in Client.objects.filter(pk__in=set(sales) | set(invoices) | set(payments)).values_list('pk', 'name'):
+        balance = sum(rows[pk]['amount'] for rows in (sales, invoices) if pk in rows)
+        balance -= payments[pk]['amount'] if pk in payments else 0
+        if balance:
+            snapshots.append(PeriodSnapshot(kind=PeriodSnapshot.RECEIVABLE, label=name, client_id=pk,
+                                            amount=Decimal(balance).quantize(CENT)))
+    return snapshots
+
+def stock_snapshots(until):
+    """
+    Each product's quantity on hand from the movements dated before until, valued at cost:
+    stock-ins at their cost price less stock-outs at the cost they were consumed at
+    """
+    stock_in, stock_out = Q(movement_type='IN'), Q(movement_type='OUT')
+    rows = grouped(
+        InventoryMovement.objects.filter(date__lt=until), 'product',
+        on_hand=amount_sum('quantity', filter=stock_in) - amount_sum('quantity', filter=stock_out),
+        value=(amount_sum(F('quantity') * F('cost_price'), filter=stock_in)
+               - amount_sum(F('quantity') * F('cost_price'), filter=stock_out)),
+    )
+    names = dict(Product.objects.filter(pk__in=rows).values_list('pk', 'name'))
+    return [
+        PeriodSnapshot(kind=PeriodSnapshot.STOCK, label=names[product_id], product_id=product_id,
+                       quantity=row['on_hand'], amount=Decimal(row['value']).quantize(CENT))
+        for product_id, row in rows.items() if row['on_hand'] or row['value']
+    ]
+
+def close_period(month, today=None):
+    """
+    Close the calendar month containing month: freeze its sales per product, expenses per
+    category, and the receivables and stock valuation at month end as snapshot rows
+    Months close in order and only once they are over. Returns the ClosedPeriod
+    """
+    today = today or timezone.localdate()
+    start = month_start(month)
+    end = next_month(start)
+    if end > today:
+        raise PeriodClosed(f"{start:%b %Y} is not over yet.")
+
+    with transaction.atomic():
+        boundary = closed_through()
+        if boundary is not None and start != boundary:
+            raise PeriodClosed(
+                f"{boundary:%b %Y} is the next month to close." if start > boundary else f"{start:%b %Y} is already closed."
+            )
+        until = day_bounds(end, end)[0]
+        period = ClosedPeriod.objects.create(month=start)
+        snapshots = (
+            sales_snapshots(start, end) + expense_snapshots(start, end)
+            + receivable_snapshots(until) + stock_snapshots(until)
+        )
+        for snapshot in snapshots:
+            snapshot.period = period
+        PeriodSnapshot.objects.bulk_create(snapshots, batch_size=500)
+        bump_versions(ClosedPeriod, PeriodSnapshot)
+    return period
+
+def period_totals(periods):
+    """
+    Annotate a queryset of closed periods with their frozen figures in one grouped query:
+    the month's revenue, COGS, margin and expenses, and the receivables and stock value at month end
+    """
+    def total(field, kind):
+        return amount_sum(f'snapshots__{field}', filter=Q(snapshots__kind=kind))
+
+    return periods.annotate(
+        revenue=total('revenue', PeriodSnapshot.SALES), cogs=total('cogs', PeriodSnapshot.SALES),
+        expenses=total('amount', PeriodSnapshot.EXPENSES), receivables=total('amount', PeriodSnapshot.RECEIVABLE),
+        stock_value=total('amount', PeriodSnapshot.STOCK),
+    ).annotate(margin=F('revenue') - F('cogs'))
+
+def report_sources(rollups, start=None, end=None):
+    """
+    Split a report over the business days start..end (open ended when None) into the closed
+    months it fully covers, read from sales snapshots, and the rest, left to the given rollups
+    Returns (rollups, snapshots) with the snapshot months excluded from the rollups
+    Only per-product totals come from snapshots; reports that list individual sales keep
+    reading them, which cannot change once their month is closed
+    """
+    boundary = closed_through()
+    if boundary is None:
+        return rollups, PeriodSnapshot.objects.none()
+
+    first = start if start is None or start.day == 1 else next_month(start)
+    last = boundary if end is None else min(boundary, month_start(end + timedelta(days=1)))
+    if first is not None and first >= last:
+        return rollups, PeriodSnapshot.objects.none()
+
+    snapshots = PeriodSnapshot.objects.filter(kind=PeriodSnapshot.SALES, period__month__lt=last)
+    rollups = rollups.exclude(date__lt=last) if first is None else rollups.exclude(date__gte=first, date__lt=last)
+    if first is not None:
+        snapshots = snapshots.filter(period__month__gte=first)
+    return rollups, snapshots
@@ -0,0 +1,247 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from django.db.models import Case, CharField, Count, DateField, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Round, TruncMonth
+from django.utils import timezone
+from .models import DailyRollup, Product, Invoice, DebtPayment, BALANCE_FIELD
+
+def day_bounds(start, end):
+    """
+    Aware datetimes covering the local days start..end, so date filters can use the column index
+    """
+    return (
+        timezone.make_aware(datetime.combine(start, time.min)),
+        timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min)),
+    )
+
+def daily_totals(start, end):
+    """
+    Revenue, COGS and expenses per business day from start to end inclusive, read
+    from the daily rollups in one grouped query (so the cost depends on the window,
+    not on how much history is kept)
+    Returns {date: {'revenue', 'cogs', 'expenses'}} with Decimal zeros for empty days
+    """
+    totals = defaultdict(lambda: {'revenue': Decimal('0'), 'cogs': Decimal('0'), 'expenses': Decimal('0')})
+    rows = (
+        DailyRollup.objects.filter(date__gte=start, date__lte=end)
+        .values('date')
+        .annotate(revenue=Sum('revenue'), cogs=Sum('cogs'), expenses=Sum('expenses'))
+        .order_by()
+    )
+    for row in rows:
+        totals[row['date']].update(revenue=row['revenue'], cogs=row['cogs'], expenses=row['expenses'])
+    return totals
+
+# Selectable dashboard windows, in days
+CHART_WINDOWS = (7, 30, 90, 365)
+
+def chart_granularity(days):
+    """
+    Bucket size that keeps a window readable: days up to a month, weeks up to a quarter, months beyond
+    """
+    if days <= 31:
+        return 'day'
+    if days <= 92:
+        return 'week'
+    return 'month'
+
+def bucket_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def bucket_label(day, granularity):
+    if granularity == 'month':
+        return day.strftime('%b %Y')
+    return day.strftime('%b %d')
+
+def chart_series(days=7, end=None, granularity=None):
+    """
+    Chart labels and sales, profit and expenses per day, week or month (picked from
+    the window length unless given) for the days ending on end (today by default)
+    Weeks start on Monday and months on the 1st; the first bucket starts with the
+    window, so it may be partial
+    Profit = Total Sales Value - COGS - Expenses (Accrual), so credit sales don't look like losses
+    """
+    end = end or timezone.localdate()
+    start = end - timedelta(days=days - 1)
+    granularity = granularity or chart_granularity(days)
+    totals = daily_totals(start, end)
+
+    buckets = {}
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        bucket = buckets.setdefault(max(bucket_start(day, granularity), start), defaultdict(Decimal))
+        for field, value in totals[day].items():
+            bucket[field] += value
+
+    series = {'granularity': granularity, 'labels': [], 'sales': [], 'profit': [], 'expenses': []}
+    for day, row in buckets.items():
+        series['labels'].append(bucket_label(day, granularity))
+        series['sales'].append(float(row['revenue']))
+        series['expenses'].append(float(row['expenses']))
+        series['profit'].append(round(float(row['revenue'] - row['cogs'] - row['expenses']), 2))
+    return series
+
+def line_amounts():
+    """
+    Total price and total cost expressions of a sale or invoice line (no recorded cost counts as 0)
+    """
+    return (
+        F('quantity') * F('price_at_sale'),
+        Coalesce(F('quantity') * F('cost_price'), Value(Decimal('0')), output_field=BALANCE_FIELD),
+    )
+
+def line_columns(date, client, is_credit, kind):
+    """
+    Columns shared by sales and invoice lines, so both querysets can be combined with union()
+    date, client and is_credit name the fields that hold them on each model
+    """
+    total_price, total_cost = line_amounts()
+    return {
+        'kind': Value(kind, output_field=CharField()),
+        'line_id': F('pk'),
+        'sold_at': F(date),
+        'product_name': F('product__name'),
+        'client_name': F(f'{client}__name'),
+        'credit': F(is_credit),
+        'total_price': total_price,
+        'total_cost': total_cost,
+        'profit': total_price - total_cost,
+    }
+
+def sales_lines(sales, items):
+    """
+    Sales and invoice lines as one queryset of dicts, newest first, sorted (and sliced
+    by the paginator) in the database
+    """
+    sales = sales.values('quantity', 'price_at_sale', **line_columns('date', 'client', 'is_credit', 'sale'))
+    items = items.values('quantity', 'price_at_sale',
+                         **line_columns('invoice__date', 'invoice__client', 'invoice__is_credit', 'item'))
+    return sales.union(items, all=True).order_by('-sold_at', '-line_id')
+
+def line_totals(queryset, is_credit):
+    """
+    Revenue, cost and line counts of a queryset of sales or invoice lines, split cash/credit, in one query
+    """
+    total_price, total_cost = line_amounts()
+    cash, credit = Q(**{is_credit: False}), Q(**{is_credit: True})
+    totals = queryset.aggregate(
+        revenue=Sum(total_price),
+        cost=Sum(total_cost),
+        cash_revenue=Sum(total_price, filter=cash),
+        credit_revenue=Sum(total_price, filter=credit),
+        count=Count('pk'),
+        cash_count=Count('pk', filter=cash),
+        credit_count=Count('pk', filter=credit),
+    )
+    return {key: value or 0 for key, value in totals.items()}
+
+def sales_summary(sales, items):
+    """
+    Report totals for a queryset of sales and one of invoice lines, each a handful of aggregate queries
+    Outstanding credit is what the credit sales and credit invoices still owe, less every
+    debt payment of the clients they were sold to
+    """
+    sale_totals = line_totals(sales, 'is_credit')
+    item_totals = line_totals(items, 'invoice__is_credit')
+    totals = {key: sale_totals[key] + item_totals[key] for key in sale_totals}
+
+    credit_sales = sales.filter(is_credit=True)
+    credit_invoices = Invoice.objects.filter(is_credit=True, pk__in=items.values('invoice'))
+    unpaid = credit_sales.aggregate(total=Sum(F('quantity') * F('price_at_sale') - F('amount_paid')))['total'] or 0
+    unpaid += credit_invoices.aggregate(total=Sum('balance_due'))['total'] or 0
+    paid = DebtPayment.objects.filter(
+        Q(client__in=credit_sales.values('client')) | Q(client__in=credit_invoices.values('client'))
+    ).aggregate(total=Sum('amount'))['total'] or 0
+
+    return {
+        'total_revenue': totals['revenue'],
+        'total_cost': totals['cost'],
+        'total_profit': totals['revenue'] - totals['cost'],
+        'cash_revenue': totals['cash_revenue'],
+        'credit_revenue': totals['credit_revenue'],
+        'outstanding_credit': unpaid - paid,
+        'total_sales': totals['count'],
+        'cash_sales_count': totals['cash_count'],
+        'credit_sales_count': totals['credit_count'],
+    }
+
+def expense_summary(expenses):
+    """
+    Total, count, average and per-category totals of a queryset of expense entries, from
+    one query grouped by category and one grouped by category and (local) month
+    The monthly breakdown is {'categories': [name], 'rows': [{'month', 'amounts', 'total'}]}
+    with one amount per category, oldest month first
+    """
+    rows = (
+        expenses.values('category__name')
+        .annotate(total=Sum('amount'), count=Count('pk'))
+        .order_by('-total', 'category__name')
+    )
+    category_totals = {}
+    total_expenses, expense_count = Decimal('0'), 0
+    for row in rows:
+        category_totals[row['category__name'] or 'Uncategorized'] = row['total']
+        total_expenses += row['total']
+        expense_count += row['count']
+
+    categories = list(category_totals)
+    months = defaultdict(lambda: [Decimal('0')] * len(categories))
+    monthly = (
+        expenses.annotate(month=TruncMonth('date', output_field=DateField()))
+        .values('month', 'category__name')
+        .annotate(total=Sum('amount'))
+        .order_by()
+    )
+    for row in monthly:
+        months[row['month']][categories.index(row['category__name'] or 'Uncategorized')] += row['total']
+
+    return {
+        'total_expenses': total_expenses,
+        'category_totals': category_totals,
+        'expense_count': expense_count,
+        'average_expense': total_expenses / expense_count if expense_count else 0,
+        'monthly_breakdown': {
+            'categories': categories,
+            'rows': [{'month': month, 'amounts': amounts, 'total': sum(amounts)} for month, amounts in sorted(months.items())],
+        },
+    }
+
+def product_profits(rollups, snapshots=None):
+    """
+    Products with units sold, revenue, cost, net profit and margin (%) summed from rollups
+    (a queryset of sales rollups) and, for closed months, sales snapshots, in correlated
+    subqueries, best net profit first
+    Products without any of those rows are filtered out in the query, so sorting and
+    slicing cover the whole catalog
+    """
+    sources = [rollups] if snapshots is None else [rollups, snapshots]
+
+    def total(field):
+        subqueries = [
+            Coalesce(Subquery(
+                source.filter(product=OuterRef('pk')).order_by()
+                .values('product').annotate(total=Sum(field)).values('total')
+            ), Value(Decimal('0')), output_field=BALANCE_FIELD)
+            for source in sources
+        ]
+        return sum(subqueries[1:], subqueries[0])
+
+    sold = Q()
+    for source in sources:
+        sold |= Q(pk__in=source.values('product'))
+    return (
+        Product.objects.filter(sold)
+        .annotate(total_sold=total('quantity'), total_revenue=total('revenue'), total_cost=total('cogs'))
+        .annotate(net_profit=F('total_revenue') - F('total_cost'))
+        .annotate(margin=Case(
+            When(total_revenue__gt=0, then=Round(F('net_profit') * 100 / F('total_revenue'), 1)),
+            default=Value(Decimal('0')),
+            output_field=BALANCE_FIELD,
+        ))
+        .order_by('-net_profit', 'name')
+    )
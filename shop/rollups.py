@@ -0,0 +1,156 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db.models import F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+from .cache import bump_versions
+from .models import DailyRollup, Sale, SaleItem, MoneyJournal
+from .reports import day_bounds
+from .periods import open_since
+
+KEY_CHUNK = 200
+
+def business_date(value):
+    return timezone.localdate(value)
+
+def sale_key(sale):
+    return (business_date(sale.date), sale.product_id)
+
+def invoice_keys(invoice):
+    """
+    Rollup keys of the lines currently on an invoice
+    """
+    day = business_date(invoice.date)
+    return {(day, product_id) for product_id in invoice.items.values_list('product_id', flat=True)}
+
+def sale_totals(sales, items):
+    """
+    Quantity, revenue and COGS grouped by (business date, product_id) for a queryset
+    of sales and one of invoice lines. Lines without a recorded cost fall back to the
+    product's cost price
+    """
+    unit_cost = Coalesce('cost_price', 'product__cost_price', Value(Decimal('0')))
+    totals = defaultdict(lambda: {'quantity': Decimal('0'), 'revenue': Decimal('0'), 'cogs': Decimal('0')})
+    for queryset, date_field in ((sales, 'date'), (items, 'invoice__date')):
+        rows = (
+            queryset.annotate(day=TruncDate(date_field))
+            .values('day', 'product_id')
+            .annotate(
+                total_quantity=Sum('quantity'),
+                total_revenue=Sum(F('quantity') * F('price_at_sale')),
+                total_cogs=Sum(F('quantity') * unit_cost)
+            )
+            .order_by()
+        )
+        for row in rows:
+            row_totals = totals[(row['day'], row['product_id'])]
+            for field in ('quantity', 'revenue', 'cogs'):
+                row_totals[field] += row[f'total_{field}'] or 0
+    return totals
+
+def journal_totals(entries):
+    """
+    Income and expenses grouped by (business date, category_id) for a queryset of journal entries
+    """
+    totals = defaultdict(lambda: {'income': Decimal('0'), 'expenses': Decimal('0')})
+    rows = (
+        entries.annotate(day=TruncDate('date'))
+        .values('day', 'category_id', 'entry_type')
+        .annotate(total=Sum('amount'))
+        .order_by()
+    )
+    for row in rows:
+        field = 'income' if row['entry_type'] == 'Income' else 'expenses'
+        totals[(row['day'], row['category_id'])][field] += row['total'] or 0
+    return totals
+
+def refresh_sale_rollups(keys):
+    """
+    Recompute the sales rows for (business date, product_id) keys from the sales and invoice lines
+    Keys are handled in date order and in chunks, so each chunk reads a narrow date range
+    """
+    keys = sorted({key for key in keys if key[1] is not None})
+    for i in range(0, len(keys), KEY_CHUNK):
+        chunk = keys[i:i + KEY_CHUNK]
+        product_ids = {product_id for _, product_id in chunk}
+        since, until = day_bounds(chunk[0][0], chunk[-1][0])
+        totals = sale_totals(
+            Sale.objects.filter(product_id__in=product_ids, date__gte=since, date__lt=until),
+            SaleItem.objects.filter(product_id__in=product_ids, invoice__date__gte=since, invoice__date__lt=until)
+        )
+
+        match = Q()
+        for day, product_id in chunk:
+            match |= Q(date=day, product_id=product_id)
+        DailyRollup.objects.filter(match).delete()
+        DailyRollup.objects.bulk_create([
+            DailyRollup(date=day, product_id=product_id, **totals[(day, product_id)])
+            for day, product_id in chunk if (day, product_id) in totals
+        ])
+    if keys:
+        bump_versions(DailyRollup)
+
+def refresh_journal_rollups(dates):
+    """
+    Recompute the journal rows of the given business dates from the money journal
+    """
+    dates = sorted(set(dates))
+    for i in range(0, len(dates), KEY_CHUNK):
+        chunk = dates[i:i + KEY_CHUNK]
+        since, until = day_bounds(chunk[0], chunk[-1])
+        totals = journal_totals(MoneyJournal.objects.filter(date__gte=since, date__lt=until))
+
+        wanted = set(chunk)
+        DailyRollup.objects.filter(product__isnull=True, date__in=chunk).delete()
+        DailyRollup.objects.bulk_create([
+            DailyRollup(date=day, category_id=category_id, **values)
+            for (day, category_id), values in totals.items() if day in wanted
+        ])
+    if dates:
+        bump_versions(DailyRollup)
+
+def refresh_rollups(sale_keys=(), journal_dates=()):
+    """
+    Bring the rollup rows touched by a write up to date; call inside the write's transaction
+    """
+    refresh_sale_rollups(sale_keys)
+    refresh_journal_rollups(journal_dates)
+
+def rebuild_rollups(product_ids=None, journal=True, batch_size=1000):
+    """
+    Recompute rollup rows from the full history: the sales rows of product_ids (all
+    products when None) and, with journal, every journal row
+    Rows of closed months are left as they were frozen
+    Returns the number of rows written
+    """
+    sales = Sale.objects.all()
+    items = SaleItem.objects.all()
+    journal_entries = MoneyJournal.objects.all()
+    rollups = DailyRollup.objects.filter(product__isnull=False)
+    journal_rollups = DailyRollup.objects.filter(product__isnull=True)
+    since = open_since()
+    if since is not None:
+        sales = sales.filter(date__gte=since)
+        items = items.filter(invoice__date__gte=since)
+        journal_entries = journal_entries.filter(date__gte=since)
+        rollups = rollups.filter(date__gte=business_date(since))
+        journal_rollups = journal_rollups.filter(date__gte=business_date(since))
+    if product_ids is not None:
+        sales = sales.filter(product_id__in=product_ids)
+        items = items.filter(product_id__in=product_ids)
+        rollups = rollups.filter(product_id__in=product_ids)
+
+    rows = [
+        DailyRollup(date=day, product_id=product_id, **values)
+        for (day, product_id), values in sale_totals(sales, items).items()
+    ]
+    rollups.delete()
+    if journal:
+        journal_rollups.delete()
+        rows += [
+            DailyRollup(date=day, category_id=category_id, **values)
+            for (day, category_id), values in journal_totals(journal_entries).items()
+        ]
+    DailyRollup.objects.bulk_create(rows, batch_size=batch_size)
+    bump_versions(DailyRollup)
+    return len(rows)
@@ -0,0 +1,39 @@
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete
+from .cache import bump_versions
+from .models import Product, Client, Sale, Invoice, SaleItem, InventoryMovement, MoneyJournal, DebtPayment, ExpenseCategory
+from .periods import closed_through, check_open
+
+# Models whose rows feed cached dashboard and report contexts; bulk writes bump their versions explicitly
+VERSIONED_MODELS = [Product, Client, Sale, Invoice, SaleItem, InventoryMovement, MoneyJournal, DebtPayment, ExpenseCategory]
+
+# Dated models whose writes are refused in closed periods; invoice lines are dated by their invoice
+DATED_MODELS = [Sale, Invoice, InventoryMovement, MoneyJournal, DebtPayment]
+
+def bump_model_version(sender, **kwargs):
+    bump_versions(sender)
+
+def refuse_closed_save(sender, instance, raw=False, **kwargs):
+    # Bulk writes (queryset.update, bulk_create) follow a guarded save of the record they belong to
+    boundary = None if raw else closed_through()
+    if boundary is None:
+        return
+    check_open(instance.date, boundary)
+    if instance.pk:
+        check_open(sender.objects.filter(pk=instance.pk).values_list('date', flat=True).first(), boundary)
+
+def refuse_closed_delete(sender, instance, **kwargs):
+    check_open(instance.date)
+
+def refuse_closed_item_write(sender, instance, raw=False, **kwargs):
+    if not raw:
+        check_open(instance.invoice.date)
+
+def connect_signals():
+    for model in VERSIONED_MODELS:
+        post_save.connect(bump_model_version, sender=model, dispatch_uid=f'bump_{model._meta.label_lower}_save')
+        post_delete.connect(bump_model_version, sender=model, dispatch_uid=f'bump_{model._meta.label_lower}_delete')
+    for model in DATED_MODELS:
+        pre_save.connect(refuse_closed_save, sender=model, dispatch_uid=f'closed_{model._meta.label_lower}_save')
+        pre_delete.connect(refuse_closed_delete, sender=model, dispatch_uid=f'closed_{model._meta.label_lower}_delete')
+    pre_save.connect(refuse_closed_item_write, sender=SaleItem, dispatch_uid='closed_shop.saleitem_save')
+    pre_delete.connect(refuse_closed_item_write, sender=SaleItem, dispatch_uid='closed_shop.saleitem_delete')
@@ -0,0 +1,116 @@
+import base64
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Product, Sale, Invoice, DebtPayment
+
+PAGE_SIZE = 50
+CENT = Decimal('0.01')
+
+# Ledger entry kinds; entries at the same instant are listed in this order
+KINDS = ('Sale', 'Invoice', 'Payment')
+
+def ledger_sql():
+    """
+    One row per credit sale, credit invoice and debt payment of a client
+    (params: client id three times) with what it charged and what was paid against it
+    Columns: date, seq, id, description, charge, paid
+    """
+    sale, product = Sale._meta.db_table, Product._meta.db_table
+    invoice, payment = Invoice._meta.db_table, DebtPayment._meta.db_table
+    return f"""
+        SELECT s.date AS date, 0 AS seq, s.id AS id, p.name AS description,
+               s.quantity * s.price_at_sale AS charge, s.amount_paid AS paid
+        FROM {sale} s JOIN {product} p ON p.id = s.product_id
+        WHERE s.client_id = %s AND s.is_credit
+        UNION ALL
+        SELECT i.date, 1, i.id, COALESCE(i.notes, ''), i.total_price, i.amount_paid
+        FROM {invoice} i
+        WHERE i.client_id = %s AND i.is_credit
+        UNION ALL
+        SELECT d.date, 2, d.id, COALESCE(d.notes, ''), 0, d.amount
+        FROM {payment} d
+        WHERE d.client_id = %s
+    """
+
+def encode_cursor(row):
+    value = f"{row['date'].isoformat()}|{row['seq']}|{row['id']}|{row['balance']}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    (date, seq, id, balance) of the last row of the previous page; ValueError if malformed
+    """
+    try:
+        date, seq, pk, balance = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        date = parse_datetime(date)
+        if date is None:
+            raise ValueError(cursor)
+        return date, int(seq), int(pk), Decimal(balance)
+    except (TypeError, ArithmeticError, UnicodeError) as e:
+        raise ValueError(cursor) from e
+
+def to_datetime(value):
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+def to_amount(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+def statement_page(client_id, cursor=None, size=PAGE_SIZE):
+    """
+    Up to size ledger rows after cursor (from the start when None), oldest first, each with
+    the client's running balance, and the cursor of the next page (None on the last one)
+    The balance is a window SUM over the rows after the cursor, started from the balance
+    carried in the cursor, so each page only reads its own rows
+    """
+    params = [client_id] * 3
+    where, opening = '', Decimal('0')
+    if cursor:
+        date, seq, pk, opening = decode_cursor(cursor)
+        date = connection.ops.adapt_datetimefield_value(date)
+        where = 'WHERE date > %s OR (date = %s AND (seq > %s OR (seq = %s AND id > %s)))'
+        params += [date, date, seq, seq, pk]
+    sql = f"""
+        SELECT date, seq, id, description, charge, paid,
+               SUM(charge - paid) OVER (ORDER BY date, seq, id ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+        FROM ({ledger_sql()}) ledger
+        {where}
+        ORDER BY date, seq, id
+        LIMIT %s
+    """
+    with connection.cursor() as db:
+        db.execute(sql, params + [size + 1])
+        fetched = db.fetchall()
+
+    rows = []
+    for date, seq, pk, description, charge, paid, movement in fetched[:size]:
+        rows.append({
+            'date': to_datetime(date),
+            'seq': seq,
+            'id': pk,
+            'kind': KINDS[seq],
+            'reference': f'{KINDS[seq]} #{pk}',
+            'description': description,
+            'charge': to_amount(charge),
+            'paid': to_amount(paid),
+            'balance': opening + to_amount(movement),
+        })
+    next_cursor = encode_cursor(rows[-1]) if len(fetched) > size else None
+    return rows, next_cursor
+
+def statement_rows(client_id, size=500):
+    """
+    Every ledger row of a client, oldest first, read one keyset page at a time
+    """
+    cursor = None
+    while True:
+        rows, cursor = statement_page(client_id, cursor, size)
+        yield from rows
+        if cursor is None:
+            return
@@ -1,7 +1,29 @@
-from django.test import TestCase
+import json
+from io import StringIO
+from unittest.mock import patch
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from decimal import Decimal
+from django.urls import reverse
+from django.db.models import Sum
 from django.utils import timezone
-from .models import Product, InventoryMovement
+from .models import Product, InsufficientStock, InventoryMovement, FifoLayer, FifoAllocation, Sale, Invoice, SaleItem, MoneyJournal, ExpenseCategory, DailyRollup, Client, DebtPayment, PeriodSnapshot, PeriodClosed, CacheVersion
+from .fifo import recost_product
+from .costing import consume_stock, receive_stock
+from .checkout import CheckoutLine, checkout_invoice, update_invoice_lines, return_invoice_stock
+from .db import write_transaction, lock_stats, reset_lock_stats
+from .benchmarks import growth_exponents
+from .reports import chart_series
+from .rollups import rebuild_rollups, refresh_rollups, sale_key, business_date
+from .cache import cached_context, bump_versions
+from .statements import statement_page, statement_rows
+from .aging import aging_rows
+from .periods import close_period, month_start
+from .forms import MoneyJournalForm
 
 class FIFOTestCase(TestCase):
     def setUp(self):
@@ -12,104 +34,1144 @@ class FIFOTestCase(TestCase):
             cost_price=Decimal('30.00')
         )
 
-    def test_get_fifo_cost_price_no_movements(self):
-        # Should fallback to product base cost price
-        cost = self.product.get_fifo_cost_price(5)
-        self.assertEqual(cost, Decimal('30.00'))
-
-    def test_get_fifo_cost_price_single_batch(self):
-        InventoryMovement.objects.create(
+    def stock_in(self, quantity, cost_price, days_ago=0):
+        movement = InventoryMovement.objects.create(
             product=self.product,
             movement_type='IN',
-            quantity=10,
-            remaining_quantity=10,
-            cost_price=Decimal('25.00')
+            quantity=quantity,
+            cost_price=cost_price,
+            date=timezone.now() - timezone.timedelta(days=days_ago)
         )
-        cost = self.product.get_fifo_cost_price(5)
-        self.assertEqual(cost, Decimal('25.00'))
+        self.product.add_fifo_layer(movement)
+        return movement
 
-    def test_get_fifo_cost_price_multiple_batches(self):
-        InventoryMovement.objects.create(
-            product=self.product,
-            movement_type='IN',
-            quantity=10,
-            remaining_quantity=10,
-            cost_price=Decimal('20.00'),
-            date=timezone.now() - timezone.timedelta(days=2)
-        )
-        InventoryMovement.objects.create(
-            product=self.product,
-            movement_type='IN',
-            quantity=10,
-            remaining_quantity=10,
-            cost_price=Decimal('40.00'),
-            date=timezone.now() - timezone.timedelta(days=1)
-        )
+    def test_consume_fifo_no_movements(self):
+        # Should fallback to product base cost price
+        consumption = self.product.consume_fifo(5)
+        self.assertEqual(consumption.cost_price, Decimal('30.00'))
+        self.assertEqual(consumption.allocations, [])
+        self.assertEqual(consumption.shortfall, 5)
+
+    def test_consume_fifo_single_batch(self):
+        self.stock_in(10, Decimal('25.00'))
+        consumption = self.product.consume_fifo(5)
+        self.assertEqual(consumption.cost_price, Decimal('25.00'))
+        self.assertEqual(consumption.shortfall, 0)
+
+    def test_consume_fifo_multiple_batches(self):
+        self.stock_in(10, Decimal('20.00'), days_ago=2)
+        self.stock_in(10, Decimal('40.00'), days_ago=1)
         
         # Taking 15 items: 10 @ 20.00 and 5 @ 40.00
         # Total cost = 400. Avg cost = 400 / 15
-        cost = float(self.product.get_fifo_cost_price(15))
+        cost = float(self.product.consume_fifo(15).cost_price)
         self.assertAlmostEqual(cost, 400.0 / 15.0, places=4)
 
-    def test_get_fifo_cost_price_not_enough_stock(self):
-        InventoryMovement.objects.create(
-            product=self.product,
-            movement_type='IN',
-            quantity=10,
-            remaining_quantity=10,
-            cost_price=Decimal('20.00')
-        )
+    def test_consume_fifo_not_enough_stock(self):
+        self.stock_in(10, Decimal('20.00'))
         # Taking 15 items but only 10 in stock
         # Should average the cost of available stock
-        cost = self.product.get_fifo_cost_price(15)
-        self.assertEqual(cost, Decimal('20.00'))
+        consumption = self.product.consume_fifo(15)
+        self.assertEqual(consumption.cost_price, Decimal('20.00'))
+        self.assertEqual(consumption.shortfall, 5)
 
-    def test_deduct_from_batches_exact(self):
-        mov1 = InventoryMovement.objects.create(
-            product=self.product,
-            movement_type='IN',
-            quantity=10,
-            remaining_quantity=10,
-            cost_price=Decimal('20.00'),
-            date=timezone.now() - timezone.timedelta(days=2)
-        )
-        mov2 = InventoryMovement.objects.create(
-            product=self.product,
-            movement_type='IN',
-            quantity=10,
-            remaining_quantity=10,
-            cost_price=Decimal('40.00'),
-            date=timezone.now() - timezone.timedelta(days=1)
-        )
+    def test_consume_fifo_deducts_exact(self):
+        mov1 = self.stock_in(10, Decimal('20.00'), days_ago=2)
+        mov2 = self.stock_in(10, Decimal('40.00'), days_ago=1)
         
-        deductions = self.product.deduct_from_batches(15)
+        deductions = self.product.consume_fifo(15).allocations
         
         # Should deduct 10 from mov1 and 5 from mov2
         self.assertEqual(len(deductions), 2)
-        self.assertEqual(deductions[0][0], mov1)
+        self.assertEqual(deductions[0][0].movement_id, mov1.id)
         self.assertEqual(deductions[0][1], 10)
-        self.assertEqual(deductions[1][0], mov2)
+        self.assertEqual(deductions[1][0].movement_id, mov2.id)
         self.assertEqual(deductions[1][1], 5)
         
-        # Verify db state
-        mov1.refresh_from_db()
-        mov2.refresh_from_db()
-        self.assertEqual(mov1.remaining_quantity, 0)
-        self.assertEqual(mov2.remaining_quantity, 5)
-
-    def test_deduct_from_batches_more_than_stock(self):
-        mov = InventoryMovement.objects.create(
-            product=self.product,
-            movement_type='IN',
-            quantity=10,
-            remaining_quantity=10,
-            cost_price=Decimal('20.00')
-        )
+        # Verify db state: the emptied layer is gone, the other one shrank
+        self.assertFalse(FifoLayer.objects.filter(movement=mov1).exists())
+        self.assertEqual(FifoLayer.objects.get(movement=mov2).remaining_quantity, 5)
+
+    def test_consume_fifo_deducts_more_than_stock(self):
+        mov = self.stock_in(10, Decimal('20.00'))
         
-        deductions = self.product.deduct_from_batches(15)
+        deductions = self.product.consume_fifo(15).allocations
         
         self.assertEqual(len(deductions), 1)
         self.assertEqual(deductions[0][1], 10)
-        
-        mov.refresh_from_db()
-        self.assertEqual(mov.remaining_quantity, 0)
+        self.assertFalse(FifoLayer.objects.filter(movement=mov).exists())
+
+    def test_consume_fifo_single_read_and_bulk_write(self):
+        for days in (3, 2, 1):
+            self.stock_in(10, Decimal('20.00'), days_ago=days)
+
+        # One read of the open layers, one delete of the emptied ones and
+        # one update of the partially consumed one
+        with self.assertNumQueries(3):
+            consumption = self.product.consume_fifo(25)
+
+        self.assertEqual(len(consumption.allocations), 3)
+        self.assertEqual(consumption.cost_price, Decimal('20.00'))
+        self.assertEqual(self.product.fifo_layers.count(), 1)
+
+    def test_consume_fifo_ignores_movement_history(self):
+        self.stock_in(10, Decimal('20.00'), days_ago=1)
+        InventoryMovement.objects.create(
+            product=self.product,
+            movement_type='OUT',
+            quantity=10
+        )
+        self.product.consume_fifo(10)
+
+        # Layers are removed once empty, the movement history stays intact
+        self.assertEqual(self.product.fifo_layers.count(), 0)
+        self.assertEqual(self.product.movements.count(), 2)
+
+class FifoAllocationTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Brake Pad",
+            current_stock=20,
+            unit_price=Decimal('50.00'),
+            cost_price=Decimal('30.00')
+        )
+        self.batches = []
+        for days, cost in ((2, Decimal('20.00')), (1, Decimal('40.00'))):
+            movement = InventoryMovement.objects.create(
+                product=self.product,
+                movement_type='IN',
+                quantity=10,
+                cost_price=cost,
+                date=timezone.now() - timezone.timedelta(days=days)
+            )
+            self.product.add_fifo_layer(movement)
+            self.batches.append(movement)
+        self.sale = Sale.objects.create(
+            product=self.product,
+            quantity=15,
+            price_at_sale=Decimal('50.00')
+        )
+
+    def test_record_allocations_per_batch(self):
+        consumption = self.product.consume_fifo(15)
+        FifoAllocation.record(consumption.allocations, sale=self.sale)
+
+        allocations = self.sale.fifo_allocations.order_by('batch__date')
+        self.assertEqual(
+            [(a.batch_id, a.quantity) for a in allocations],
+            [(self.batches[0].id, 10), (self.batches[1].id, 5)]
+        )
+
+    def test_release_restores_exact_layers(self):
+        consumption = self.product.consume_fifo(15)
+        FifoAllocation.record(consumption.allocations, sale=self.sale)
+        movement_count = InventoryMovement.objects.count()
+
+        FifoAllocation.release(self.sale.fifo_allocations.all())
+
+        # The emptied layer is reopened from its batch, the partial one grows back
+        layers = list(self.product.fifo_layers.order_by('date'))
+        self.assertEqual([layer.movement_id for layer in layers], [b.id for b in self.batches])
+        self.assertEqual([layer.remaining_quantity for layer in layers], [10, 10])
+        self.assertEqual(layers[0].cost_price, Decimal('20.00'))
+        self.assertFalse(self.sale.fifo_allocations.exists())
+        # No compensation movements are added
+        self.assertEqual(InventoryMovement.objects.count(), movement_count)
+
+class RecostTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Filter",
+            current_stock=0,
+            unit_price=Decimal('50.00'),
+            cost_price=Decimal('30.00')
+        )
+
+    def stock_in(self, quantity, cost_price, days_ago):
+        movement = InventoryMovement.objects.create(
+            product=self.product,
+            movement_type='IN',
+            quantity=quantity,
+            cost_price=cost_price,
+            date=timezone.now() - timezone.timedelta(days=days_ago)
+        )
+        self.product.add_fifo_layer(movement)
+        return movement
+
+    def sell(self, quantity, days_ago):
+        sale = Sale.objects.create(
+            product=self.product,
+            quantity=quantity,
+            price_at_sale=Decimal('50.00'),
+            date=timezone.now() - timezone.timedelta(days=days_ago)
+        )
+        consumption = self.product.consume_fifo(quantity)
+        FifoAllocation.record(consumption.allocations, sale=sale)
+        sale.cost_price = consumption.cost_price
+        sale.save()
+        return sale
+
+    def test_backdated_stock_in_recosts_later_sales(self):
+        early_sale_batch = self.stock_in(2, Decimal('10.00'), days_ago=10)
+        early_sale = self.sell(2, days_ago=9)
+        late_batch = self.stock_in(10, Decimal('40.00'), days_ago=2)
+        sale = self.sell(5, days_ago=1)
+        self.assertEqual(sale.cost_price, Decimal('40.00'))
+
+        backdated = self.stock_in(10, Decimal('20.00'), days_ago=3)
+        self.assertEqual(recost_product(self.product, backdated.date), 1)
+
+        sale.refresh_from_db()
+        self.assertEqual(sale.cost_price, Decimal('20.00'))
+        self.assertEqual(
+            [(a.batch_id, a.quantity) for a in sale.fifo_allocations.all()],
+            [(backdated.id, 5)]
+        )
+        self.assertEqual(FifoLayer.objects.get(movement=backdated).remaining_quantity, 5)
+        self.assertEqual(FifoLayer.objects.get(movement=late_batch).remaining_quantity, 10)
+
+        # Consumptions before the backdated date are not replayed
+        early_sale.refresh_from_db()
+        self.assertEqual(early_sale.cost_price, Decimal('10.00'))
+        self.assertEqual(early_sale.fifo_allocations.get().batch_id, early_sale_batch.id)
+
+    def test_unallocated_consumption_falls_back_to_a_full_rebuild(self):
+        self.stock_in(10, Decimal('40.00'), days_ago=3)
+        legacy = self.sell(5, days_ago=2)
+        # A sale from before allocations were recorded
+        legacy.fifo_allocations.all().delete()
+
+        backdated = self.stock_in(10, Decimal('20.00'), days_ago=4)
+        self.assertEqual(recost_product(self.product, backdated.date), 1)
+
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.cost_price, Decimal('20.00'))
+        self.assertEqual(sum(layer.remaining_quantity for layer in self.product.fifo_layers.all()), 15)
+
+    def test_recost_without_later_consumption_is_a_noop(self):
+        self.stock_in(10, Decimal('40.00'), days_ago=2)
+        backdated = self.stock_in(10, Decimal('20.00'), days_ago=3)
+        with self.assertNumQueries(3):
+            self.assertEqual(recost_product(self.product, backdated.date), 0)
+
+    def test_rebuild_fifo_command(self):
+        first = self.stock_in(10, Decimal('20.00'), days_ago=3)
+        second = self.stock_in(10, Decimal('40.00'), days_ago=2)
+        sale = self.sell(12, days_ago=1)
+
+        # Simulate drift from a data repair: wrong cost, lost allocations and layers
+        Sale.objects.filter(pk=sale.pk).update(cost_price=Decimal('99.00'))
+        FifoAllocation.objects.all().delete()
+        FifoLayer.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_fifo', dry_run=True, workers=1, stdout=out)
+        self.assertIn('FILTER: 1 sale cost(s)', out.getvalue())
+        sale.refresh_from_db()
+        self.assertEqual(sale.cost_price, Decimal('99.00'))
+
+        call_command('rebuild_fifo', workers=1, stdout=StringIO())
+        sale.refresh_from_db()
+        self.assertEqual(sale.cost_price, Decimal('23.33'))
+        self.assertEqual(
+            sorted((a.batch_id, a.quantity) for a in sale.fifo_allocations.all()),
+            [(first.id, 10), (second.id, 2)]
+        )
+        self.assertEqual(
+            list(self.product.fifo_layers.values_list('movement_id', 'remaining_quantity')),
+            [(second.id, 8)]
+        )
+
+    def test_rebuild_skips_legacy_invoice_edit_reversals(self):
+        self.stock_in(10, Decimal('20.00'), days_ago=3)
+        invoice = Invoice.objects.create(date=timezone.now() - timezone.timedelta(days=2))
+        # An invoice edited by the old code: its first OUT stayed, a compensating IN put the line back
+        for movement_type, reference in (('OUT', None), ('IN', f'Invoice #{invoice.id} edited (revert)'), ('OUT', None)):
+            InventoryMovement.objects.create(
+                product=self.product, invoice=invoice if movement_type == 'OUT' else None, movement_type=movement_type,
+                quantity=3, cost_price=Decimal('20.00'), reference=reference, date=invoice.date
+            )
+        SaleItem.objects.create(invoice=invoice, product=self.product, quantity=3, price_at_sale=Decimal('50.00'))
+        Product.objects.filter(pk=self.product.pk).update(current_stock=7)
+
+        out = StringIO()
+        call_command('rebuild_fifo', workers=1, stdout=out)
+        self.assertNotIn('off current stock', out.getvalue())
+        self.assertEqual(sum(layer.remaining_quantity for layer in self.product.fifo_layers.all()), 7)
+
+        Product.objects.filter(pk=self.product.pk).update(current_stock=9)
+        out = StringIO()
+        call_command('rebuild_fifo', dry_run=True, workers=1, stdout=out)
+        self.assertIn('FILTER: rebuilt layers are -2.00 off current stock', out.getvalue())
+
+class CostingStrategyTestCase(TestCase):
+    def make_product(self, costing_method):
+        return Product.objects.create(
+            name="Coolant",
+            current_stock=0,
+            unit_price=Decimal('50.00'),
+            cost_price=Decimal('30.00'),
+            costing_method=costing_method
+        )
+
+    def stock_in(self, product, quantity, cost_price, days_ago=0, expiry_date=None):
+        movement = InventoryMovement.objects.create(
+            product=product,
+            movement_type='IN',
+            quantity=quantity,
+            cost_price=cost_price,
+            expiry_date=expiry_date,
+            date=timezone.now() - timezone.timedelta(days=days_ago)
+        )
+        receive_stock(product, movement)
+        product.current_stock += quantity
+        product.save()
+        return movement
+
+    def test_fefo_consumes_earliest_expiry_first(self):
+        product = self.make_product('FEFO')
+        today = timezone.now().date()
+        self.stock_in(product, 10, Decimal('20.00'), days_ago=3, expiry_date=today + timezone.timedelta(days=90))
+        self.stock_in(product, 10, Decimal('25.00'), days_ago=2)
+        expiring = self.stock_in(product, 10, Decimal('40.00'), days_ago=1, expiry_date=today + timezone.timedelta(days=10))
+
+        consumption = consume_stock(product, 5)
+
+        self.assertEqual(consumption.cost_price, Decimal('40.00'))
+        self.assertEqual(consumption.allocations[0][0].movement_id, expiring.id)
+
+    def test_moving_average_skips_layers(self):
+        product = self.make_product('AVG')
+        self.stock_in(product, 10, Decimal('20.00'))
+        self.stock_in(product, 30, Decimal('40.00'))
+
+        product.refresh_from_db()
+        self.assertEqual(product.average_cost, Decimal('35.00'))
+        self.assertFalse(product.fifo_layers.exists())
+
+        with self.assertNumQueries(0):
+            consumption = consume_stock(product, 15)
+        self.assertEqual(consumption.cost_price, Decimal('35.00'))
+        self.assertEqual(consumption.allocations, [])
+
+    def edit_method(self, product, costing_method):
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        return self.client.post(reverse('product_update', args=[product.pk]), {
+            'name': product.name, 'current_stock': product.current_stock, 'unit_price': product.unit_price,
+            'cost_price': product.cost_price, 'costing_method': costing_method,
+        })
+
+    def test_switch_to_moving_average_starts_from_open_layers(self):
+        product = self.make_product('FIFO')
+        self.stock_in(product, 10, Decimal('20.00'))
+        self.stock_in(product, 30, Decimal('40.00'))
+
+        self.edit_method(product, 'AVG')
+        product.refresh_from_db()
+        self.assertEqual((product.costing_method, product.average_cost), ('AVG', Decimal('35.00')))
+        self.assertFalse(product.fifo_layers.exists())
+
+    def test_sale_deleted_after_switch_to_moving_average_opens_no_layer(self):
+        product = self.make_product('FIFO')
+        self.stock_in(product, 10, Decimal('20.00'))
+        sale = Sale.objects.create(product=product, quantity=4, price_at_sale=Decimal('50.00'))
+        FifoAllocation.record(consume_stock(product, 4).allocations, sale=sale)
+        product.remove_stock(4)
+        self.edit_method(product, 'AVG')
+
+        self.client.post(reverse('sale_delete', args=[sale.pk]))
+        product.refresh_from_db()
+        self.assertEqual(product.current_stock, 10)
+        self.assertFalse(product.fifo_layers.exists())
+        self.assertFalse(FifoAllocation.objects.exists())
+
+    def test_switch_onto_layers_is_refused_while_stock_is_held(self):
+        product = self.make_product('AVG')
+        self.stock_in(product, 10, Decimal('20.00'))
+
+        response = self.edit_method(product, 'FIFO')
+        self.assertIn('costing_method', response.context['form'].errors)
+        product.refresh_from_db()
+        self.assertEqual(product.costing_method, 'AVG')
+
+class CheckoutTestCase(TestCase):
+    def setUp(self):
+        self.products = []
+        for i in range(10):
+            product = Product.objects.create(
+                name=f"Part {i}",
+                current_stock=20,
+                unit_price=Decimal('50.00'),
+                cost_price=Decimal('30.00')
+            )
+            for days, cost in ((2, Decimal('20.00')), (1, Decimal('40.00'))):
+                movement = InventoryMovement.objects.create(
+                    product=product,
+                    movement_type='IN',
+                    quantity=10,
+                    cost_price=cost,
+                    date=timezone.now() - timezone.timedelta(days=days)
+                )
+                product.add_fifo_layer(movement)
+            self.products.append(product)
+
+    def checkout(self, products):
+        invoice = Invoice.objects.create()
+        lines = [CheckoutLine(product.id, Decimal('15'), Decimal('60.00')) for product in products]
+        with CaptureQueriesContext(connection) as queries:
+            items, total = checkout_invoice(invoice, lines, reference=f'Invoice #{invoice.id}')
+        return invoice, items, total, len(queries)
+
+    def test_checkout_costs_and_stock(self):
+        invoice, items, total, _ = self.checkout(self.products[:2])
+
+        self.assertEqual(total, Decimal('1800.00'))
+        self.assertAlmostEqual(float(items[0].cost_price), (10 * 20 + 5 * 40) / 15, places=4)
+        self.assertEqual(invoice.total_price, total)
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).total_cost, sum(item.total_cost for item in items))
+        self.assertEqual(items[0].fifo_allocations.count(), 2)
+        self.assertEqual(invoice.inventory_movements.filter(movement_type='OUT').count(), 2)
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].current_stock, 5)
+        self.assertEqual(self.products[0].fifo_layers.get().remaining_quantity, 5)
+
+    def test_checkout_query_count_is_constant(self):
+        _, _, _, small = self.checkout(self.products[:2])
+        _, _, _, large = self.checkout(self.products[2:])
+        self.assertEqual(small, large)
+
+    def test_checkout_rejects_insufficient_stock(self):
+        invoice = Invoice.objects.create()
+        lines = [
+            CheckoutLine(self.products[0].id, Decimal('15'), Decimal('60.00')),
+            CheckoutLine(self.products[0].id, Decimal('10'), Decimal('60.00')),
+        ]
+        with self.assertRaises(ValueError):
+            checkout_invoice(invoice, lines, reference='Invoice')
+        self.assertFalse(invoice.items.exists())
+
+    def test_return_invoice_stock(self):
+        invoice, _, _, _ = self.checkout(self.products[:3])
+        return_invoice_stock(invoice)
+
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].current_stock, 20)
+        self.assertEqual(
+            sorted(self.products[0].fifo_layers.values_list('remaining_quantity', flat=True)),
+            [10, 10]
+        )
+
+    def test_update_invoice_lines_applies_only_the_difference(self):
+        invoice, items, _, _ = self.checkout(self.products[:2])
+        movements = set(InventoryMovement.objects.values_list('pk', flat=True))
+        lines = [
+            CheckoutLine(self.products[0].id, Decimal('12'), Decimal('60.00')),
+            CheckoutLine(self.products[1].id, Decimal('15'), Decimal('55.00')),
+            CheckoutLine(self.products[2].id, Decimal('5'), Decimal('60.00')),
+        ]
+        total = update_invoice_lines(invoice, lines, reference='Edited')
+
+        self.assertEqual(total, Decimal('1845.00'))
+        self.assertEqual(invoice.total_price, total)
+        kept = {item.pk: item for item in invoice.items.all()}
+        self.assertEqual(len(kept), 3)
+        # Edited lines keep their items and movements
+        self.assertEqual(kept[items[0].pk].quantity, 12)
+        # The last 3 units taken (at 40) went back, leaving 10 @ 20 + 2 @ 40
+        self.assertEqual(kept[items[0].pk].cost_price, Decimal('23.33'))
+        self.assertEqual(kept[items[1].pk].price_at_sale, Decimal('55.00'))
+        self.assertEqual(InventoryMovement.objects.exclude(pk__in=movements).count(), 1)
+        self.assertEqual(invoice.inventory_movements.get(product=self.products[0]).quantity, 12)
+
+        stock = dict(Product.objects.values_list('pk', 'current_stock'))
+        self.assertEqual([stock[p.pk] for p in self.products[:3]], [8, 5, 15])
+        self.assertEqual(self.products[0].fifo_layers.get().remaining_quantity, 8)
+
+    def test_update_invoice_lines_grows_and_removes(self):
+        invoice, items, _, _ = self.checkout(self.products[:2])
+        update_invoice_lines(invoice, [CheckoutLine(self.products[0].id, Decimal('18'), Decimal('60.00'))], 'Edited')
+
+        item = invoice.items.get()
+        self.assertEqual(item.pk, items[0].pk)
+        # 15 units costed at 26.67 and 3 more at 40
+        self.assertEqual(item.cost_price, Decimal('28.89'))
+        self.assertEqual(item.fifo_allocations.aggregate(total=Sum('quantity'))['total'], 18)
+        stock = dict(Product.objects.values_list('pk', 'current_stock'))
+        self.assertEqual((stock[self.products[0].pk], stock[self.products[1].pk]), (2, 20))
+        self.assertFalse(invoice.inventory_movements.filter(product=self.products[1]).exists())
+
+class StockUpdateTestCase(TestCase):
+    def setUp(self):
+        self.products = [
+            Product.objects.create(name=f"Filter {i}", current_stock=10, unit_price=Decimal('50.00'))
+            for i in range(3)
+        ]
+
+    def test_adjust_stock_in_one_query(self):
+        with self.assertNumQueries(1):
+            Product.adjust_stock({self.products[0].pk: -4, self.products[1].pk: 6, self.products[2].pk: -10})
+        stock = dict(Product.objects.values_list('pk', 'current_stock'))
+        self.assertEqual([stock[p.pk] for p in self.products], [6, 16, 0])
+
+    def test_remove_stock_is_guarded(self):
+        stale = Product.objects.get(pk=self.products[0].pk)
+        self.products[0].remove_stock(8)
+        # The stale copy still believes 10 are available, the database knows better
+        with self.assertRaisesMessage(InsufficientStock, "Not enough stock for FILTER 0"):
+            stale.remove_stock(5)
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].current_stock, 2)
+
+    def test_stale_layer_is_not_consumed_twice(self):
+        product = self.products[0]
+        movement = InventoryMovement.objects.create(
+            product=product, movement_type='IN', quantity=10, cost_price=Decimal('20.00')
+        )
+        product.add_fifo_layer(movement)
+        stale = FifoLayer.objects.get(movement=movement)
+        product.consume_fifo(6)
+        stale.remaining_quantity -= 6
+        with self.assertRaises(InsufficientStock):
+            FifoLayer.save_allocations([(stale, 6)])
+        self.assertEqual(FifoLayer.objects.get(movement=movement).remaining_quantity, 4)
+
+    def test_emptied_layer_is_only_deleted_while_unchanged(self):
+        product = self.products[0]
+        movement = InventoryMovement.objects.create(
+            product=product, movement_type='IN', quantity=5, cost_price=Decimal('20.00')
+        )
+        product.add_fifo_layer(movement)
+        layer = FifoLayer.objects.get(movement=movement)
+        layer.remaining_quantity = 0
+
+        # Another writer took 3 of the 5 read: taking all 5 must be refused, not delete the layer
+        FifoLayer.objects.filter(pk=layer.pk).update(remaining_quantity=2)
+        with self.assertRaises(InsufficientStock), transaction.atomic():
+            FifoLayer.save_allocations([(layer, 5)])
+        self.assertEqual(FifoLayer.objects.get(pk=layer.pk).remaining_quantity, 2)
+
+        # A concurrent restore raised it to 7: the 5 are taken and 2 stay open
+        FifoLayer.objects.filter(pk=layer.pk).update(remaining_quantity=7)
+        FifoLayer.save_allocations([(layer, 5)])
+        self.assertEqual(FifoLayer.objects.get(pk=layer.pk).remaining_quantity, 2)
+
+        # Unchanged since it was read: the emptied layer is removed
+        FifoLayer.objects.filter(pk=layer.pk).update(remaining_quantity=5)
+        FifoLayer.save_allocations([(layer, 5)])
+        self.assertFalse(FifoLayer.objects.filter(pk=layer.pk).exists())
+
+class WriteTransactionTestCase(TransactionTestCase):
+    def setUp(self):
+        reset_lock_stats()
+        self.product = Product.objects.create(name="Spark Plug", current_stock=10, unit_price=Decimal('5.00'))
+
+    def test_locked_transaction_is_retried_from_the_start(self):
+        calls = []
+
+        @write_transaction(base_delay=0)
+        def sell():
+            calls.append(1)
+            self.product.remove_stock(1)
+            if len(calls) < 3:
+                raise OperationalError("database is locked")
+
+        with self.assertLogs('shop.db', 'WARNING') as logs:
+            sell()
+        self.assertEqual([record.levelname for record in logs.records], ['WARNING', 'WARNING'])
+        self.assertIn('database is locked, retry 2', logs.output[-1])
+        self.product.refresh_from_db()
+        # The two locked attempts were rolled back, only the last one counts
+        self.assertEqual(self.product.current_stock, 9)
+        self.assertEqual(len(calls), 3)
+        stats = lock_stats()
+        self.assertEqual((stats['transactions'], stats['retries'], stats['failures']), (1, 2, 0))
+
+    def test_gives_up_after_the_last_attempt(self):
+        @write_transaction(attempts=2, base_delay=0)
+        def locked():
+            raise OperationalError("database is locked")
+
+        with self.assertLogs('shop.db', 'WARNING') as logs, self.assertRaises(OperationalError):
+            locked()
+        self.assertEqual([record.levelname for record in logs.records], ['WARNING', 'ERROR'])
+        self.assertIn('gave up after 2 locked attempts', logs.output[-1])
+        self.assertEqual(lock_stats()['failures'], 1)
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        @write_transaction
+        def broken():
+            calls.append(1)
+            raise OperationalError("no such table: shop_missing")
+
+        with self.assertRaises(OperationalError):
+            broken()
+        self.assertEqual(len(calls), 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_retried_invoice_edit_starts_from_the_stored_invoice(self):
+        first, second = Client.objects.create(name="First"), Client.objects.create(name="Second")
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        self.client.post(reverse('invoice_create'), json.dumps({
+            'client_id': first.pk, 'is_credit': True, 'amount_paid': '0', 'date': '2026-10-01',
+            'items': [{'product_id': self.product.pk, 'quantity': '2', 'price': '10.00'}],
+        }), content_type='application/json')
+        invoice = Invoice.objects.get()
+
+        attempts = []
+        def locked_once(*args, **kwargs):
+            total = update_invoice_lines(*args, **kwargs)
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise OperationalError("database is locked")
+            return total
+
+        with patch('shop.views.update_invoice_lines', locked_once), self.assertLogs('shop.db', 'WARNING') as logs:
+            response = self.client.post(reverse('invoice_update', args=[invoice.pk]), json.dumps({
+                'client_id': second.pk, 'is_credit': True, 'amount_paid': '0', 'date': '2026-10-05',
+                'items': [{'product_id': self.product.pk, 'quantity': '2', 'price': '10.00'}],
+            }), content_type='application/json')
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('InvoiceUpdateView.save_invoice: database is locked, retry 1', logs.output[0])
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.balance, second.balance), (0, Decimal('20.00')))
+        self.assertEqual(
+            {timezone.localdate(date) for date in invoice.inventory_movements.values_list('date', flat=True)},
+            {timezone.datetime(2026, 10, 5).date()}
+        )
+
+class BenchmarkTestCase(TestCase):
+    def test_growth_exponents(self):
+        self.assertEqual(growth_exponents([10, 100, 1000], [1.0, 1.0, 10.0]), [0.0, 1.0])
+
+    def test_benchmark_fifo_command_reports_and_rolls_back(self):
+        out = StringIO()
+        call_command('benchmark_fifo', sizes=[5, 50], repeat=1, tolerance=10, json=True, stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertTrue(report['ok'])
+        self.assertEqual(set(report['operations']), {'lookup', 'deduct', 'reverse', 'rebuild'})
+        self.assertEqual(report['movements'], {'5': 15, '50': 150})
+        self.assertFalse(Product.objects.filter(name__startswith='BENCHMARK').exists())
+        self.assertFalse(InventoryMovement.objects.exists())
+
+class DashboardChartTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Brake Pad", current_stock=100, unit_price=Decimal('50.00'), cost_price=Decimal('30.00')
+        )
+        self.today = timezone.localdate()
+        now = timezone.now()
+        Sale.objects.create(product=self.product, quantity=4, price_at_sale=Decimal('50.00'),
+                            cost_price=Decimal('20.00'), date=now)
+        # No cost recorded: falls back to quantity * the product's cost price
+        Sale.objects.create(product=self.product, quantity=1, price_at_sale=Decimal('50.00'),
+                            date=now - timezone.timedelta(days=2))
+        invoice = Invoice.objects.create(date=now)
+        SaleItem.objects.create(invoice=invoice, product=self.product, quantity=2,
+                                price_at_sale=Decimal('60.00'), cost_price=Decimal('25.00'))
+        MoneyJournal.objects.create(entry_type='Expense', amount=Decimal('15.00'), date=now)
+        rebuild_rollups()
+
+    def test_chart_series_in_one_query(self):
+        with self.assertNumQueries(1):
+            series = chart_series(days=7, end=self.today)
+
+        self.assertEqual(len(series['labels']), 7)
+        self.assertEqual(series['sales'][-1], 320.0)
+        # 320 revenue - (4 * 20 + 2 * 25) COGS - 15 expenses
+        self.assertEqual(series['profit'][-1], 175.0)
+        self.assertEqual(series['expenses'][-1], 15.0)
+        self.assertEqual(series['profit'][-3], 20.0)
+        self.assertEqual(series['sales'][0], 0.0)
+
+    def test_chart_series_any_window(self):
+        series = chart_series(days=30, end=self.today)
+        self.assertEqual(len(series['sales']), 30)
+        self.assertEqual(sum(series['sales']), 370.0)
+
+    def test_chart_granularity(self):
+        weekly = chart_series(days=90, end=self.today)
+        self.assertEqual(weekly['granularity'], 'week')
+        self.assertIn(len(weekly['labels']), (13, 14))
+        self.assertEqual(sum(weekly['sales']), 370.0)
+
+        monthly = chart_series(days=365, end=self.today)
+        self.assertEqual(monthly['granularity'], 'month')
+        self.assertEqual(monthly['labels'][-1], self.today.strftime('%b %Y'))
+        self.assertEqual(sum(monthly['sales']), 370.0)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_chart_endpoint(self):
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        data = self.client.get(reverse('dashboard_chart'), {'days': 30}).json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['granularity'], 'day')
+        self.assertEqual(data['sales'][-1], 320.0)
+
+        response = self.client.get(reverse('dashboard_chart'), {'days': 12})
+        self.assertEqual(response.status_code, 400)
+
+class DailyRollupTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Wiper", current_stock=100, unit_price=Decimal('20.00'), cost_price=Decimal('12.00')
+        )
+        self.sale = Sale.objects.create(product=self.product, quantity=3, price_at_sale=Decimal('20.00'),
+                                        cost_price=Decimal('10.00'))
+
+    def test_refresh_moves_sale_between_days(self):
+        old_key = sale_key(self.sale)
+        refresh_rollups([old_key])
+        row = DailyRollup.objects.get(product=self.product)
+        self.assertEqual((row.quantity, row.revenue, row.cogs), (3, 60, 30))
+
+        self.sale.date -= timezone.timedelta(days=3)
+        self.sale.save()
+        refresh_rollups({old_key, sale_key(self.sale)})
+        row = DailyRollup.objects.get(product=self.product)
+        self.assertEqual(row.date, business_date(self.sale.date))
+
+    def test_journal_rows_per_category(self):
+        entry = MoneyJournal.objects.create(entry_type='Expense', amount=Decimal('8.00'))
+        MoneyJournal.objects.create(entry_type='Income', amount=Decimal('60.00'))
+        refresh_rollups(journal_dates=[business_date(entry.date)])
+        row = DailyRollup.objects.get(product__isnull=True)
+        self.assertEqual((row.income, row.expenses), (60, 8))
+
+    def test_recost_updates_rollups(self):
+        refresh_rollups([sale_key(self.sale)])
+        movement = InventoryMovement.objects.create(
+            product=self.product, movement_type='IN', quantity=10, cost_price=Decimal('5.00'),
+            date=self.sale.date - timezone.timedelta(days=1)
+        )
+        receive_stock(self.product, movement)
+        recost_product(self.product, movement.date)
+        self.assertEqual(DailyRollup.objects.get(product=self.product).cogs, 15)
+
+    def test_backfill_rollups_command(self):
+        out = StringIO()
+        call_command('backfill_rollups', stdout=out)
+        self.assertIn('Wrote 1 rollup row(s)', out.getvalue())
+        self.assertEqual(DailyRollup.objects.get(product=self.product).revenue, 60)
+
+class ClientBalanceTestCase(TestCase):
+    def setUp(self):
+        self.client_record = Client.objects.create(name="Garage Ltd")
+        self.product = Product.objects.create(name="Belt", current_stock=50, unit_price=Decimal('40.00'))
+        Sale.objects.create(product=self.product, client=self.client_record, quantity=5, price_at_sale=Decimal('40.00'),
+                            is_credit=True, amount_paid=Decimal('50.00'))
+        Sale.objects.create(product=self.product, client=self.client_record, quantity=1, price_at_sale=Decimal('40.00'))
+        invoice = Invoice.objects.create(client=self.client_record, is_credit=True, amount_paid=Decimal('30.00'))
+        SaleItem.objects.create(invoice=invoice, product=self.product, quantity=2, price_at_sale=Decimal('45.00'))
+        Invoice.refresh_totals([invoice.pk])
+        DebtPayment.objects.create(client=self.client_record, amount=Decimal('20.00'))
+
+    def test_refresh_balances_in_one_query(self):
+        with self.assertNumQueries(1):
+            Client.refresh_balances([self.client_record.pk])
+        self.client_record.refresh_from_db()
+        # (200 - 50) + (90 - 30) - 20; the cash sale is not owed
+        self.assertEqual(self.client_record.total_debt, Decimal('190.00'))
+
+    def test_reconcile_balances_command(self):
+        out = StringIO()
+        call_command('reconcile_balances', dry_run=True, stdout=out)
+        self.assertIn('stored 0.00, expected 190.00', out.getvalue())
+        self.client_record.refresh_from_db()
+        self.assertEqual(self.client_record.balance, 0)
+
+        call_command('reconcile_balances', stdout=StringIO())
+        self.client_record.refresh_from_db()
+        self.assertEqual(self.client_record.balance, Decimal('190.00'))
+
+    def test_client_list_sorts_and_filters_in_sql(self):
+        Client.refresh_balances([self.client_record.pk])
+        Client.objects.create(name="Walk-in Regular")
+        invoice = self.client_record.invoices.get()
+        self.client.force_login(User.objects.create_user('cashier', password='secret'))
+
+        response = self.client.get(reverse('client_list'), {'sort': 'debt'})
+        self.assertEqual([c.name for c in response.context['clients']], ["Garage Ltd", "Walk-in Regular"])
+        self.assertFalse(response.context['clients'][0].has_overdue)
+
+        response = self.client.get(reverse('client_list'), {'min_debt': '100'})
+        self.assertEqual([c.name for c in response.context['clients']], ["Garage Ltd"])
+
+        self.assertEqual(len(self.client.get(reverse('client_list'), {'overdue': '1'}).context['clients']), 0)
+        invoice.due_date = timezone.localdate() - timezone.timedelta(days=1)
+        invoice.save()
+        response = self.client.get(reverse('client_list'), {'overdue': '1'})
+        self.assertEqual([c.name for c in response.context['clients']], ["Garage Ltd"])
+
+    def test_statement_running_balance_across_pages(self):
+        rows, cursor = statement_page(self.client_record.pk, size=2)
+        self.assertEqual([row['kind'] for row in rows], ['Sale', 'Invoice'])
+        self.assertEqual([row['balance'] for row in rows], [Decimal('150.00'), Decimal('210.00')])
+
+        rows, cursor = statement_page(self.client_record.pk, cursor, size=2)
+        self.assertIsNone(cursor)
+        self.assertEqual([(row['reference'], row['balance']) for row in rows], [
+            (f'Payment #{self.client_record.debt_payments.get().pk}', Decimal('190.00'))
+        ])
+        self.assertEqual([row['balance'] for row in statement_rows(self.client_record.pk, size=1)][-1],
+                         Decimal('190.00'))
+
+    def test_statement_csv_is_streamed(self):
+        self.client.force_login(User.objects.create_user('cashier', password='secret'))
+        response = self.client.get(reverse('client_statement_csv', args=[self.client_record.pk]))
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'Date,Reference,Description,Charge,Paid,Balance')
+        self.assertTrue(lines[-1].endswith(',0.00,20.00,190.00'))
+
+    def test_invoice_totals_stored_and_listed_in_sql(self):
+        invoice = self.client_record.invoices.get()
+        self.assertEqual((invoice.total_price, invoice.balance_due, invoice.payment_status),
+                         (Decimal('90.00'), Decimal('60.00'), 'PARTIAL'))
+        Invoice.objects.create(amount_paid=0)
+        self.client.force_login(User.objects.create_user('cashier', password='secret'))
+
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('invoice_list'), {'sort': 'amount'})
+            self.assertContains(response, 'TZS 90.00')
+        self.assertEqual([i.pk for i in response.context['invoices']][0], invoice.pk)
+
+        response = self.client.get(reverse('invoice_list'), {'status': 'PAID', 'max_amount': '50'})
+        self.assertNotIn(invoice, response.context['invoices'])
+        self.assertEqual(len(response.context['invoices']), 1)
+
+class ProductDeleteTestCase(TestCase):
+    def setUp(self):
+        self.client_record = Client.objects.create(name="Workshop")
+        self.product = Product.objects.create(name="Belt", current_stock=10, unit_price=Decimal('10.00'))
+        other = Product.objects.create(name="Hose", current_stock=10, unit_price=Decimal('10.00'))
+        Sale.objects.create(product=self.product, client=self.client_record, quantity=1,
+                            price_at_sale=Decimal('10.00'), is_credit=True)
+        self.invoice = Invoice.objects.create(client=self.client_record, is_credit=True)
+        SaleItem.objects.create(invoice=self.invoice, product=self.product, quantity=1, price_at_sale=Decimal('10.00'))
+        SaleItem.objects.create(invoice=self.invoice, product=other, quantity=1, price_at_sale=Decimal('10.00'))
+        Invoice.refresh_totals([self.invoice.pk])
+        Client.refresh_balances([self.client_record.pk])
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+
+    def test_cascade_refreshes_client_balances(self):
+        self.client.post(reverse('product_delete', args=[self.product.pk]))
+        self.assertFalse(Product.objects.filter(pk=self.product.pk).exists())
+        client = Client.objects.annotate(expected=Client.balance_expression()).get()
+        self.assertEqual(client.balance, client.expected)
+        self.assertEqual(client.balance, Decimal('10.00'))
+
+    def test_cascade_refreshes_invoice_totals(self):
+        self.client.post(reverse('product_delete', args=[self.product.pk]))
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.total_price, Decimal('10.00'))
+        self.assertEqual(self.invoice.balance_due, Decimal('10.00'))
+
+class AgingReportTestCase(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        now = timezone.now()
+        self.client_record = Client.objects.create(name="Fleet Co")
+        product = Product.objects.create(name="Tyre", current_stock=50, unit_price=Decimal('50.00'))
+        Sale.objects.create(product=product, client=self.client_record, quantity=2, price_at_sale=Decimal('50.00'),
+                            is_credit=True, date=now - timezone.timedelta(days=100))
+        Sale.objects.create(product=product, client=self.client_record, quantity=1, price_at_sale=Decimal('40.00'),
+                            is_credit=True, date=now)
+        invoice = Invoice.objects.create(client=self.client_record, is_credit=True, amount_paid=Decimal('30.00'),
+                                         date=now - timezone.timedelta(days=40),
+                                         due_date=self.today - timezone.timedelta(days=10))
+        SaleItem.objects.create(invoice=invoice, product=product, quantity=2, price_at_sale=Decimal('45.00'))
+        Invoice.refresh_totals([invoice.pk])
+        DebtPayment.objects.create(client=self.client_record, amount=Decimal('120.00'))
+        Client.refresh_balances([self.client_record.pk])
+
+    def test_buckets_with_payments_on_oldest_first(self):
+        [row] = aging_rows(self.today)
+        # 100 (90+) + 60 (1-30) + 40 (current) - 120 paid on the oldest first
+        self.assertEqual(row['buckets'], {'current': Decimal('40.00'), 'days_30': Decimal('40.00'),
+                                          'days_60': 0, 'days_90': 0, 'over_90': 0})
+        self.client_record.refresh_from_db()
+        self.assertEqual(row['total'], self.client_record.balance)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_report_drill_down_and_csv(self):
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        response = self.client.get(reverse('aging_report'), {'client': self.client_record.pk})
+        self.assertEqual(response.context['grand_total'], Decimal('80.00'))
+        self.assertEqual([d['days'] for d in response.context['documents']], [100, 10, 0])
+
+        lines = self.client.get(reverse('aging_report_csv')).content.decode().splitlines()
+        self.assertEqual(lines[0], 'Client,Current,1-30,31-60,61-90,90+,Total')
+        self.assertEqual(lines[1], 'Fleet Co,40.00,40.00,0.00,0.00,0.00,80.00')
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SalesReportTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.today = timezone.localdate()
+        self.client_record = Client.objects.create(name="Depot")
+        product = Product.objects.create(name="Bolt", current_stock=50, unit_price=Decimal('10.00'))
+        Sale.objects.create(product=product, quantity=2, price_at_sale=Decimal('10.00'),
+                            cost_price=Decimal('6.00'), date=now - timezone.timedelta(hours=2))
+        Sale.objects.create(product=product, client=self.client_record, quantity=3, price_at_sale=Decimal('10.00'),
+                            is_credit=True, amount_paid=Decimal('5.00'), date=now - timezone.timedelta(hours=1))
+        # Outside the report range
+        Sale.objects.create(product=product, quantity=9, price_at_sale=Decimal('10.00'),
+                            date=now - timezone.timedelta(days=40))
+        invoice = Invoice.objects.create(client=self.client_record, is_credit=True, amount_paid=Decimal('4.00'), date=now)
+        SaleItem.objects.create(invoice=invoice, product=product, quantity=1, price_at_sale=Decimal('12.00'),
+                                cost_price=Decimal('7.00'))
+        SaleItem.objects.create(invoice=invoice, product=product, quantity=2, price_at_sale=Decimal('11.00'))
+        Invoice.refresh_totals([invoice.pk])
+        DebtPayment.objects.create(client=self.client_record, amount=Decimal('10.00'))
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+
+    def test_lines_and_summary(self):
+        start = (self.today - timezone.timedelta(days=7)).isoformat()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('sales_report'), {'start_date': start, 'end_date': self.today.isoformat()})
+        lines = response.context['sales']
+        self.assertEqual([line['kind'] for line in lines], ['item', 'item', 'sale', 'sale'])
+        self.assertEqual(lines[3]['profit'], Decimal('8.00'))
+        self.assertEqual(lines[2]['client_name'], 'Depot')
+
+        context = response.context
+        self.assertEqual(context['total_revenue'], Decimal('84.00'))
+        self.assertEqual(context['total_cost'], Decimal('19.00'))
+        self.assertEqual(context['total_profit'], Decimal('65.00'))
+        self.assertEqual(context['cash_revenue'], Decimal('20.00'))
+        self.assertEqual(context['credit_revenue'], Decimal('64.00'))
+        # 25 unpaid on the credit sale + 30 on the invoice - 10 paid on account
+        self.assertEqual(context['outstanding_credit'], Decimal('45.00'))
+        self.assertEqual((context['total_sales'], context['cash_sales_count'], context['credit_sales_count']), (4, 1, 3))
+        self.assertLess(len(queries), 20)
+
+    def test_csv_export_streams_every_line(self):
+        start = (self.today - timezone.timedelta(days=7)).isoformat()
+        response = self.client.get(reverse('sales_report'), {'start_date': start, 'export': 'csv', 'page': 2})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'Date,Source,Product,Client,Quantity,Price,Total,Cost,Profit,Type')
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[-1].endswith(',BOLT,,2.00,10.00,20.00,12.00,8.00,Cash'))
+
+    def test_history_export_honors_date_filters(self):
+        InventoryMovement.objects.create(product=Product.objects.get(), movement_type='IN', quantity=5,
+                                         reference='old', date=timezone.now() - timezone.timedelta(days=40))
+        InventoryMovement.objects.create(product=Product.objects.get(), movement_type='IN', quantity=7, reference='new')
+        response = self.client.get(reverse('inventory_history'), {
+            'start_date': (self.today - timezone.timedelta(days=7)).isoformat(), 'export': 'csv'
+        })
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith(',BOLT,Stock In,7.00,,new'))
+
+class ExpensesReportTestCase(TestCase):
+    def setUp(self):
+        rent = ExpenseCategory.objects.create(name="Rent")
+        fuel = ExpenseCategory.objects.create(name="Fuel")
+        march = timezone.make_aware(timezone.datetime(2026, 3, 10))
+        april = timezone.make_aware(timezone.datetime(2026, 4, 10))
+        for amount, category, date in ((Decimal('100.00'), rent, march), (Decimal('100.00'), rent, april),
+                                       (Decimal('30.00'), fuel, april), (Decimal('20.00'), None, april)):
+            MoneyJournal.objects.create(entry_type='Expense', amount=amount, category=category, date=date)
+        MoneyJournal.objects.create(entry_type='Income', amount=Decimal('500.00'), date=april)
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+
+    def test_grouped_totals_and_monthly_breakdown(self):
+        response = self.client.get(reverse('expenses_report'), {'start_date': '2026-03-01', 'end_date': '2026-04-30'})
+        context = response.context
+        self.assertEqual(context['total_expenses'], Decimal('250.00'))
+        self.assertEqual(context['expense_count'], 4)
+        self.assertEqual(context['average_expense'], Decimal('62.50'))
+        self.assertEqual(context['category_totals'], {'Rent': Decimal('200.00'), 'Fuel': Decimal('30.00'),
+                                                      'Uncategorized': Decimal('20.00')})
+
+        breakdown = context['monthly_breakdown']
+        self.assertEqual(breakdown['categories'], ['Rent', 'Fuel', 'Uncategorized'])
+        self.assertEqual([(row['month'].month, row['amounts'], row['total']) for row in breakdown['rows']], [
+            (3, [Decimal('100.00'), 0, 0], Decimal('100.00')),
+            (4, [Decimal('100.00'), Decimal('30.00'), Decimal('20.00')], Decimal('150.00')),
+        ])
+
+class ProfitReportTestCase(TestCase):
+    def setUp(self):
+        today = timezone.localdate()
+        for i in range(21):
+            product = Product.objects.create(name=f"Part {i:02d}", current_stock=10, unit_price=Decimal('10.00'))
+            # Profit grows with i, split over two days so the subqueries have to sum
+            for days_ago in (0, 1):
+                DailyRollup.objects.create(date=today - timezone.timedelta(days=days_ago), product=product,
+                                           quantity=1, revenue=Decimal('100.00'), cogs=Decimal(100 - i))
+        Product.objects.create(name="Unsold", current_stock=10, unit_price=Decimal('10.00'))
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+
+    def test_ranked_across_pages(self):
+        first = self.client.get(reverse('profit_report'))
+        self.assertEqual(first.context['paginator'].count, 21)
+        top = first.context['report_data'][0]
+        self.assertEqual((top.name, top.total_sold, top.net_profit, top.margin),
+                         ('PART 20', Decimal('2'), Decimal('40.00'), Decimal('20.0')))
+        self.assertEqual(first.context['total_revenue_sum'], Decimal('4200.00'))
+
+        last = self.client.get(reverse('profit_report'), {'page': 2})
+        self.assertEqual([product.name for product in last.context['report_data']], ['PART 00'])
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ClosedPeriodTestCase(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.month = month_start(month_start(self.today) - timezone.timedelta(days=1))
+        self.in_month = timezone.make_aware(timezone.datetime.combine(self.month.replace(day=10), timezone.datetime.min.time()))
+        self.product = Product.objects.create(name="Filter", current_stock=6, unit_price=Decimal('25.00'))
+        self.client_record = Client.objects.create(name="Garage")
+        InventoryMovement.objects.create(product=self.product, movement_type='IN', quantity=10,
+                                         cost_price=Decimal('10.00'), date=self.in_month)
+        self.sale = Sale.objects.create(product=self.product, client=self.client_record, quantity=4,
+                                        price_at_sale=Decimal('25.00'), cost_price=Decimal('10.00'),
+                                        is_credit=True, amount_paid=Decimal('30.00'), date=self.in_month)
+        InventoryMovement.objects.create(product=self.product, sale=self.sale, movement_type='OUT', quantity=4,
+                                         cost_price=Decimal('10.00'), date=self.in_month)
+        MoneyJournal.objects.create(entry_type='Expense', amount=Decimal('15.00'), date=self.in_month)
+        rebuild_rollups()
+
+    def test_close_freezes_month_end_totals(self):
+        period = close_period(self.month)
+        snapshots = {snapshot.kind: snapshot for snapshot in period.snapshots.all()}
+        sales = snapshots[PeriodSnapshot.SALES]
+        self.assertEqual((sales.label, sales.quantity, sales.revenue, sales.margin),
+                         ('FILTER', Decimal('4.00'), Decimal('100.00'), Decimal('60.00')))
+        self.assertEqual(snapshots[PeriodSnapshot.EXPENSES].amount, Decimal('15.00'))
+        self.assertEqual(snapshots[PeriodSnapshot.RECEIVABLE].amount, Decimal('70.00'))
+        self.assertEqual((snapshots[PeriodSnapshot.STOCK].quantity, snapshots[PeriodSnapshot.STOCK].amount),
+                         (Decimal('6.00'), Decimal('60.00')))
+
+        with self.assertRaises(PeriodClosed):
+            close_period(self.month)
+        with self.assertRaises(PeriodClosed):
+            close_period(self.today)
+
+    def test_manual_stock_outs_are_valued_at_their_consumption_cost(self):
+        product = Product.objects.create(name="Gasket", unit_price=Decimal('9.00'))
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        for movement_type, quantity in (('IN', 10), ('OUT', 4)):
+            self.client.post(reverse('movement_create'), {
+                'product': product.pk, 'movement_type': movement_type, 'quantity': quantity,
+                'date': self.in_month.date().isoformat(), 'cost_price': '5.00' if movement_type == 'IN' else '',
+            })
+        self.assertEqual(product.movements.get(movement_type='OUT').cost_price, Decimal('5.00'))
+
+        period = close_period(self.month)
+        stock = period.snapshots.get(kind=PeriodSnapshot.STOCK, product=product)
+        self.assertEqual((stock.quantity, stock.amount), (Decimal('6.00'), Decimal('30.00')))
+
+    def test_backdated_writes_are_refused(self):
+        close_period(self.month)
+        with self.assertRaises(PeriodClosed):
+            Sale.objects.create(product=self.product, quantity=1, price_at_sale=Decimal('25.00'), date=self.in_month)
+        self.sale.date = timezone.now()
+        with self.assertRaises(PeriodClosed):
+            self.sale.save()
+        # A delete is refused from inside its own transaction, so keep the test's usable
+        with self.assertRaises(PeriodClosed), transaction.atomic():
+            MoneyJournal.objects.get().delete()
+
+        form = MoneyJournalForm(data={'entry_type': 'Expense', 'amount': '5.00', 'date': self.month.isoformat()})
+        self.assertIn('date', form.errors)
+        Sale.objects.create(product=self.product, quantity=1, price_at_sale=Decimal('25.00'))
+
+    def test_product_with_closed_history_is_not_deleted(self):
+        close_period(self.month)
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        response = self.client.post(reverse('product_delete', args=[self.product.pk]))
+        self.assertRedirects(response, reverse('product_list'), fetch_redirect_response=False)
+        self.assertTrue(Product.objects.filter(pk=self.product.pk).exists())
+        self.assertEqual(self.product.sales.count(), 1)
+
+    def test_rebuilds_leave_closed_months_as_frozen(self):
+        Sale.objects.filter(pk=self.sale.pk).update(cost_price=Decimal('99.00'))
+        rebuild_rollups()
+        close_period(self.month)
+
+        call_command('rebuild_fifo', workers=1, stdout=StringIO())
+        call_command('backfill_rollups', stdout=StringIO())
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.cost_price, Decimal('99.00'))
+        self.assertEqual(DailyRollup.objects.get(product=self.product).cogs, Decimal('396.00'))
+        # The closed month's consumptions still seed the layers
+        self.assertEqual(list(self.product.fifo_layers.values_list('remaining_quantity', flat=True)), [6])
+
+    def test_closed_periods_page_shows_every_month_end_figure(self):
+        close_period(self.month)
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        [period] = self.client.get(reverse('closed_periods')).context['periods']
+        self.assertEqual(
+            (period.revenue, period.cogs, period.margin, period.expenses, period.receivables, period.stock_value),
+            (Decimal('100.00'), Decimal('40.00'), Decimal('60.00'), Decimal('15.00'), Decimal('70.00'), Decimal('60.00'))
+        )
+
+    def test_profit_report_reads_closed_months_from_snapshots(self):
+        close_period(self.month)
+        # The live rows of the closed month are no longer read
+        DailyRollup.objects.filter(product=self.product).update(revenue=0)
+        Sale.objects.create(product=self.product, quantity=1, price_at_sale=Decimal('30.00'),
+                            cost_price=Decimal('10.00'))
+        refresh_rollups([(self.today, self.product.pk)])
+
+        self.client.force_login(User.objects.create_superuser('manager', password='secret'))
+        response = self.client.get(reverse('profit_report'), {'start_date': self.month.isoformat()})
+        [row] = response.context['report_data']
+        self.assertEqual((row.total_sold, row.total_revenue, row.net_profit), (Decimal('5'), Decimal('130'), Decimal('80')))
+        self.assertEqual(response.context['total_revenue_sum'], Decimal('130.00'))
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedContextTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        return {'products': Product.objects.count()}
+
+    def context(self, **params):
+        return cached_context('test', [Product], params, self.build)
+
+    def test_reused_until_version_bump(self):
+        self.assertEqual(self.context(), {'products': 0})
+        self.assertEqual(self.context(), {'products': 0})
+        self.assertEqual(self.builds, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_versions(Product)
+        self.context()
+        self.assertEqual(self.builds, 2)
+
+    def test_save_bumps_version(self):
+        self.context()
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name="Chain", current_stock=1, unit_price=Decimal('8.00'))
+        self.assertEqual(self.context(), {'products': 1})
+
+    def test_versions_are_written_once_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            bump_versions(Product)
+            bump_versions(Product, Client)
+            self.assertFalse(CacheVersion.objects.exists())
+        with self.assertNumQueries(1):
+            for callback in callbacks:
+                callback()
+        self.assertEqual(CacheVersion.objects.count(), 2)
+
+    def test_params_are_part_of_key(self):
+        self.context(start_date='2026-01-01')
+        self.context(start_date='2026-02-01')
+        self.context(start_date='2026-01-01')
+        self.assertEqual(self.builds, 2)
+
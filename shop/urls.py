@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path('', views.DashboardView.as_view(), name='dashboard'),
+    path('api/dashboard-chart/', views.DashboardChartView.as_view(), name='dashboard_chart'),
     path('products/', views.ProductListView.as_view(), name='product_list'),
     path('products/add/', views.ProductCreateView.as_view(), name='product_create'),
     path('products/<int:pk>/edit/', views.ProductUpdateView.as_view(), name='product_update'),
@@ -22,12 +23,18 @@ urlpatterns = [
     path('profit-report/', views.ProfitReportView.as_view(), name='profit_report'),
     path('reports/sales/', views.SalesReportView.as_view(), name='sales_report'),
     path('reports/expenses/', views.ExpensesReportView.as_view(), name='expenses_report'),
+    path('reports/periods/', views.ClosedPeriodListView.as_view(), name='closed_periods'),
+    path('reports/aging/', views.AgingReportView.as_view(), name='aging_report'),
+    path('reports/aging/csv/', views.AgingReportCSVView.as_view(), name='aging_report_csv'),
     path('categories/', views.ExpenseCategoryListView.as_view(), name='category_list'),
     path('categories/add/', views.ExpenseCategoryCreateView.as_view(), name='category_create'),
     path('low-stock/', views.LowStockView.as_view(), name='low_stock'),
     path('clients/', views.ClientListView.as_view(), name='client_list'),
     path('clients/add/', views.ClientCreateView.as_view(), name='client_create'),
     path('clients/<int:pk>/', views.ClientDetailView.as_view(), name='client_detail'),
+    path('clients/<int:pk>/statement/', views.ClientStatementView.as_view(), name='client_statement'),
+    path('clients/<int:pk>/statement/csv/', views.ClientStatementCSVView.as_view(), name='client_statement_csv'),
+    path('clients/<int:pk>/statement/pdf/', views.ClientStatementPDFView.as_view(), name='client_statement_pdf'),
     path('debts/add/', views.DebtPaymentCreateView.as_view(), name='debt_payment_create'),
     path('debts/<int:pk>/delete/', views.DebtPaymentDeleteView.as_view(), name='debt_payment_delete'),
     path('products/<int:pk>/quick-stock/', views.quick_stock_update, name='quick_stock_update'),
@@ -1,19 +1,32 @@
+import csv
+import tempfile
+from itertools import chain
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import views as auth_views
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView, TemplateView, FormView, View
 from django.urls import reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.db import transaction
-from django.db.models import Sum, F, Q, Prefetch
+from django.db.models import Sum, F, Q, Min
 from django.utils import timezone
 from django.contrib import messages
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.template.loader import get_template
 from xhtml2pdf import pisa
-from decimal import Decimal
-from .models import Product, InventoryMovement, Sale, MoneyJournal, ExpenseCategory, Client, DebtPayment, Invoice, SaleItem
-from .forms import SaleForm, MovementForm, MoneyJournalForm, ClientForm, DebtPaymentForm
-from .mixins import ManagerRequiredMixin, DateFilterMixin
+from decimal import Decimal, InvalidOperation
+from .models import Product, InsufficientStock, PeriodClosed, InventoryMovement, FifoLayer, FifoAllocation, Sale, MoneyJournal, ExpenseCategory, Client, DebtPayment, Invoice, SaleItem, DailyRollup, ClosedPeriod, PeriodSnapshot
+from .forms import ProductForm, SaleForm, MovementForm, MoneyJournalForm, ClientForm, DebtPaymentForm
+from .mixins import ManagerRequiredMixin, DateFilterMixin, WriteTransactionMixin, CSVExportMixin, OpenPeriodDeleteMixin, Echo, export_date
+from .db import write_transaction, message_on_commit
+from .costing import consume_stock, receive_stock, get_strategy, carry_over_stock
+from .fifo import recost_product
+from .checkout import parse_lines, checkout_invoice, update_invoice_lines, return_invoice_stock
+from .reports import CHART_WINDOWS, chart_series, sales_lines, sales_summary, expense_summary, product_profits
+from .rollups import business_date, sale_key, invoice_keys, refresh_rollups
+from .cache import cached_context, bump_versions
+from .statements import statement_page, statement_rows, to_amount
+from .aging import BUCKETS, aging_rows, aging_totals, open_documents
+from .periods import check_open, period_totals, report_sources
 
 class MyLogoutView(auth_views.LogoutView):
     def get(self, request, *args, **kwargs):
@@ -25,71 +38,46 @@ class DashboardView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['total_products'] = Product.objects.count()
-        context['low_stock'] = Product.objects.filter(current_stock__lt=5).count()
-        context['total_income'] = float(MoneyJournal.objects.filter(entry_type='Income').aggregate(Sum('amount'))['amount__sum'] or 0)
-        context['total_expense'] = float(MoneyJournal.objects.filter(entry_type='Expense').aggregate(Sum('amount'))['amount__sum'] or 0)
-        context['balance'] = round(context['total_income'] - context['total_expense'], 2)
+        # Reused until a product, client or rollup changes (or the day rolls over)
+        context.update(cached_context(
+            'dashboard', [Product, Client, DailyRollup], {'today': timezone.localdate()}, self.get_stats
+        ))
+        return context
+
+    def get_stats(self):
+        stats = {}
+        stats['total_products'] = Product.objects.count()
+        stats['low_stock'] = Product.objects.filter(current_stock__lt=5).count()
+        journal = DailyRollup.objects.filter(product__isnull=True).aggregate(income=Sum('income'), expenses=Sum('expenses'))
+        stats['total_income'] = float(journal['income'] or 0)
+        stats['total_expense'] = float(journal['expenses'] or 0)
+        stats['balance'] = round(stats['total_income'] - stats['total_expense'], 2)
         
         # Debt Stats
-        total_owed = sum(c.total_debt for c in Client.objects.all())
-        context['total_debt'] = float(total_owed)
+        total_owed = Client.objects.aggregate(total=Sum('balance'))['total'] or 0
+        stats['total_debt'] = float(total_owed)
         
-        # Calculate last 7 days data
-        days = []
-        sales_data = []
-        profit_data = []
-        expenses_data = []
-        
-        for i in range(6, -1, -1):
-            date = timezone.now().date() - timezone.timedelta(days=i)
-            days.append(date.strftime('%b %d'))
-            
-            # Daily Sales (Total Volume - Accrual)
-            daily_sales = Sale.objects.filter(date__date=date).aggregate(
-                total=Sum(F('quantity') * F('price_at_sale'))
-            )['total'] or 0
-            
-            daily_invoice_sales = SaleItem.objects.filter(invoice__date__date=date).aggregate(
-                total=Sum(F('quantity') * F('price_at_sale'))
-            )['total'] or 0
-            
-            daily_sales_total = float(daily_sales) + float(daily_invoice_sales)
-            sales_data.append(daily_sales_total)
-            
-            # Daily COGS - use actual sale cost_price (FIFO) instead of current product cost_price
-            daily_cogs = 0
-            daily_sales_queryset = Sale.objects.filter(date__date=date).select_related('product')
-            for sale in daily_sales_queryset:
-                if sale.cost_price:
-                    daily_cogs += sale.cost_price
-                else:
-                    # Fallback to current product cost_price if sale cost_price is null
-                    daily_cogs += sale.quantity * sale.product.cost_price
-                    
-            daily_invoice_sales_queryset = SaleItem.objects.filter(invoice__date__date=date).select_related('product')
-            for item in daily_invoice_sales_queryset:
-                if item.cost_price:
-                    daily_cogs += item.cost_price
-                else:
-                    daily_cogs += item.quantity * item.product.cost_price
-            
-            # Manual Expenses for the day
-            daily_expenses = MoneyJournal.objects.filter(entry_type='Expense', date__date=date).aggregate(
-                total=Sum('amount')
-            )['total'] or 0
-            expenses_data.append(float(daily_expenses))
-            
-            # Profit = Total Sales Value - COGS - Expenses (Accrual)
-            # This ensures that credit sales don't look like losses because of COGS.
-            daily_profit = daily_sales_total - float(daily_cogs) - float(daily_expenses)
-            profit_data.append(round(daily_profit, 2))
-
-        context['chart_labels'] = days
-        context['chart_sales'] = sales_data
-        context['chart_profit'] = profit_data
-        context['chart_expenses'] = expenses_data
-        return context
+        # The chart is fetched from DashboardChartView once the page has rendered
+        stats['chart_windows'] = CHART_WINDOWS
+        return stats
+
+class DashboardChartView(ManagerRequiredMixin, LoginRequiredMixin, View):
+    """
+    Chart series as JSON for one of the dashboard windows (?days=7, 30, 90 or 365)
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            days = int(request.GET.get('days', CHART_WINDOWS[0]))
+        except ValueError:
+            days = None
+        if days not in CHART_WINDOWS:
+            return JsonResponse({'success': False, 'error': 'Unsupported chart window.'}, status=400)
+
+        series = cached_context(
+            'dashboard_chart', [DailyRollup], {'today': timezone.localdate(), 'days': days},
+            lambda: chart_series(days=days)
+        )
+        return JsonResponse({'success': True, 'days': days, **series})
 
 class ProductListView(LoginRequiredMixin, ListView):
     model = Product
@@ -112,22 +100,59 @@ class ProductListView(LoginRequiredMixin, ListView):
 
 class ProductCreateView(LoginRequiredMixin, CreateView):
     model = Product
-    fields = ['name', 'current_stock', 'unit_price', 'cost_price']
+    form_class = ProductForm
     template_name = 'shop/product_form.html'
     success_url = reverse_lazy('product_list')
 
-class ProductUpdateView(ManagerRequiredMixin, LoginRequiredMixin, UpdateView):
+class ProductUpdateView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, UpdateView):
     model = Product
-    fields = ['name', 'current_stock', 'unit_price', 'cost_price']
+    form_class = ProductForm
     template_name = 'shop/product_form.html'
     success_url = reverse_lazy('product_list')
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # The stock on hand follows the product onto its new costing method
+        if 'costing_method' in form.changed_data:
+            carry_over_stock(self.object, form.initial['costing_method'])
+        return response
 
-class ProductDeleteView(ManagerRequiredMixin, LoginRequiredMixin, DeleteView):
+class ProductDeleteView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, DeleteView):
     model = Product
     template_name = 'shop/product_confirm_delete.html'
     success_url = reverse_lazy('product_list')
 
+    def form_valid(self, form):
+        product = self.object
+        # 1. The cascade deletes the product's history, so refuse while any of it is in a closed month
+        dates = [
+            queryset.aggregate(first=Min(field))['first'] for queryset, field in (
+                (product.sales.all(), 'date'), (product.movements.all(), 'date'),
+                (SaleItem.objects.filter(product=product), 'invoice__date'),
+                (MoneyJournal.objects.filter(sale__product=product), 'date'),
+            )
+        ]
+        try:
+            check_open(min(filter(None, dates), default=None))
+        except PeriodClosed as e:
+            message_on_commit(self.request, messages.ERROR, f"{product.name} has history in a closed month. {e}")
+            return redirect(self.get_success_url())
+
+        # 2. Note what the cascade to the product's sales and invoice lines changes
+        client_ids = set(product.sales.filter(is_credit=True).values_list('client_id', flat=True))
+        items = SaleItem.objects.filter(product=product)
+        invoice_ids = set(items.values_list('invoice_id', flat=True))
+        client_ids |= set(items.filter(invoice__is_credit=True).values_list('invoice__client_id', flat=True))
+        journal_dates = {business_date(date) for date in
+                         MoneyJournal.objects.filter(sale__product=product).values_list('date', flat=True)}
+
+        # 3. Delete, then bring the stored totals, balances and journal rollups back in line
+        response = super().form_valid(form)
+        Invoice.refresh_totals(invoice_ids)
+        Client.refresh_balances(client_ids)
+        refresh_rollups(journal_dates=journal_dates)
+        return response
+
 class ClientListView(LoginRequiredMixin, ListView):
     model = Client
     template_name = 'shop/client_list.html'
@@ -135,12 +160,37 @@ class ClientListView(LoginRequiredMixin, ListView):
     paginate_by = 10
     ordering = ['name']
 
+    # ?sort= value -> ordering; debt uses the stored (indexed) balance
+    sort_options = {
+        'name': ['name'],
+        'debt': ['-balance', 'name'],
+        'debt_asc': ['balance', 'name'],
+    }
+
     def get_queryset(self):
-        queryset = super().get_queryset().prefetch_related('sales', 'debt_payments')
+        queryset = super().get_queryset().annotate(has_overdue=Client.overdue_expression())
         query = self.request.GET.get('q')
         if query:
             queryset = queryset.filter(name__icontains=query)
-        return queryset
+
+        # Collections filters: owes more than X, has overdue invoices
+        try:
+            min_debt = Decimal(self.request.GET.get('min_debt', ''))
+            queryset = queryset.filter(balance__gt=min_debt)
+        except InvalidOperation:
+            pass
+        if self.request.GET.get('overdue'):
+            queryset = queryset.filter(has_overdue=True)
+
+        return queryset.order_by(*self.sort_options.get(self.request.GET.get('sort'), self.ordering))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['search_query'] = self.request.GET.get('q', '')
+        context['min_debt'] = self.request.GET.get('min_debt', '')
+        context['overdue'] = bool(self.request.GET.get('overdue'))
+        context['sort'] = self.request.GET.get('sort', 'name')
+        return context
 
 class ClientDetailView(LoginRequiredMixin, ListView):
     model = Sale
@@ -159,18 +209,71 @@ class ClientDetailView(LoginRequiredMixin, ListView):
         context['invoices'] = Invoice.objects.filter(client=self.client).order_by('-date')
         return context
 
+class ClientStatementView(LoginRequiredMixin, TemplateView):
+    """
+    A client's sales, invoices and payments as one ledger with a running balance, one keyset page at a time
+    """
+    template_name = 'shop/client_statement.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        client = get_object_or_404(Client, pk=self.kwargs['pk'])
+        try:
+            rows, next_cursor = statement_page(client.pk, self.request.GET.get('after'))
+        except ValueError:
+            rows, next_cursor = statement_page(client.pk)
+        context.update({'client': client, 'rows': rows, 'next_cursor': next_cursor,
+                        'is_first_page': not self.request.GET.get('after')})
+        return context
+
+class ClientStatementCSVView(LoginRequiredMixin, View):
+    def get(self, request, pk):
+        client = get_object_or_404(Client, pk=pk)
+        writer = csv.writer(Echo())
+        header = ['Date', 'Reference', 'Description', 'Charge', 'Paid', 'Balance']
+        lines = (
+            [timezone.localtime(row['date']).strftime('%Y-%m-%d %H:%M'), row['reference'], row['description'],
+             row['charge'], row['paid'], row['balance']]
+            for row in statement_rows(client.pk)
+        )
+        response = StreamingHttpResponse(
+            (writer.writerow(line) for line in chain([header], lines)), content_type='text/csv'
+        )
+        response['Content-Disposition'] = f'attachment; filename="statement_{client.pk}.csv"'
+        return response
+
+class ClientStatementPDFView(LoginRequiredMixin, View):
+    def get(self, request, pk):
+        client = get_object_or_404(Client, pk=pk)
+        template = get_template('shop/client_statement_pdf.html')
+        html = template.render({
+            'client': client,
+            'rows': statement_rows(client.pk),
+            'current_date': timezone.now(),
+        })
+        # The PDF goes to a temporary file and is streamed from there
+        pdf = tempfile.TemporaryFile()
+        pisa_status = pisa.CreatePDF(html, dest=pdf)
+        if pisa_status.err:
+            pdf.close()
+            return HttpResponse('We had some errors <pre>' + html + '</pre>')
+        pdf.seek(0)
+        return FileResponse(pdf, content_type='application/pdf', filename=f'statement_{client.pk}.pdf')
+
 class ClientCreateView(LoginRequiredMixin, CreateView):
     model = Client
     form_class = ClientForm
     template_name = 'shop/client_form.html'
     success_url = reverse_lazy('client_list')
 
-class InventoryHistoryView(LoginRequiredMixin, DateFilterMixin, ListView):
+class InventoryHistoryView(LoginRequiredMixin, CSVExportMixin, DateFilterMixin, ListView):
     model = InventoryMovement
     template_name = 'shop/inventory_history.html'
     context_object_name = 'movements'
     ordering = ['-date']
     paginate_by = 10
+    export_filename = 'inventory_history'
+    export_header = ['Date', 'Product', 'Type', 'Quantity', 'Unit Cost', 'Reference']
 
     def get_queryset(self):
         queryset = super().get_queryset().select_related('product', 'sale')
@@ -191,12 +294,18 @@ class InventoryHistoryView(LoginRequiredMixin, DateFilterMixin, ListView):
         context['search_query'] = self.request.GET.get('q', '')
         return context
 
-class SalesHistoryView(LoginRequiredMixin, DateFilterMixin, ListView):
+    def export_row(self, movement):
+        return [export_date(movement.date), movement.product.name, movement.get_movement_type_display(),
+                movement.quantity, movement.cost_price, movement.reference]
+
+class SalesHistoryView(LoginRequiredMixin, CSVExportMixin, DateFilterMixin, ListView):
     model = Sale
     template_name = 'shop/sales_history.html'
     context_object_name = 'sales'
     ordering = ['-date']
     paginate_by = 10
+    export_filename = 'sales_history'
+    export_header = ['Date', 'Product', 'Client', 'Quantity', 'Price', 'Total', 'Type', 'Paid']
 
     def get_queryset(self):
         queryset = super().get_queryset().select_related('product', 'client')
@@ -217,15 +326,21 @@ class SalesHistoryView(LoginRequiredMixin, DateFilterMixin, ListView):
         context['search_query'] = self.request.GET.get('q', '')
         return context
 
-class MoneyJournalView(ManagerRequiredMixin, LoginRequiredMixin, DateFilterMixin, ListView):
+    def export_row(self, sale):
+        return [export_date(sale.date), sale.product.name, sale.client.name if sale.client else '', sale.quantity,
+                sale.price_at_sale, sale.total_price, 'Credit' if sale.is_credit else 'Cash', sale.amount_paid]
+
+class MoneyJournalView(ManagerRequiredMixin, LoginRequiredMixin, CSVExportMixin, DateFilterMixin, ListView):
     model = MoneyJournal
     template_name = 'shop/money_journal.html'
     context_object_name = 'entries'
     ordering = ['-date']
     paginate_by = 10
+    export_filename = 'money_journal'
+    export_header = ['Date', 'Type', 'Category', 'Description', 'Amount']
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().select_related('category')
         queryset = self.apply_date_filters(queryset)
             
         category_id = self.request.GET.get('category')
@@ -246,6 +361,10 @@ class MoneyJournalView(ManagerRequiredMixin, LoginRequiredMixin, DateFilterMixin
         context['selected_category'] = self.request.GET.get('category', '')
         return context
 
+    def export_row(self, entry):
+        return [export_date(entry.date), entry.entry_type, entry.category.name if entry.category else '',
+                entry.description, entry.amount]
+
 class LowStockView(LoginRequiredMixin, ListView):
     model = Product
     template_name = 'shop/product_list.html'
@@ -260,42 +379,42 @@ class LowStockView(LoginRequiredMixin, ListView):
         context['header_title'] = 'Low Stock Alert'
         return context
 
-class SaleCreateView(LoginRequiredMixin, CreateView):
+class SaleCreateView(LoginRequiredMixin, WriteTransactionMixin, CreateView):
     model = Sale
     form_class = SaleForm
     template_name = 'shop/sale_form.html'
     success_url = reverse_lazy('sales_history')
 
-    @transaction.atomic
     def form_valid(self, form):
+        # 1. Update Product Stock; the guarded update is the authoritative stock check
+        product = form.cleaned_data['product']
+        try:
+            product.remove_stock(form.cleaned_data['quantity'])
+        except InsufficientStock as e:
+            form.add_error('quantity', str(e))
+            return self.form_invalid(form)
+
         sale = form.save()
         
-        # Calculate FIFO cost price for this sale
-        fifo_cost_price = sale.product.get_fifo_cost_price(sale.quantity)
+        # Consume stock with the product's costing method and take the resulting cost price
+        consumption = consume_stock(product, sale.quantity)
+        FifoAllocation.record(consumption.allocations, sale=sale)
+        fifo_cost_price = consumption.cost_price
         sale.cost_price = fifo_cost_price
-        sale.save()
-        
-        # 1. Update Product Stock
-        product = sale.product
-        product.current_stock -= sale.quantity
-        product.save()
+        sale.save(update_fields=['cost_price'])
 
-        # 2. Deduct from inventory batches using FIFO
-        deductions = product.deduct_from_batches(sale.quantity)
-        
-        # 3. Record Inventory Movement (OUT) with cost price and remaining_quantity=0
+        # 2. Record Inventory Movement (OUT) with cost price
         InventoryMovement.objects.create(
             product=product,
             sale=sale,
             movement_type='OUT',
             quantity=sale.quantity,
-            remaining_quantity=0,  # OUT movements have no remaining stock
             date=sale.date,
             reference=f'Sale ID: {sale.id}',
             cost_price=fifo_cost_price
         )
 
-        # 4. Record Money Journal Entry (Income)
+        # 3. Record Money Journal Entry (Income)
         # For credit sales, we only record the upfront payment as income.
         amount_to_record = sale.total_price if not sale.is_credit else sale.amount_paid
         
@@ -311,27 +430,28 @@ class SaleCreateView(LoginRequiredMixin, CreateView):
                 date=sale.date,
                 sale=sale
             )
+
+        # 4. Keep the daily rollups and the client's balance in step
+        refresh_rollups([sale_key(sale)], [business_date(sale.date)])
+        Client.refresh_balances([sale.client_id])
         return super().form_valid(form)
 
-class SaleDeleteView(ManagerRequiredMixin, LoginRequiredMixin, DeleteView):
+class SaleDeleteView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, OpenPeriodDeleteMixin, DeleteView):
     model = Sale
     template_name = 'shop/sale_confirm_delete.html'
     success_url = reverse_lazy('sales_history')
 
-    @transaction.atomic
     def form_valid(self, form):
         sale = self.get_object()
         product = sale.product
         
-        # 1. Restore Product Stock
-        product.current_stock += sale.quantity
-        product.save()
+        # 1. Restore Product Stock and hand the quantity back to the batches it came from
+        product.add_stock(sale.quantity)
+        FifoAllocation.release(sale.fifo_allocations.all())
 
         # 2. Cleanup records
         if hasattr(sale, 'inventory_movements'):
              sale.inventory_movements.all().delete()
-        if hasattr(sale, 'journal_entries'):
-             sale.journal_entries.all().delete()
         
         # Fix legacy references (orphan entries not explicitly linked)
         InventoryMovement.objects.filter(reference=f'Sale ID: {sale.id}').delete()
@@ -340,24 +460,40 @@ class SaleDeleteView(ManagerRequiredMixin, LoginRequiredMixin, DeleteView):
         time_window = timedelta(hours=1)
         
         # Search for unlinked Income entries matching this sale's product and quantity
-        MoneyJournal.objects.filter(
+        legacy_income = MoneyJournal.objects.filter(
             Q(sale__isnull=True),
             Q(entry_type='Income'),
             Q(description__icontains=f'Sale of {product.name} (x{sale.quantity})'),
             Q(amount__in=[sale.total_price, sale.amount_paid]),
             Q(date__range=(sale.date - time_window, sale.date + time_window))
-        ).delete()
+        )
 
         # Clean up any "Reversal" expenses that might have been created by old logic
-        MoneyJournal.objects.filter(
+        reversals = MoneyJournal.objects.filter(
             entry_type='Expense',
             description__icontains=f'Reversal: Deleted Sale of {product.name}',
-        ).delete()
+        )
+
+        # Note the days of the journal entries going away so their rollups can be redone
+        journal_entries = sale.journal_entries.all()
+        journal_dates = {
+            business_date(date)
+            for entries in (journal_entries, legacy_income, reversals)
+            for date in entries.values_list('date', flat=True)
+        }
+        for entries in (journal_entries, legacy_income, reversals):
+            entries.delete()
              
-        messages.success(self.request, f"Sale of {product.name} deleted. Stock restored and records cleared.")
-        return super().form_valid(form)
+        message_on_commit(self.request, messages.SUCCESS, f"Sale of {product.name} deleted. Stock restored and records cleared.")
+        key = sale_key(sale)
+        response = super().form_valid(form)
+
+        # 3. Drop the sale from the daily rollups and the client's balance
+        refresh_rollups([key], journal_dates)
+        Client.refresh_balances([sale.client_id])
+        return response
 
-class DebtPaymentCreateView(LoginRequiredMixin, CreateView):
+class DebtPaymentCreateView(LoginRequiredMixin, WriteTransactionMixin, CreateView):
     model = DebtPayment
     form_class = DebtPaymentForm
     template_name = 'shop/debt_payment_form.html'
@@ -382,7 +518,6 @@ class DebtPaymentCreateView(LoginRequiredMixin, CreateView):
                 pass
         return context
 
-    @transaction.atomic
     def form_valid(self, form):
         payment = form.save()
         # Record Income in Money Journal
@@ -393,51 +528,73 @@ class DebtPaymentCreateView(LoginRequiredMixin, CreateView):
             date=payment.date,
             debt_payment=payment
         )
-        messages.success(self.request, f"Payment of {payment.amount} recorded for {payment.client.name}.")
+        refresh_rollups(journal_dates=[business_date(payment.date)])
+        Client.refresh_balances([payment.client_id])
+        message_on_commit(self.request, messages.SUCCESS, f"Payment of {payment.amount} recorded for {payment.client.name}.")
         return super().form_valid(form)
 
-class DebtPaymentDeleteView(ManagerRequiredMixin, LoginRequiredMixin, DeleteView):
+class DebtPaymentDeleteView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, OpenPeriodDeleteMixin, DeleteView):
     model = DebtPayment
     template_name = 'shop/debt_payment_confirm_delete.html'
     
     def get_success_url(self):
         return reverse_lazy('client_detail', kwargs={'pk': self.object.client.pk})
 
-    @transaction.atomic
     def form_valid(self, form):
         payment = self.get_object()
         # Remove corresponding entry in Money Journal
-        MoneyJournal.objects.filter(debt_payment=payment).delete()
-        messages.success(self.request, f"Payment of {payment.amount} removed. Client balance updated.")
-        return super().form_valid(form)
+        entries = MoneyJournal.objects.filter(debt_payment=payment)
+        journal_dates = {business_date(date) for date in entries.values_list('date', flat=True)}
+        entries.delete()
+        refresh_rollups(journal_dates=journal_dates)
+        message_on_commit(self.request, messages.SUCCESS, f"Payment of {payment.amount} removed. Client balance updated.")
+        response = super().form_valid(form)
+        Client.refresh_balances([payment.client_id])
+        return response
 
-class SaleUpdateView(ManagerRequiredMixin, LoginRequiredMixin, UpdateView):
+class SaleUpdateView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, UpdateView):
     model = Sale
     form_class = SaleForm
     template_name = 'shop/sale_form.html'
     success_url = reverse_lazy('sales_history')
 
-    @transaction.atomic
     def form_valid(self, form):
         old_sale = Sale.objects.get(pk=self.object.pk)
         old_quantity = old_sale.quantity
         old_product = old_sale.product
+        old_journal_dates = {business_date(date) for date in old_sale.journal_entries.values_list('date', flat=True)}
         
         sale = form.save()
         
         # 1. Handle stock changes if product or quantity changed
-        if old_product != sale.product:
-            old_product.current_stock += old_quantity
-            old_product.save()
-            sale.product.current_stock -= sale.quantity
-            sale.product.save()
-        elif old_quantity != sale.quantity:
-            sale.product.current_stock += (old_quantity - sale.quantity)
-            sale.product.save()
+        try:
+            if old_product != sale.product:
+                Product.adjust_stock({old_product.pk: old_quantity, sale.product.pk: -sale.quantity})
+            elif old_quantity != sale.quantity:
+                Product.adjust_stock({sale.product.pk: old_quantity - sale.quantity})
+        except InsufficientStock as e:
+            transaction.set_rollback(True)
+            form.add_error('quantity', str(e))
+            return self.form_invalid(form)
+
+        # Return the old quantity to its batches and consume the new one
+        if old_product != sale.product or old_quantity != sale.quantity:
+            FifoAllocation.release(sale.fifo_allocations.all())
+            consumption = consume_stock(sale.product, sale.quantity)
+            FifoAllocation.record(consumption.allocations, sale=sale)
+            sale.cost_price = consumption.cost_price
+            sale.save(update_fields=['cost_price'])
+            InventoryMovement.objects.filter(sale=sale).update(
+                product=sale.product,
+                quantity=sale.quantity,
+                cost_price=consumption.cost_price
+            )
+            bump_versions(InventoryMovement)
 
         # 2. Update/Sync Money Journal and Inventory Movement Dates
         MoneyJournal.objects.filter(sale=sale).delete()
         InventoryMovement.objects.filter(sale=sale).update(date=sale.date)
+        bump_versions(InventoryMovement)
         
         amount_to_record = sale.total_price if not sale.is_credit else sale.amount_paid
         if amount_to_record > 0:
@@ -452,8 +609,12 @@ class SaleUpdateView(ManagerRequiredMixin, LoginRequiredMixin, UpdateView):
                 date=sale.date,
                 sale=sale
             )
+
+        # 3. Move the sale between rollup rows if its day or product changed
+        refresh_rollups({sale_key(old_sale), sale_key(sale)}, old_journal_dates | {business_date(sale.date)})
+        Client.refresh_balances({old_sale.client_id, sale.client_id})
             
-        messages.success(self.request, f"Sale updated successfully.")
+        message_on_commit(self.request, messages.SUCCESS, f"Sale updated successfully.")
         return super().form_valid(form)
 
 class BulkRestockView(ManagerRequiredMixin, LoginRequiredMixin, TemplateView):
@@ -464,7 +625,7 @@ class BulkRestockView(ManagerRequiredMixin, LoginRequiredMixin, TemplateView):
         context['products'] = Product.objects.all().order_by('name')
         return context
 
-    @transaction.atomic
+    @write_transaction
     def post(self, request, *args, **kwargs):
         product_ids = request.POST.getlist('product_ids')
         reference = request.POST.get('reference', 'Bulk Restock')
@@ -476,6 +637,11 @@ class BulkRestockView(ManagerRequiredMixin, LoginRequiredMixin, TemplateView):
             movement_date = timezone.make_aware(movement_date)
         else:
             movement_date = timezone.now()
+        try:
+            check_open(movement_date)
+        except PeriodClosed as e:
+            message_on_commit(request, messages.ERROR, str(e))
+            return redirect('bulk_restock')
 
         updated_count = 0
         for pid in product_ids:
@@ -490,39 +656,41 @@ class BulkRestockView(ManagerRequiredMixin, LoginRequiredMixin, TemplateView):
                 cost_price_decimal = None
                 if cost_price and cost_price.strip():
                     try:
-                        cost_price_decimal = float(cost_price)
-                    except ValueError:
+                        cost_price_decimal = Decimal(cost_price)
+                    except (ValueError, InvalidOperation):
                         pass
                 
-                # 1. Update stock
-                product.current_stock += qty
-                
-                # Update product cost price if this is the first stock or if provided
-                if cost_price_decimal and (not product.cost_price or request.POST.get(f'update_cost_{pid}') == 'on'):
-                    product.cost_price = cost_price_decimal
-                
-                product.save()
-                
-                # 2. Record movement with cost price and remaining quantity
+                # 1. Record movement with cost price and hand it to the product's costing method
                 movement = InventoryMovement.objects.create(
                     product=product,
                     movement_type='IN',
                     quantity=qty,
-                    remaining_quantity=qty,  # All stock is available initially
                     date=movement_date,
                     reference=reference,
                     cost_price=cost_price_decimal
                 )
+                receive_stock(product, movement)
+
+                # 2. Update stock
+                product.add_stock(qty)
+                
+                # Update product cost price if this is the first stock or if provided
+                if cost_price_decimal and (not product.cost_price or request.POST.get(f'update_cost_{pid}') == 'on'):
+                    product.cost_price = cost_price_decimal
+                    product.save(update_fields=['cost_price'])
+                
+                # A backdated batch changes the FIFO cost of later sales
+                recost_product(product, movement_date)
                 updated_count += 1
         
         if updated_count > 0:
-            messages.success(request, f"Successfully restocked {updated_count} products.")
+            message_on_commit(request, messages.SUCCESS, f"Successfully restocked {updated_count} products.")
         else:
-            messages.warning(request, "No stock updates performed.")
+            message_on_commit(request, messages.WARNING, "No stock updates performed.")
             
         return redirect('inventory_history')
 
-class MovementCreateView(LoginRequiredMixin, CreateView):
+class MovementCreateView(LoginRequiredMixin, WriteTransactionMixin, CreateView):
     model = InventoryMovement
     form_class = MovementForm
     template_name = 'shop/movement_form.html'
@@ -533,56 +701,84 @@ class MovementCreateView(LoginRequiredMixin, CreateView):
         initial['date'] = timezone.now().date()
         return initial
 
-    @transaction.atomic
     def form_valid(self, form):
         movement = form.save()
         
-        # Set remaining_quantity based on movement type
         if movement.movement_type == 'IN':
-            movement.remaining_quantity = movement.quantity  # All stock is available
-            # Update Product Stock
+            # All stock is available to the product's costing method (a new layer for FIFO/FEFO)
             product = movement.product
-            product.current_stock += movement.quantity
-            product.save()
+            receive_stock(product, movement)
+            # Update Product Stock
+            product.add_stock(movement.quantity)
+            # A backdated batch changes the FIFO cost of later sales
+            recost_product(product, movement.date)
         else:
-            movement.remaining_quantity = 0  # OUT movements have no remaining stock
             # For OUT movements, deduct from available batches
-            if movement.product.current_stock >= movement.quantity:
-                movement.product.deduct_from_batches(movement.quantity)
-                movement.product.current_stock -= movement.quantity
-                movement.product.save()
+            try:
+                movement.product.remove_stock(movement.quantity)
+            except InsufficientStock as e:
+                transaction.set_rollback(True)
+                form.add_error('quantity', str(e))
+                return self.form_invalid(form)
+            movement.record_consumption(consume_stock(movement.product, movement.quantity))
         
-        movement.save()
         return super().form_valid(form)
 
-class MovementUpdateView(ManagerRequiredMixin, LoginRequiredMixin, UpdateView):
+class MovementUpdateView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, UpdateView):
     model = InventoryMovement
     form_class = MovementForm
     template_name = 'shop/movement_form.html'
     success_url = reverse_lazy('inventory_history')
 
-    @transaction.atomic
     def form_valid(self, form):
         # Get the original movement to reverse its stock effect
         original_movement = InventoryMovement.objects.get(pk=self.object.pk)
         product = original_movement.product
         
-        # Reverse the original movement's effect on stock
-        if original_movement.movement_type == 'IN':
-            product.current_stock -= original_movement.quantity
-        else:
-            product.current_stock += original_movement.quantity
-        
         # Save the updated movement
         movement = form.save()
-        
-        # Apply the new movement's effect on stock
-        if movement.movement_type == 'IN':
-            product.current_stock += movement.quantity
+
+        # Reverse the original movement's effect on stock and apply the new one in one guarded update
+        def signed(m):
+            return m.quantity if m.movement_type == 'IN' else -m.quantity
+        try:
+            Product.adjust_stock({product.pk: signed(movement) - signed(original_movement)})
+        except InsufficientStock as e:
+            transaction.set_rollback(True)
+            form.add_error('quantity', str(e))
+            return self.form_invalid(form)
+
+        # Hand back what an edited stock-out took before re-applying it
+        if original_movement.movement_type == 'OUT':
+            FifoAllocation.release(movement.out_allocations.all())
+
+        # Keep the FIFO layer in step with the edited movement
+        uses_layers = get_strategy(product).uses_layers
+        layer = FifoLayer.objects.filter(movement=movement).first()
+        consumed = 0
+        if original_movement.movement_type == 'IN':
+            consumed = original_movement.quantity - (layer.remaining_quantity if layer else 0)
+        remaining = movement.quantity - consumed
+
+        if movement.movement_type == 'IN' and remaining > 0 and uses_layers:
+            FifoLayer.objects.update_or_create(movement=movement, defaults={
+                'product': product,
+                'date': movement.date,
+                'expiry_date': movement.expiry_date,
+                'cost_price': movement.cost_price,
+                'remaining_quantity': remaining,
+            })
+        elif layer:
+            layer.delete()
+
+        if movement.movement_type == 'OUT':
+            # A cost price the user left as it was follows the new consumption
+            movement.record_consumption(consume_stock(product, movement.quantity),
+                                        keep_cost='cost_price' in form.changed_data)
         else:
-            product.current_stock -= movement.quantity
-            
-        product.save()
+            # Sales from the earlier of the old and new dates may now cost differently
+            recost_product(product, min(original_movement.date, movement.date))
+
         return super().form_valid(form)
 
 class ExpenseCategoryListView(ManagerRequiredMixin, LoginRequiredMixin, ListView):
@@ -597,7 +793,7 @@ class ExpenseCategoryCreateView(ManagerRequiredMixin, LoginRequiredMixin, Create
     template_name = 'shop/category_form.html'
     success_url = reverse_lazy('category_list')
 
-class MoneyJournalCreateView(ManagerRequiredMixin, LoginRequiredMixin, CreateView):
+class MoneyJournalCreateView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, CreateView):
     model = MoneyJournal
     form_class = MoneyJournalForm
     template_name = 'shop/journal_form.html'
@@ -608,97 +804,69 @@ class MoneyJournalCreateView(ManagerRequiredMixin, LoginRequiredMixin, CreateVie
         initial['date'] = timezone.now().date()
         return initial
 
-class ProfitReportView(ManagerRequiredMixin, LoginRequiredMixin, ListView):
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        refresh_rollups(journal_dates=[business_date(self.object.date)])
+        return response
+
+class ProfitReportView(ManagerRequiredMixin, LoginRequiredMixin, CSVExportMixin, ListView):
     model = Product
     template_name = 'shop/profit_report.html'
-    ordering = ['name']
+    context_object_name = 'report_data'
     paginate_by = 20
-    
-    def get_queryset(self):
-        # Get date filters
-        start_date = self.request.GET.get('start_date')
-        end_date = self.request.GET.get('end_date')
-        
-        # Filter sales by date range if provided
-        sales_filter = Sale.objects.all()
-        items_filter = SaleItem.objects.all()
-        if start_date:
-            try:
-                start_dt = timezone.datetime.strptime(start_date, '%Y-%m-%d')
-                start_dt = timezone.make_aware(start_dt)
-                sales_filter = sales_filter.filter(date__gte=start_dt)
-                items_filter = items_filter.filter(invoice__date__gte=start_dt)
-            except ValueError:
-                pass
-        if end_date:
+    export_filename = 'profit_report'
+    export_header = ['Product', 'Units Sold', 'Revenue', 'Cost', 'Net Profit', 'Margin %']
+
+    def get_range(self):
+        # Selected business days; None leaves that end open
+        bounds = []
+        for param in ('start_date', 'end_date'):
             try:
-                end_dt = timezone.datetime.strptime(end_date, '%Y-%m-%d')
-                end_dt = timezone.make_aware(end_dt.replace(hour=23, minute=59, second=59))
-                sales_filter = sales_filter.filter(date__lte=end_dt)
-                items_filter = items_filter.filter(invoice__date__lte=end_dt)
+                bounds.append(timezone.datetime.strptime(self.request.GET.get(param, ''), '%Y-%m-%d').date())
             except ValueError:
-                pass
-        
-        # Start with all products
-        queryset = Product.objects.prefetch_related(
-            Prefetch('sales', queryset=sales_filter, to_attr='filtered_sales'),
-            Prefetch('saleitem_set', queryset=items_filter, to_attr='filtered_invoice_items')
-        )
-        return queryset
+                bounds.append(None)
+        return bounds
+
+    def get_sources(self):
+        # Sales rollups of the selected days, with the closed months they fully cover read from snapshots instead
+        start, end = self.get_range()
+        rollups = DailyRollup.objects.filter(product__isnull=False)
+        if start:
+            rollups = rollups.filter(date__gte=start)
+        if end:
+            rollups = rollups.filter(date__lte=end)
+        return report_sources(rollups, start, end)
+
+    def get_queryset(self):
+        # Totalled, ranked by Net Profit and paginated in SQL across every product
+        return product_profits(*self.get_sources())
+
+    def get_summary(self):
+        revenue = cost = 0
+        for source in self.get_sources():
+            totals = source.aggregate(revenue=Sum('revenue'), cost=Sum('cogs'))
+            revenue += totals['revenue'] or 0
+            cost += totals['cost'] or 0
+        return {'total_revenue_sum': revenue, 'total_profit_sum': revenue - cost}
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        
-        # Get date filters
-        start_date = self.request.GET.get('start_date')
-        end_date = self.request.GET.get('end_date')
-        
-        products_data = []
-        total_revenue_sum = 0
-        total_profit_sum = 0
-
-        # Process each product to calculate profit based on actual sale cost prices
-        for product in context['object_list']:
-            # Get filtered sales for this product (prefetched)
-            sales = product.filtered_sales
-            invoice_items = product.filtered_invoice_items
-            
-            total_sold = sum(sale.quantity for sale in sales) + sum(item.quantity for item in invoice_items)
-            
-            if total_sold == 0:
-                continue
-                
-            total_revenue = sum(sale.total_price for sale in sales) + sum(item.total_price for item in invoice_items)
-            total_cost = sum(sale.total_cost for sale in sales) + sum(item.total_cost for item in invoice_items)
-            net_profit = sum(sale.profit for sale in sales if hasattr(sale, 'profit') and sale.profit) + sum(item.profit for item in invoice_items if hasattr(item, 'profit') and item.profit)
-            
-            if total_revenue > 0:
-                margin = (net_profit / total_revenue) * 100
-            else:
-                margin = 0
-            
-            products_data.append({
-                'name': product.name,
-                'total_sold': total_sold,
-                'total_revenue': total_revenue,
-                'total_cost': total_cost,
-                'net_profit': net_profit,
-                'margin': round(margin, 1)
-            })
-            
-            total_revenue_sum += total_revenue
-            total_profit_sum += net_profit
-            
-        # Sort by Net Profit descending
-        products_data.sort(key=lambda x: x['net_profit'], reverse=True)
-        
-        context['report_data'] = products_data
-        context['total_revenue_sum'] = total_revenue_sum
-        context['total_profit_sum'] = total_profit_sum
-        context['start_date'] = start_date or ''
-        context['end_date'] = end_date or ''
+
+        # Totals are reused for this date range until a rollup changes
+        context.update(cached_context(
+            'profit_report',
+            [DailyRollup, PeriodSnapshot],
+            {param: self.request.GET.get(param, '') for param in ('start_date', 'end_date')},
+            self.get_summary
+        ))
+        context['start_date'] = self.request.GET.get('start_date', '')
+        context['end_date'] = self.request.GET.get('end_date', '')
         return context
 
+    def export_row(self, product):
+        return [product.name, product.total_sold, to_amount(product.total_revenue), to_amount(product.total_cost),
+                to_amount(product.net_profit), product.margin]
+
 from django.shortcuts import get_object_or_404, redirect
 from django.contrib import messages
 from django.views.decorators.http import require_POST
@@ -707,90 +875,60 @@ from django.http import JsonResponse
 import json
 from django.contrib.auth.decorators import login_required
 
-class SalesReportView(ManagerRequiredMixin, LoginRequiredMixin, DateFilterMixin, ListView):
+class SalesReportView(ManagerRequiredMixin, LoginRequiredMixin, CSVExportMixin, DateFilterMixin, ListView):
     model = Sale
     template_name = 'shop/sales_report.html'
     context_object_name = 'sales'
     paginate_by = 50
+    export_filename = 'sales_report'
+    export_header = ['Date', 'Source', 'Product', 'Client', 'Quantity', 'Price', 'Total', 'Cost', 'Profit', 'Type']
 
-    def get_queryset(self):
+    def get_querysets(self):
         # 1. Get filtered sales
-        sales_qs = Sale.objects.select_related('product', 'client')
-        sales_qs = self.apply_date_filters(sales_qs)
-        
-        # 2. Get filtered invoice items
-        items_qs = SaleItem.objects.select_related('product', 'invoice', 'invoice__client')
-        original_date_field = getattr(self, 'date_field', 'date')
+        sales = self.apply_date_filters(Sale.objects.all())
+
+        # 2. Get filtered invoice items (dated by their invoice)
         self.date_field = 'invoice__date'
-        items_qs = self.apply_date_filters(items_qs)
-        self.date_field = original_date_field
-        
-        # 3. Combine and sort
-        combined = list(sales_qs) + list(items_qs)
-        combined.sort(key=lambda x: x.date, reverse=True)
-        return combined
+        items = self.apply_date_filters(SaleItem.objects.all())
+        self.date_field = 'date'
+        return sales, items
+
+    def get_queryset(self):
+        # 3. Combine and sort in the database; the paginator only reads the current page
+        return sales_lines(*self.get_querysets())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Get the full queryset for statistics (before pagination)
-        queryset = self.get_queryset()
-        
-        # Calculate summary statistics
-        total_revenue = sum(sale.total_price for sale in queryset)
-        total_cost = sum(sale.total_cost for sale in queryset if sale.total_cost)
-        total_profit = sum(sale.profit for sale in queryset if hasattr(sale, 'profit') and sale.profit)
-        
-        cash_sales = [s for s in queryset if not s.is_credit]
-        credit_sales = [s for s in queryset if s.is_credit]
-        
-        cash_revenue = sum(sale.total_price for sale in cash_sales)
-        credit_revenue = sum(sale.total_price for sale in credit_sales)
-        
-        # Calculate outstanding credit
-        # Since SaleItem amount_paid is 0 and we don't want to double count invoice payments,
-        # we calculate total unpaid by summing over Sales and unique Invoices.
-        sales_only_credit = [s for s in credit_sales if isinstance(s, Sale)]
-        total_unpaid = sum(s.total_price - s.amount_paid for s in sales_only_credit)
-        
-        unique_credit_invoices = set(item.invoice for item in credit_sales if hasattr(item, 'invoice'))
-        total_unpaid += sum(inv.total_price - inv.amount_paid for inv in unique_credit_invoices)
-        
-        # Calculate debt payments per client to avoid double-counting
-        debt_payments_total = 0
-        unique_clients = set()
-        for sale in credit_sales:
-            if sale.client and sale.client not in unique_clients:
-                debt_payments_total += sum(p.amount for p in sale.client.debt_payments.all())
-                unique_clients.add(sale.client)
-        
-        outstanding_credit = total_unpaid - debt_payments_total
+        # Summary statistics are reused for this date range until the sales data changes
+        context.update(cached_context(
+            'sales_report',
+            [Sale, SaleItem, Invoice, Client, DebtPayment],
+            {param: self.request.GET.get(param, '') for param in ('start_date', 'end_date')},
+            self.get_summary
+        ))
         
         # Get filter values for form
-        start_date = self.request.GET.get('start_date', '')
-        end_date = self.request.GET.get('end_date', '')
-        
-        context.update({
-            'total_revenue': total_revenue,
-            'total_cost': total_cost,
-            'total_profit': total_profit,
-            'cash_revenue': cash_revenue,
-            'credit_revenue': credit_revenue,
-            'outstanding_credit': outstanding_credit,
-            'total_sales': len(queryset),
-            'cash_sales_count': len(cash_sales),
-            'credit_sales_count': len(credit_sales),
-            'start_date': start_date,
-            'end_date': end_date,
-        })
-        
+        context['start_date'] = self.request.GET.get('start_date', '')
+        context['end_date'] = self.request.GET.get('end_date', '')
         return context
 
-class ExpensesReportView(ManagerRequiredMixin, LoginRequiredMixin, DateFilterMixin, ListView):
+    def get_summary(self):
+        # Read from the lines themselves, closed months included: they can no longer change
+        return sales_summary(*self.get_querysets())
+
+    def export_row(self, line):
+        return [export_date(line['sold_at']), 'Invoice' if line['kind'] == 'item' else 'Sale', line['product_name'],
+                line['client_name'], line['quantity'], line['price_at_sale'], to_amount(line['total_price']),
+                to_amount(line['total_cost']), to_amount(line['profit']), 'Credit' if line['credit'] else 'Cash']
+
+class ExpensesReportView(ManagerRequiredMixin, LoginRequiredMixin, CSVExportMixin, DateFilterMixin, ListView):
     model = MoneyJournal
     template_name = 'shop/expenses_report.html'
     context_object_name = 'expenses'
     paginate_by = 50
+    export_filename = 'expenses_report'
+    export_header = ['Date', 'Category', 'Description', 'Amount']
 
     def get_queryset(self):
         queryset = MoneyJournal.objects.filter(entry_type='Expense').select_related('category').order_by('-date')
@@ -799,43 +937,98 @@ class ExpensesReportView(ManagerRequiredMixin, LoginRequiredMixin, DateFilterMix
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Get the full queryset for statistics (before pagination)
-        queryset = self.get_queryset()
-        
-        # Calculate summary statistics
-        total_expenses = sum(expense.amount for expense in queryset)
-        
-        # Group by category
-        category_totals = {}
-        for expense in queryset:
-            category_name = expense.category.name if expense.category else 'Uncategorized'
-            if category_name not in category_totals:
-                category_totals[category_name] = 0
-            category_totals[category_name] += expense.amount
+        # Summary statistics are reused for this date range until an expense changes
+        context.update(cached_context(
+            'expenses_report',
+            [MoneyJournal, ExpenseCategory],
+            {param: self.request.GET.get(param, '') for param in ('start_date', 'end_date')},
+            self.get_summary
+        ))
         
         # Get filter values for form
-        start_date = self.request.GET.get('start_date', '')
-        end_date = self.request.GET.get('end_date', '')
-        
+        context['start_date'] = self.request.GET.get('start_date', '')
+        context['end_date'] = self.request.GET.get('end_date', '')
+        return context
+
+    def get_summary(self):
+        # Grouped in the database; the rows themselves are only read a page at a time
+        return expense_summary(self.apply_date_filters(MoneyJournal.objects.filter(entry_type='Expense')))
+
+    def export_row(self, expense):
+        return [export_date(expense.date), expense.category.name if expense.category else 'Uncategorized',
+                expense.description, expense.amount]
+
+class ClosedPeriodListView(ManagerRequiredMixin, LoginRequiredMixin, CSVExportMixin, ListView):
+    """
+    The frozen month-end figures of every closed month, latest first
+    """
+    model = ClosedPeriod
+    template_name = 'shop/closed_periods.html'
+    context_object_name = 'periods'
+    paginate_by = 12
+    export_filename = 'closed_periods'
+    export_header = ['Month', 'Revenue', 'COGS', 'Margin', 'Expenses', 'Receivables', 'Stock Value', 'Closed At']
+
+    def get_queryset(self):
+        return period_totals(ClosedPeriod.objects.order_by('-month'))
+
+    def export_row(self, period):
+        return [period.month.strftime('%Y-%m'), to_amount(period.revenue), to_amount(period.cogs),
+                to_amount(period.margin), to_amount(period.expenses), to_amount(period.receivables),
+                to_amount(period.stock_value), export_date(period.closed_at)]
+
+class AgingReportView(ManagerRequiredMixin, LoginRequiredMixin, TemplateView):
+    """
+    Outstanding receivables per client by days past due; ?client=<pk> lists that client's open documents
+    """
+    template_name = 'shop/aging_report.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        today = timezone.localdate()
+        rows = cached_context(
+            'aging_report', [Sale, SaleItem, Invoice, Client, DebtPayment], {'today': today}, lambda: aging_rows(today)
+        )
+        totals = aging_totals(rows)
+        bucket_totals = [totals[bucket.key] for bucket in BUCKETS]
         context.update({
-            'total_expenses': total_expenses,
-            'category_totals': category_totals,
-            'expense_count': len(queryset),
-            'average_expense': total_expenses / len(queryset) if len(queryset) > 0 else 0,
-            'start_date': start_date,
-            'end_date': end_date,
+            'rows': rows,
+            'buckets': BUCKETS,
+            'bucket_totals': bucket_totals,
+            'bucket_summary': list(zip(BUCKETS, bucket_totals)),
+            'grand_total': totals['total'],
+            'today': today,
         })
-        
+
+        client_id = self.request.GET.get('client')
+        if client_id:
+            client = get_object_or_404(Client, pk=client_id)
+            context['selected_client'] = client
+            context['documents'] = open_documents(client.pk, today)
         return context
 
-class MoneyJournalDeleteView(ManagerRequiredMixin, LoginRequiredMixin, DeleteView):
+class AgingReportCSVView(ManagerRequiredMixin, LoginRequiredMixin, View):
+    def get(self, request):
+        today = timezone.localdate()
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="aging_{today:%Y%m%d}.csv"'
+        writer = csv.writer(response)
+        writer.writerow(['Client'] + [bucket.label for bucket in BUCKETS] + ['Total'])
+        for row in aging_rows(today):
+            writer.writerow([row['name']] + [row['buckets'][bucket.key] for bucket in BUCKETS] + [row['total']])
+        return response
+
+class MoneyJournalDeleteView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, OpenPeriodDeleteMixin, DeleteView):
     model = MoneyJournal
     template_name = 'shop/money_confirm_delete.html'
     success_url = reverse_lazy('money_journal')
 
     def form_valid(self, form):
-        messages.success(self.request, "Journal entry deleted successfully.")
-        return super().form_valid(form)
+        message_on_commit(self.request, messages.SUCCESS, "Journal entry deleted successfully.")
+        day = business_date(self.object.date)
+        response = super().form_valid(form)
+        refresh_rollups(journal_dates=[day])
+        return response
 
 class ReceiptPDFView(LoginRequiredMixin, View):
     def get(self, request, pk):
@@ -858,33 +1051,37 @@ class ReceiptPDFView(LoginRequiredMixin, View):
 
 @login_required
 @require_POST
+@write_transaction
 def quick_stock_update(request, pk):
     product = get_object_or_404(Product, pk=pk)
     action = request.POST.get('action')
     
     if action == 'add':
-        product.current_stock += 1
-        InventoryMovement.objects.create(
+        movement = InventoryMovement.objects.create(
             product=product,
             movement_type='IN',
             quantity=1,
             reference='Quick Adjustment (+1)'
         )
-        messages.success(request, f"Added 1 to {product.name} stock.")
+        receive_stock(product, movement)
+        product.add_stock(1)
+        message_on_commit(request, messages.SUCCESS, f"Added 1 to {product.name} stock.")
     elif action == 'remove':
-        if product.current_stock > 0:
-            product.current_stock -= 1
-            InventoryMovement.objects.create(
+        try:
+            # Nothing is written when the guarded update finds no stock
+            product.remove_stock(1)
+        except InsufficientStock:
+            message_on_commit(request, messages.WARNING, f"{product.name} stock is already 0.")
+        else:
+            movement = InventoryMovement.objects.create(
                 product=product,
                 movement_type='OUT',
                 quantity=1,
                 reference='Quick Adjustment (-1)'
             )
-            messages.success(request, f"Removed 1 from {product.name} stock.")
-        else:
-            messages.warning(request, f"{product.name} stock is already 0.")
+            movement.record_consumption(consume_stock(product, 1))
+            message_on_commit(request, messages.SUCCESS, f"Removed 1 from {product.name} stock.")
             
-    product.save()
     return redirect(request.META.get('HTTP_REFERER', 'product_list'))
 
 class InvoiceCreateView(LoginRequiredMixin, TemplateView):
@@ -896,100 +1093,70 @@ class InvoiceCreateView(LoginRequiredMixin, TemplateView):
         context['products'] = Product.objects.all().order_by('name')
         return context
 
-    @transaction.atomic
     def post(self, request, *args, **kwargs):
         try:
             data = json.loads(request.body)
-            client_id = data.get('client_id')
-            is_credit = data.get('is_credit', False)
-            amount_paid = Decimal(data.get('amount_paid', 0))
-            items_data = data.get('items', [])
-
-            if not items_data:
-                return JsonResponse({'success': False, 'error': 'No items in the invoice.'})
-
-            client = Client.objects.get(id=client_id) if client_id else None
-
-            date_str = data.get('date')
-            invoice_date = timezone.now()
-            if date_str:
-                try:
-                    dt = timezone.datetime.strptime(date_str, '%Y-%m-%d')
-                    invoice_date = timezone.make_aware(dt)
-                except ValueError:
-                    pass
-
-            # Create Invoice
-            invoice = Invoice.objects.create(
-                client=client,
-                date=invoice_date,
-                is_credit=is_credit,
-                amount_paid=amount_paid
-            )
-
-            total_sale_price = 0
-
-            # Process items
-            for item in items_data:
-                product = Product.objects.get(id=item['product_id'])
-                quantity = Decimal(item['quantity'])
-                price = Decimal(item['price'])
+            invoice = self.save_invoice(data)
+            return JsonResponse({'success': True, 'invoice_id': invoice.id})
+        except Exception as e:
+            # The write transaction has already been rolled back
+            return JsonResponse({'success': False, 'error': str(e)})
 
-                if quantity <= 0:
-                    continue
+    @write_transaction
+    def save_invoice(self, data):
+        """
+        Create the invoice, its items and journal entry; retried from the start while the database is locked
+        """
+        client_id = data.get('client_id')
+        is_credit = data.get('is_credit', False)
+        amount_paid = Decimal(data.get('amount_paid', 0))
+        items_data = data.get('items', [])
 
-                if product.current_stock < quantity:
-                    raise ValueError(f"Not enough stock for {product.name}")
+        if not items_data:
+            raise ValueError('No items in the invoice.')
 
-                # Calculate FIFO cost price
-                cost_price = product.get_fifo_cost_price(quantity)
-                product.deduct_from_batches(quantity)
+        client = Client.objects.get(id=client_id) if client_id else None
 
-                # Update current stock
-                product.current_stock -= quantity
-                product.save()
+        date_str = data.get('date')
+        invoice_date = timezone.now()
+        if date_str:
+            try:
+                dt = timezone.datetime.strptime(date_str, '%Y-%m-%d')
+                invoice_date = timezone.make_aware(dt)
+            except ValueError:
+                pass
 
-                # Create SaleItem
-                SaleItem.objects.create(
-                    invoice=invoice,
-                    product=product,
-                    quantity=quantity,
-                    price_at_sale=price,
-                    cost_price=cost_price
-                )
+        # Create Invoice
+        invoice = Invoice.objects.create(
+            client=client,
+            date=invoice_date,
+            is_credit=is_credit,
+            amount_paid=amount_paid
+        )
 
-                # Create InventoryMovement OUT
-                InventoryMovement.objects.create(
-                    product=product,
-                    invoice=invoice,
-                    movement_type='OUT',
-                    quantity=quantity,
-                    date=invoice.date,
-                    reference=f'Invoice #{invoice.id}',
-                    cost_price=cost_price
-                )
+        # Process items
+        # Products and layers are loaded up front and written back in bulk
+        lines = parse_lines(items_data)
+        _, total_sale_price = checkout_invoice(invoice, lines, reference=f'Invoice #{invoice.id}')
 
-                total_sale_price += (quantity * price)
-
-            # Create MoneyJournal entry for the amount paid (if any) or if it's cash (the full amount)
-            amount_received = amount_paid if is_credit else total_sale_price
-            if amount_received > 0:
-                description = f"Invoice #{invoice.id}"
-                if client:
-                    description += f" - {client.name}"
-
-                MoneyJournal.objects.create(
-                    entry_type='Income',
-                    amount=amount_received,
-                    description=description,
-                    invoice=invoice,
-                    date=invoice.date
-                )
+        # Create MoneyJournal entry for the amount paid (if any) or if it's cash (the full amount)
+        amount_received = amount_paid if is_credit else total_sale_price
+        if amount_received > 0:
+            description = f"Invoice #{invoice.id}"
+            if client:
+                description += f" - {client.name}"
 
-            return JsonResponse({'success': True, 'invoice_id': invoice.id})
+            MoneyJournal.objects.create(
+                entry_type='Income',
+                amount=amount_received,
+                description=description,
+                invoice=invoice,
+                date=invoice.date
+            )
 
-        except Exception as e:
-            return JsonResponse({'success': False, 'error': str(e)})
+        refresh_rollups(invoice_keys(invoice), [business_date(invoice.date)])
+        Client.refresh_balances([invoice.client_id])
+        return invoice
 
 class InvoiceListView(LoginRequiredMixin, ListView):
     model = Invoice
@@ -997,34 +1164,54 @@ class InvoiceListView(LoginRequiredMixin, ListView):
     context_object_name = 'invoices'
     paginate_by = 20
     ordering = ['-date']
+    # ?sort= value -> ordering over the stored totals
+    sort_options = {
+        'date': ['-date'],
+        'amount': ['-total_price', '-date'],
+        'amount_asc': ['total_price', '-date'],
+        'balance': ['-balance_due', '-date'],
+    }
+
+    def get_queryset(self):
+        queryset = super().get_queryset().select_related('client')
 
-class InvoiceDeleteView(ManagerRequiredMixin, LoginRequiredMixin, DeleteView):
+        status = self.request.GET.get('status')
+        if status in Invoice.STATUS_FILTERS:
+            queryset = queryset.filter(Invoice.STATUS_FILTERS[status])
+        for param, lookup in (('min_amount', 'total_price__gte'), ('max_amount', 'total_price__lte')):
+            try:
+                queryset = queryset.filter(**{lookup: Decimal(self.request.GET.get(param, ''))})
+            except InvalidOperation:
+                pass
+
+        return queryset.order_by(*self.sort_options.get(self.request.GET.get('sort'), self.ordering))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['status'] = self.request.GET.get('status', '')
+        context['min_amount'] = self.request.GET.get('min_amount', '')
+        context['max_amount'] = self.request.GET.get('max_amount', '')
+        context['sort'] = self.request.GET.get('sort', 'date')
+        return context
+
+class InvoiceDeleteView(ManagerRequiredMixin, LoginRequiredMixin, WriteTransactionMixin, OpenPeriodDeleteMixin, DeleteView):
     model = Invoice
     template_name = 'shop/invoice_confirm_delete.html'
     success_url = reverse_lazy('invoice_list')
 
-    @transaction.atomic
     def form_valid(self, form):
         invoice = self.get_object()
         
-        # Restore stock for each item
-        for item in invoice.items.all():
-            product = item.product
-            product.current_stock += item.quantity
-            product.save()
-            
-            # Create compensation stock-in to restore batches
-            InventoryMovement.objects.create(
-                product=product,
-                movement_type='IN',
-                quantity=item.quantity,
-                remaining_quantity=item.quantity,
-                reference=f'Invoice {invoice.id} deleted',
-                cost_price=item.cost_price
-            )
-
-        messages.success(self.request, f"Invoice #{invoice.id} deleted and stock restored.")
-        return super().form_valid(form)
+        # Restore stock and batches for every item
+        return_invoice_stock(invoice)
+
+        message_on_commit(self.request, messages.SUCCESS, f"Invoice #{invoice.id} deleted and stock restored.")
+        keys = invoice_keys(invoice)
+        journal_dates = {business_date(date) for date in invoice.journal_entries.values_list('date', flat=True)}
+        response = super().form_valid(form)
+        refresh_rollups(keys, journal_dates)
+        Client.refresh_balances([invoice.client_id])
+        return response
 
 class InvoiceReceiptPDFView(LoginRequiredMixin, View):
     def get(self, request, pk):
@@ -1055,124 +1242,76 @@ class InvoiceUpdateView(ManagerRequiredMixin, LoginRequiredMixin, TemplateView):
         context['products'] = Product.objects.all().order_by('name')
         return context
 
-    @transaction.atomic
     def post(self, request, *args, **kwargs):
         try:
-            invoice = get_object_or_404(Invoice, pk=self.kwargs['pk'])
             data = json.loads(request.body)
-            client_id = data.get('client_id')
-            is_credit = data.get('is_credit', False)
-            amount_paid = Decimal(data.get('amount_paid', 0))
-            items_data = data.get('items', [])
-            date_str = data.get('date')
-
-            if not items_data:
-                return JsonResponse({'success': False, 'error': 'No items in the invoice.'})
-
-            # 1. Revert Old Items (Restore Stock)
-            for item in invoice.items.all():
-                product = item.product
-                product.current_stock += item.quantity
-                product.save()
-                
-                # Create compensation stock-in to restore batches
-                InventoryMovement.objects.create(
-                    product=product,
-                    movement_type='IN',
-                    quantity=item.quantity,
-                    remaining_quantity=item.quantity,
-                    reference=f'Invoice #{invoice.id} edited (revert)',
-                    cost_price=item.cost_price,
-                    date=invoice.date
-                )
-
-            # 2. Delete old related records
-            invoice.items.all().delete()
-            # MoneyJournal entries related to this invoice are cascading, but let's be explicit
-            MoneyJournal.objects.filter(invoice=invoice).delete()
-            # Delete old OUT movements to avoid clutter? Or keep them?
-            # It's better to keep the OUT movement and the IN movement for audit trail.
-            # But the logic above already creates an IN movement to compensate.
-            # The old IN movements for deletion have `date=invoice.date`.
-
-            # 3. Update Invoice Details
-            client = Client.objects.get(id=client_id) if client_id else None
-            invoice.client = client
-            invoice.is_credit = is_credit
-            invoice.amount_paid = amount_paid
-            
-            if date_str:
-                try:
-                    dt = timezone.datetime.strptime(date_str, '%Y-%m-%d')
-                    invoice.date = timezone.make_aware(dt)
-                except ValueError:
-                    pass
-            invoice.save()
-
-            total_sale_price = 0
-
-            # 4. Apply New Items
-            for item in items_data:
-                product = Product.objects.get(id=item['product_id'])
-                quantity = Decimal(item['quantity'])
-                price = Decimal(item['price'])
-
-                if quantity <= 0:
-                    continue
-
-                if product.current_stock < quantity:
-                    raise ValueError(f"Not enough stock for {product.name}")
-
-                # Calculate FIFO cost price
-                cost_price = product.get_fifo_cost_price(quantity)
-                product.deduct_from_batches(quantity)
-
-                # Update current stock
-                product.current_stock -= quantity
-                product.save()
-
-                # Create SaleItem
-                SaleItem.objects.create(
-                    invoice=invoice,
-                    product=product,
-                    quantity=quantity,
-                    price_at_sale=price,
-                    cost_price=cost_price
-                )
-
-                # Create InventoryMovement OUT
-                InventoryMovement.objects.create(
-                    product=product,
-                    invoice=invoice,
-                    movement_type='OUT',
-                    quantity=quantity,
-                    date=invoice.date,
-                    reference=f'Invoice #{invoice.id} (edited)',
-                    cost_price=cost_price
-                )
-
-                total_sale_price += (quantity * price)
-
-            # 5. Create MoneyJournal entry
-            amount_received = amount_paid if is_credit else total_sale_price
-            if amount_received > 0:
-                description = f"Invoice #{invoice.id}"
-                if client:
-                    description += f" - {client.name}"
-
-                MoneyJournal.objects.create(
-                    entry_type='Income',
-                    amount=amount_received,
-                    description=description,
-                    invoice=invoice,
-                    date=invoice.date
-                )
-
+            invoice = self.save_invoice(self.kwargs['pk'], data)
             return JsonResponse({'success': True, 'invoice_id': invoice.id})
-
         except Exception as e:
+            # The write transaction has already been rolled back
             return JsonResponse({'success': False, 'error': str(e)})
 
+    @write_transaction
+    def save_invoice(self, pk, data):
+        """
+        Apply the edited items, payment and journal entry of an invoice; retried from the start while the database is locked
+        The invoice is read inside, so a retry never sees what a rolled-back attempt changed in memory
+        """
+        invoice = get_object_or_404(Invoice, pk=pk)
+        client_id = data.get('client_id')
+        is_credit = data.get('is_credit', False)
+        amount_paid = Decimal(data.get('amount_paid', 0))
+        items_data = data.get('items', [])
+        date_str = data.get('date')
+
+        if not items_data:
+            raise ValueError('No items in the invoice.')
+
+        old_keys = invoice_keys(invoice)
+        old_client_id = invoice.client_id
+        old_date = invoice.date
+        old_journal_dates = {business_date(date) for date in invoice.journal_entries.values_list('date', flat=True)}
+
+        # 1. Update Invoice Details
+        client = Client.objects.get(id=client_id) if client_id else None
+        invoice.client = client
+        invoice.is_credit = is_credit
+        invoice.amount_paid = amount_paid
+        
+        if date_str:
+            try:
+                dt = timezone.datetime.strptime(date_str, '%Y-%m-%d')
+                invoice.date = timezone.make_aware(dt)
+            except ValueError:
+                pass
+        invoice.save()
+        if invoice.date != old_date:
+            invoice.inventory_movements.filter(movement_type='OUT').update(date=invoice.date)
+
+        # 2. Apply only the line changes: stock, layers, items and movements move by the difference
+        lines = parse_lines(items_data)
+        total_sale_price = update_invoice_lines(invoice, lines, reference=f'Invoice #{invoice.id} (edited)')
+
+        # 3. Update the MoneyJournal entry in place
+        amount_received = amount_paid if is_credit else total_sale_price
+        entries = list(invoice.journal_entries.order_by('id'))
+        if amount_received > 0:
+            description = f"Invoice #{invoice.id}"
+            if client:
+                description += f" - {client.name}"
+
+            entry = entries.pop(0) if entries else MoneyJournal(entry_type='Income', invoice=invoice)
+            entry.amount = amount_received
+            entry.description = description
+            entry.date = invoice.date
+            entry.save()
+        MoneyJournal.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+
+        # 4. Move the lines between rollup rows
+        refresh_rollups(old_keys | invoice_keys(invoice), old_journal_dates | {business_date(invoice.date)})
+        Client.refresh_balances({old_client_id, invoice.client_id})
+        return invoice
+
 @login_required
 def product_by_barcode(request, barcode):
     try: